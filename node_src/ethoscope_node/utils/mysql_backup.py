@@ -11,6 +11,7 @@ class DBNotReadyError(Exception):
 
 class MySQLdbToSQlite(object):
     _max_n_rows_to_insert = 10000
+    _positions_table_name = "POSITIONS"
 
     def     __init__(self, dst_path,
                             remote_db_name="ethoscope_db",
@@ -91,14 +92,20 @@ class MySQLdbToSQlite(object):
             if len([i for i in src_cur]) == 0:
                 raise DBNotReadyError("No read are available for this database yet")
 
-            command = "SHOW TABLES"
+            command = "SHOW FULL TABLES"
             src_cur.execute(command)
-            tables = [c[0] for c in src_cur]
-            for t in tables:
+            tables = [(c[0], c[1]) for c in src_cur]
+            for t, table_type in tables:
+                if table_type == "VIEW":
+                    continue
                 if t == "CSV_DAM_ACTIVITY":
                     self._copy_table(t, src, conn, dump_in_csv=True)
                 else:
                     self._copy_table(t, src, conn, dump_in_csv=False)
+            # e.g. the ROI_<n> views of a single positions table
+            for t, table_type in tables:
+                if table_type == "VIEW":
+                    self._copy_view(t, src, conn)
 
             #TODO checksum of ordered metadata ?
 
@@ -132,6 +139,19 @@ class MySQLdbToSQlite(object):
         else:
             self._replace_table(table_name, src, dst, dump_in_csv)
 
+    def _copy_view(self, view_name, src, dst):
+        # only the per ROI views of the positions table are expected
+        if not view_name.startswith("ROI_"):
+            logging.warning("Not copying unknown view %s" % view_name)
+            return
+        src_cur = src.cursor()
+        src_cur.execute("SHOW COLUMNS FROM %s" % view_name)
+        columns = ", ".join([c[0] for c in src_cur])
+        dst_command = "CREATE VIEW IF NOT EXISTS %s AS SELECT %s FROM %s WHERE roi_idx = %i" % (
+            view_name, columns, self._positions_table_name, int(view_name[len("ROI_"):]))
+        dst.cursor().execute(dst_command)
+        dst.commit()
+
     def update_roi_tables(self):
         """
         Fetch new ROI tables and new data points in the remote and use them to update local db
@@ -145,11 +165,16 @@ class MySQLdbToSQlite(object):
         with sqlite3.connect(self._dst_path, check_same_thread=False) as dst:
 
             dst_cur = src.cursor()
-            command = "SELECT roi_idx FROM ROI_MAP"
-            dst_cur.execute(command)
-            rois_in_src = set([c[0] for c in dst_cur])
-            for i in rois_in_src :
-                self._update_one_roi_table("ROI_%i" % i, src, dst)
+            dst_cur.execute("SHOW TABLES LIKE '%s'" % self._positions_table_name)
+            if len([c for c in dst_cur]) > 0:
+                # all ROIs are in a single table, and ROI_<n> are views of it
+                self._update_one_roi_table(self._positions_table_name, src, dst)
+            else:
+                command = "SELECT roi_idx FROM ROI_MAP"
+                dst_cur.execute(command)
+                rois_in_src = set([c[0] for c in dst_cur])
+                for i in rois_in_src :
+                    self._update_one_roi_table("ROI_%i" % i, src, dst)
 
 
             self._update_one_roi_table("CSV_DAM_ACTIVITY", src, dst, dump_in_csv=True)
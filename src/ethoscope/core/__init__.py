@@ -5,6 +5,7 @@ It defines the building bricks at the basis of the package.
 Overview:
 
 * :class:`~ethoscope.core.monitor.Monitor` is the most important class. It glues together all the other elements of the package in order to perform (video tracking, interacting , data writing and drawing).
+* :class:`~ethoscope.core.monitor.PipelinedMonitor` does the same, but runs acquisition, persistence and drawing in separate stages (:mod:`~ethoscope.core.pipeline`).
 * :class:`~ethoscope.core.tracking_unit.TrackingUnit` are internally used by monitor. They forces to conceptually treat each ROI independently.
 * :class:`~ethoscope.core.roi.ROI` formalise and facilitates the use of Region Of Interests.
 * :mod:`~ethoscope.core.variables` are custom types of variables that result from tracking and interacting.
@@ -20,3 +21,7 @@ import monitor
 import tracking_unit
 import variables
 import roi
+import pipeline
+import deadline
+import rate_scheduler
+import frame_change
@@ -0,0 +1,149 @@
+__author__ = 'quentin'
+
+import time
+
+
+class FrameDeadlineScheduler(object):
+    _critical_tasks = {"tracking", "stimulation"}
+    _deferrable_tasks = ("drawing", "snapshot", "dam", "info_image", "checkpoint", "drift_correction")
+
+    def __init__(self, target_fps, max_postponement=50, smoothing=0.1):
+        """
+        Decides, frame by frame, which work the monitor can afford.
+        Each frame has a budget of ``1/target_fps`` seconds.
+        Work is either *critical* ("tracking" and "stimulation"), and always runs, or *deferrable*
+        (e.g. "drawing", "snapshot", "dam" or "info_image"), and only runs if the time spent so far on the current frame,
+        plus the typical cost of the task, fits in the budget.
+        Shed work is postponed to the next frame. To avoid starvation, a task that was postponed
+        ``max_postponement`` frames in a row is run regardless of the budget.
+
+        :param target_fps: the expected frame rate, which defines the budget per frame.
+        :type target_fps: float
+        :param max_postponement: the maximal number of consecutive frames a deferrable task can be shed for.
+        :type max_postponement: int
+        :param smoothing: the weight of the last measurement in the exponential moving averages of task costs and load.
+        :type smoothing: float
+        """
+        if target_fps <= 0:
+            raise ValueError("The target fps must be positive")
+        self._budget = 1.0 / target_fps
+        self._max_postponement = max_postponement
+        self._smoothing = smoothing
+        self._frame_start = None
+        self._costs = {}
+        self._postponed = {}
+        # counters are created upfront as they may be read and updated from other threads
+        self._counters = {k: {"run": 0, "shed": 0} for k in self._deferrable_tasks}
+        self._load = 0.0
+
+    @property
+    def budget(self):
+        """
+        :return: the time available to process one frame, in seconds
+        :rtype: float
+        """
+        return self._budget
+
+    @property
+    def load(self):
+        """
+        :return: a moving average of the time spent on each frame, relative to the budget. Above 1 means the monitor falls behind.
+        :rtype: float
+        """
+        return self._load
+
+    @property
+    def stats(self):
+        """
+        :return: for each task, the number of times it was run and shed, and the current load.
+        :rtype: dict
+        """
+        out = {k: dict(v) for k, v in self._counters.items()}
+        out["load"] = round(self._load, 3)
+        return out
+
+    def _count(self, task, field):
+        if task not in self._counters:
+            self._counters[task] = {"run": 0, "shed": 0}
+        self._counters[task][field] += 1
+
+    def _ewma(self, old, new):
+        if old is None:
+            return new
+        return (1 - self._smoothing) * old + self._smoothing * new
+
+    def start_frame(self):
+        """
+        Signal the beginning of a new frame. This also updates the load from the previous frame.
+        """
+        now = time.time()
+        if self._frame_start is not None:
+            self._load = self._ewma(self._load, (now - self._frame_start) / self._budget)
+        self._frame_start = now
+
+    def elapsed(self):
+        """
+        :return: the time spent on the current frame, in seconds.
+        :rtype: float
+        """
+        if self._frame_start is None:
+            return 0.0
+        return time.time() - self._frame_start
+
+    def should_run(self, task):
+        """
+        Decide whether a task should be run now. The decision is counted, so callers must abide by it.
+
+        :param task: the name of the task
+        :type task: str
+        :return: whether to run the task
+        :rtype: bool
+        """
+        if task in self._critical_tasks:
+            self._count(task, "run")
+            return True
+
+        postponed = self._postponed.get(task, 0)
+        if postponed >= self._max_postponement or \
+                self.elapsed() + self._costs.get(task, 0.0) <= self._budget:
+            self._postponed[task] = 0
+            self._count(task, "run")
+            return True
+
+        self._postponed[task] = postponed + 1
+        self._count(task, "shed")
+        return False
+
+    def shed(self, task):
+        """
+        Count a task as shed, when the decision was made from outside the frame loop (e.g. using :attr:`load`).
+
+        :param task: the name of the task
+        :type task: str
+        """
+        self._count(task, "shed")
+
+    def report(self, task, duration):
+        """
+        Update the typical cost of a task.
+
+        :param task: the name of the task
+        :type task: str
+        :param duration: the time the task took, in seconds
+        :type duration: float
+        """
+        self._costs[task] = self._ewma(self._costs.get(task), duration)
+
+    def run(self, task, fun, *args, **kwargs):
+        """
+        Run ``fun(*args, **kwargs)`` if :meth:`should_run` allows it, and measure its cost.
+
+        :return: whether the task was run
+        :rtype: bool
+        """
+        if not self.should_run(task):
+            return False
+        start = time.time()
+        fun(*args, **kwargs)
+        self.report(task, time.time() - start)
+        return True
@@ -0,0 +1,167 @@
+__author__ = 'quentin'
+
+import logging
+from math import atan2, degrees, sqrt
+import cv2
+import numpy as np
+
+
+class ROIDriftCorrector(object):
+    def __init__(self, roi_builder, rois, anchors=None, period=5 * 60 * 1000, search_radius=20,
+                 min_correction=2.0, max_correction=40.0):
+        """
+        Keeps ROIs aligned with an arena that moves slightly during an experiment
+        (e.g. thermal expansion, or someone bumping the incubator).
+        Every ``period``, the anchors of the layout (e.g. the three targets) are located again, cheaply, around their last
+        position (see :meth:`~ethoscope.roi_builders.roi_builders.BaseROIBuilder.locate_anchors`).
+        The affine transformation between the anchors as they were when ROIs were built and their new positions
+        is applied to all ROIs, in place (see :meth:`~ethoscope.core.roi.ROI.align`), so the monitor keeps running.
+        Each correction is logged.
+
+        Corrections that would move ROIs by less than ``min_correction`` are ignored, so that ROIs do not jitter with
+        the noise of the localisation of anchors. Corrections that would move ROIs by more than ``max_correction``
+        (in total, since the ROIs were built) are refused, as they are more likely to be detection errors than drift.
+
+        :param roi_builder: the ROI builder that built ``rois``
+        :type roi_builder: :class:`~ethoscope.roi_builders.roi_builders.BaseROIBuilder`
+        :param rois: the ROIs to keep aligned
+        :type rois: list(:class:`~ethoscope.core.roi.ROI`)
+        :param anchors: the anchors of the layout when ``rois`` were built. ``None`` means those of ``roi_builder``
+            (see :attr:`~ethoscope.roi_builders.roi_builders.BaseROIBuilder.layout_anchors`).
+        :param period: the time between two checks, in ms
+        :type period: int
+        :param search_radius: the largest displacement of anchors between two checks, in pixels
+        :type search_radius: float
+        :param min_correction: the smallest displacement of ROIs that is corrected, in pixels
+        :type min_correction: float
+        :param max_correction: the largest displacement of ROIs, from where they were built, in pixels
+        :type max_correction: float
+        """
+        if anchors is None:
+            anchors = roi_builder.layout_anchors
+        if anchors is None:
+            raise ValueError("The ROI builder provides no anchors to align ROIs on")
+
+        self._roi_builder = roi_builder
+        self._rois = rois
+        self._reference_anchors = anchors
+        self._anchors = anchors
+        self._matrix = np.array([[1, 0, 0], [0, 1, 0]], dtype=np.float64)
+        self._period = period
+        self._search_radius = search_radius
+        self._min_correction = min_correction
+        self._max_correction = max_correction
+        self._last_t = None
+        self._n_checks = 0
+        self._n_failed = 0
+        self._n_refused = 0
+        self._n_corrections = 0
+        self._last_correction = None
+
+    def is_due(self, t):
+        """
+        :param t: the time of the current frame, in ms
+        :type t: int
+        :return: whether the alignment should be checked now. The first check is due one period after the first call.
+        :rtype: bool
+        """
+        if self._last_t is None:
+            self._last_t = t
+        return t - self._last_t >= self._period
+
+    def _displacement(self, matrix_a, matrix_b):
+        # the largest distance between the images of the vertices of ROIs, as built, by two transformations
+        vertices = np.concatenate([r.reference_polygon.reshape(-1, 1, 2) for r in self._rois]).astype(np.float64)
+        diff = cv2.transform(vertices, matrix_a) - cv2.transform(vertices, matrix_b)
+        return float(np.sqrt(np.max(np.sum(diff ** 2, axis=2))))
+
+    def _fits(self, matrix, frame):
+        for r in self._rois:
+            x, y, w, h = r.aligned_rectangle(matrix)
+            if x < 0 or y < 0 or x + w > frame.shape[1] or y + h > frame.shape[0]:
+                return False
+        return True
+
+    def correct(self, t, frame):
+        """
+        Locates the anchors in a frame and, if they moved, aligns all ROIs on them.
+
+        :param t: the time of the frame, in ms
+        :type t: int
+        :param frame: the whole frame
+        :type frame: :class:`~numpy.ndarray`
+        :return: whether ROIs were moved
+        :rtype: bool
+        """
+        self._last_t = t
+        self._n_checks += 1
+        anchors = self._roi_builder.locate_anchors(frame, self._anchors, self._search_radius)
+        if anchors is None:
+            self._n_failed += 1
+            logging.warning("ROI drift correction: could not locate the anchors of the layout at t = %i ms" % t)
+            return False
+
+        matrix = self._roi_builder.anchor_transform(self._reference_anchors, anchors).astype(np.float64)
+        if self._displacement(matrix, self._matrix) < self._min_correction:
+            return False
+
+        identity = np.array([[1, 0, 0], [0, 1, 0]], dtype=np.float64)
+        if self._displacement(matrix, identity) > self._max_correction or not self._fits(matrix, frame):
+            self._n_refused += 1
+            logging.warning("ROI drift correction: refused to move ROIs by more than %.1f pixels at t = %i ms" %
+                            (self._max_correction, t))
+            return False
+
+        # the change since the last correction, for the log
+        increment = np.dot(np.vstack([matrix, [0, 0, 1]]),
+                           np.vstack([cv2.invertAffineTransform(self._matrix), [0, 0, 1]]))[0:2]
+        dx, dy = increment[:, 2]
+        angle = degrees(atan2(increment[1, 0], increment[0, 0]))
+        scale = sqrt(abs(np.linalg.det(increment[:, 0:2])))
+
+        for r in self._rois:
+            r.align(matrix)
+        self._anchors = anchors
+        self._matrix = matrix
+        self._n_corrections += 1
+        self._last_correction = {"t": t, "dx": round(dx, 2), "dy": round(dy, 2),
+                                 "angle": round(angle, 3), "scale": round(scale, 4)}
+        logging.info("ROI drift correction at t = %i ms: translation (%.2f, %.2f) px, rotation %.3f deg, scale %.4f" %
+                     (t, dx, dy, angle, scale))
+        return True
+
+    def get_state(self):
+        """
+        :return: the current alignment (the transformation applied to ROIs and the last position of the anchors),
+            so that it can be restored after a restart (see :meth:`set_state`)
+        :rtype: dict
+        """
+        return {"matrix": self._matrix.copy(),
+                "anchors": self._anchors}
+
+    def set_state(self, state):
+        """
+        Restores an alignment generated by :meth:`get_state`, and applies it to the ROIs, which must be as they were
+        built (e.g. unpickled after a restart).
+
+        :param state: the state of a drift corrector of the same layout
+        :type state: dict
+        """
+        self._matrix = np.asarray(state["matrix"], dtype=np.float64)
+        self._anchors = state["anchors"]
+        for r in self._rois:
+            r.align(self._matrix)
+
+    @property
+    def stats(self):
+        """
+        :return: the number of checks, of checks where the anchors were not found, of refused and of applied
+            corrections, and the last applied correction (time, translation, rotation and scale, relative to the
+            previous correction).
+        :rtype: dict
+        """
+        return {"checks": self._n_checks,
+                "failed": self._n_failed,
+                "refused": self._n_refused,
+                "corrections": self._n_corrections,
+                "last_correction": self._last_correction}
@@ -0,0 +1,67 @@
+__author__ = 'quentin'
+
+import cv2
+import numpy as np
+
+
+class FrameChangeDetector(object):
+    def __init__(self, change_threshold=6, scale=0.125, max_skip_duration=5 * 1000):
+        """
+        Detects whether a frame differs from the last processed one, so that static frames (e.g. at night, when all
+        animals sleep) do not need to be tracked at all.
+        Frames are downsampled (which averages out sensor noise), and compared to the downsampled version of the last
+        processed frame. A frame has changed when any pixel differs by more than ``change_threshold`` grey levels.
+        To keep background models up to date, a frame is always processed when the last processed one is older than
+        ``max_skip_duration``.
+
+        :param change_threshold: the minimal difference of grey level, in the downsampled frame, considered as a change
+        :type change_threshold: int
+        :param scale: the downsampling factor
+        :type scale: float
+        :param max_skip_duration: the maximal time without processing a frame, in ms
+        :type max_skip_duration: int
+        """
+        self._change_threshold = change_threshold
+        self._scale = scale
+        self._max_skip_duration = max_skip_duration
+        self._reference = None
+        self._last_processed_t = None
+        self._n_processed = 0
+        self._n_skipped = 0
+
+    def has_changed(self, t, frame):
+        """
+        Decide whether a frame should be processed. The decision is counted, so callers must abide by it.
+
+        :param t: the time of the frame, in ms
+        :type t: int
+        :param frame: the whole frame
+        :type frame: :class:`~numpy.ndarray`
+        :return: ``False`` if the frame is the same as the last processed one, and can be skipped.
+        :rtype: bool
+        """
+        small = cv2.resize(frame, None, fx=self._scale, fy=self._scale, interpolation=cv2.INTER_AREA)
+        if small.ndim == 3:
+            small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+
+        if self._reference is None or \
+                t - self._last_processed_t >= self._max_skip_duration or \
+                np.max(cv2.absdiff(small, self._reference)) > self._change_threshold:
+            self._reference = small
+            self._last_processed_t = t
+            self._n_processed += 1
+            return True
+
+        self._n_skipped += 1
+        return False
+
+    @property
+    def stats(self):
+        """
+        :return: the number of processed and skipped frames, and the proportion of skipped frames.
+        :rtype: dict
+        """
+        total = self._n_processed + self._n_skipped
+        return {"processed": self._n_processed,
+                "skipped": self._n_skipped,
+                "skip_rate": round(float(self._n_skipped) / total, 3) if total else 0.0}
@@ -1,14 +1,20 @@
 __author__ = 'quentin'
 
 from tracking_unit import TrackingUnit
+from roi import ROISet
+from deadline import FrameDeadlineScheduler
+from pipeline import StageQueue, StageQueueClosed, PipelineStage, BLOCK, COALESCE
 import logging
 import traceback
+import threading
+import time
 
 
 class Monitor(object):
 
     def __init__(self, camera, tracker_class,
-                 rois = None, stimulators=None,
+                 rois = None, stimulators=None, target_fps=None, checkpointer=None, rate_scheduler=None,
+                 change_detector=None, motion_model=None, drift_corrector=None,
                  *args, **kwargs  # extra arguments for the tracker objects
                  ):
         r"""
@@ -26,24 +32,59 @@ class Monitor(object):
         :type camera: :class:`~ethoscope.hardware.input.cameras.BaseCamera`
         :param tracker_class: The algorithm that will be used for tracking. It must inherit from :class:`~ethoscope.trackers.trackers.BaseTracker`
         :type tracker_class: class
-        :param rois: A list of region of interest.
-        :type rois: list(:class:`~ethoscope.core.roi.ROI`)
+        :param rois: A list of region of interest. They are packed in a :class:`~ethoscope.core.roi.ROISet`,
+            unless they already are.
+        :type rois: list(:class:`~ethoscope.core.roi.ROI`) or :class:`~ethoscope.core.roi.ROISet`
         :param stimulators: The class that will be used to analyse the position of the object and interact with the system/hardware.
         :type stimulators: list(:class:`~ethoscope.stimulators.stimulators.BaseInteractor`
+        :param target_fps: The expected frame rate. When defined, optional work (drawing, snapshots, DAM-like table) is
+            shed whenever processing a frame takes longer than ``1/target_fps``
+            (see :class:`~ethoscope.core.deadline.FrameDeadlineScheduler`). ``None`` means all work is always done.
+        :type target_fps: float
+        :param checkpointer: An object saving the state of all trackers periodically, for warm restarts.
+            ``None`` means no checkpoint is made.
+        :type checkpointer: :class:`~ethoscope.utils.checkpoint.TrackerCheckpointer`
+        :param rate_scheduler: An object deciding, for each ROI and frame, whether it should be tracked, so that
+            quiescent ROIs are tracked at a lower rate. ``None`` means all ROIs are tracked at every frame.
+        :type rate_scheduler: :class:`~ethoscope.core.rate_scheduler.AdaptiveRateScheduler`
+        :param change_detector: An object deciding whether a frame changed since the last processed one.
+            When it did not, no tracker runs and the last positions are carried forward (stimulators still run).
+            ``None`` means all frames are processed.
+        :type change_detector: :class:`~ethoscope.core.frame_change.FrameChangeDetector`
+        :param motion_model: A model of the motion of all animals, used by trackers to infer positions when animals
+            are not detected, and to predict where to search for them.
+            ``None`` means the last position is repeated when an animal is not detected.
+        :type motion_model: :class:`~ethoscope.trackers.motion_model.KalmanMotionBank`
+        :param drift_corrector: An object moving ROIs, in place, to follow small displacements of the arena.
+            It is run, as deferrable work, when it is due. ``None`` means ROIs never move.
+        :type drift_corrector: :class:`~ethoscope.core.drift_correction.ROIDriftCorrector`
         :param args: additional arguments passed to the tracking algorithm
         :param kwargs: additional keyword arguments passed to the tracking algorithm
         """
 
         self._camera = camera
+        self._tracker_class = tracker_class
         self._last_frame_idx =0
         self._force_stop = False
         self._last_positions = {}
         self._last_time_stamp = 0
         self._is_running = False
-
+        self._checkpointer = checkpointer
+        self._rate_scheduler = rate_scheduler
+        self._change_detector = change_detector
+        self._motion_model = motion_model
+        self._drift_corrector = drift_corrector
+
+        if target_fps is None:
+            self._deadline = None
+        else:
+            self._deadline = FrameDeadlineScheduler(target_fps)
 
         if rois is None:
             raise NotImplementedError("rois must exist (cannot be None)")
+        if not isinstance(rois, ROISet):
+            rois = ROISet(rois)
+        self._roi_set = rois
 
         if stimulators is None:
             self._unit_trackers = [TrackingUnit(tracker_class, r, None, *args, **kwargs) for r in rois]
@@ -53,6 +94,10 @@ class Monitor(object):
         else:
             raise ValueError("You should have one interactor per ROI")
 
+        if motion_model is not None:
+            for u in self._unit_trackers:
+                u.set_motion_model(motion_model)
+
     @property
     def last_positions(self):
         """
@@ -70,6 +115,145 @@ class Monitor(object):
         time_from_start = self._last_time_stamp / 1e3
         return time_from_start
 
+    @property
+    def time_to_first_positions(self):
+        """
+        :return: For each ROI (by index), the time, in ms, the tracker took to find the first valid position of the animal.
+            ``None`` for ROIs where no position was found yet.
+        :rtype: dict
+        """
+        return {u.roi.idx: u.time_to_first_position for u in self._unit_trackers}
+
+    @property
+    def deadline_stats(self):
+        """
+        :return: How many times each task was run and shed, when a ``target_fps`` was given. ``None`` otherwise.
+        :rtype: dict
+        """
+        if self._deadline is None:
+            return None
+        return self._deadline.stats
+
+    @property
+    def rate_stats(self):
+        """
+        :return: The tracking coverage and the CPU time saved by tracking quiescent ROIs at a lower rate,
+            when a ``rate_scheduler`` was given. ``None`` otherwise.
+        :rtype: dict
+        """
+        if self._rate_scheduler is None:
+            return None
+        return self._rate_scheduler.stats(self._last_time_stamp)
+
+    @property
+    def frame_skip_stats(self):
+        """
+        :return: The number of processed and skipped (static) frames, and the skip rate, when a ``change_detector``
+            was given. ``None`` otherwise.
+        :rtype: dict
+        """
+        if self._change_detector is None:
+            return None
+        return self._change_detector.stats
+
+    @property
+    def drift_stats(self):
+        """
+        :return: The checks and corrections of the alignment of ROIs, when a ``drift_corrector`` was given.
+            ``None`` otherwise.
+        :rtype: dict
+        """
+        if self._drift_corrector is None:
+            return None
+        return self._drift_corrector.stats
+
+    @property
+    def memory_footprint(self):
+        """
+        :return: The memory used by trackers, in bytes: per ROI (by index), in total, and shared between ROIs.
+        :rtype: dict
+        """
+        per_roi = {u.roi.idx: u.memory_footprint for u in self._unit_trackers}
+        shared = max([u.shared_memory_footprint for u in self._unit_trackers] + [0])
+        return {"per_roi": per_roi,
+                "total": sum(per_roi.values()) + shared,
+                "shared": shared}
+
+    @property
+    def is_overloaded(self):
+        """
+        :return: Whether frames take, on average, longer to process than their budget (always ``False`` without ``target_fps``).
+        :rtype: bool
+        """
+        return self._deadline is not None and self._deadline.load > 1
+
+    def shed_task(self, task):
+        """
+        Record that a deferrable task, external to the monitor (e.g. encoding an info image), was shed because of load.
+
+        :param task: the name of the task
+        :type task: str
+        """
+        if self._deadline is not None:
+            self._deadline.shed(task)
+
+    def tracker_states(self):
+        """
+        :return: The state of each tracker, by ROI index (see :meth:`~ethoscope.trackers.trackers.BaseTracker.get_state`)
+        :rtype: dict
+        """
+        return {u.roi.idx: u.get_state() for u in self._unit_trackers}
+
+    def shared_tracker_state(self):
+        """
+        :return: The state shared by all trackers, saved once for all ROIs
+            (see :meth:`~ethoscope.trackers.trackers.BaseTracker.get_shared_state`)
+        :rtype: dict
+        """
+        return self._tracker_class.get_shared_state()
+
+    def restore_tracker_states(self, states, drift_state=None, shared_state=None):
+        """
+        Restore the trackers from states generated by :meth:`~ethoscope.core.monitor.Monitor.tracker_states`.
+        This must happen before the monitor runs. Trackers without a matching, valid, state start from scratch.
+
+        :param states: the state of trackers, by ROI index
+        :type states: dict
+        :param drift_state: the alignment of ROIs when the states were saved
+            (see :meth:`~ethoscope.core.drift_correction.ROIDriftCorrector.get_state`). It is applied to the ROIs,
+            as they were built, before trackers are restored.
+        :type drift_state: dict
+        :param shared_state: the state shared by all trackers (see :meth:`shared_tracker_state`)
+        :type shared_state: dict
+        :return: The number of restored trackers
+        :rtype: int
+        """
+        if drift_state is not None:
+            if self._drift_corrector is not None:
+                self._drift_corrector.set_state(drift_state)
+            else:
+                for u in self._unit_trackers:
+                    u.roi.align(drift_state["matrix"])
+            self._roi_set.refresh()
+
+        if shared_state is not None:
+            try:
+                self._tracker_class.set_shared_state(shared_state)
+            except Exception as e:
+                logging.warning("Could not restore the state shared by trackers: %s" % str(e))
+
+        n_restored = 0
+        for u in self._unit_trackers:
+            state = states.get(u.roi.idx)
+            if state is None:
+                continue
+            try:
+                u.set_state(state)
+                n_restored += 1
+            except Exception as e:
+                logging.warning("Could not restore the tracker of ROI %i: %s" % (u.roi.idx, str(e)))
+        return n_restored
+
     @property
     def last_frame_idx(self):
         """
@@ -108,25 +292,19 @@ class Monitor(object):
                 self._last_time_stamp = t
                 self._frame_buffer = frame
 
-                for j,track_u in enumerate(self._unit_trackers):
-                    data_rows = track_u.track(t, frame)
-                    if len(data_rows) == 0:
-                        self._last_positions[track_u.roi.idx] = []
-                        continue
+                if self._deadline is not None:
+                    self._deadline.start_frame()
 
-                    abs_pos = track_u.get_last_positions(absolute=True)
-
-                    # if abs_pos is not None:
-                    self._last_positions[track_u.roi.idx] = abs_pos
-
-                    if not result_writer is None:
-                        result_writer.write(t,track_u.roi, data_rows)
-
-                if result_writer is not None:
-                    result_writer.flush(t, frame)
+                tracked = self._track_frame(t, frame)
+                self._checkpoint(t)
+                self._correct_drift(t, frame)
+                self._persist_in_budget(result_writer, t, frame, tracked)
 
                 if drawer is not None:
-                    drawer.draw(frame, self._last_positions, self._unit_trackers)
+                    if self._deadline is None:
+                        drawer.draw(frame, self._last_positions, self._unit_trackers)
+                    else:
+                        self._deadline.run("drawing", drawer.draw, frame, self._last_positions, self._unit_trackers)
                 self._last_t = t
 
         except Exception as e:
@@ -137,6 +315,225 @@ class Monitor(object):
             self._is_running = False
             logging.info("Monitor closing")
 
+    def _track_frame(self, t, frame):
+        """
+        Run all tracking units (and their stimulators) on a frame and update the last positions.
+        This is the time critical part of monitoring.
+
+        :return: The tracking units that produced data, along with the data they produced
+        :rtype: list((:class:`~ethoscope.core.tracking_unit.TrackingUnit`, list(:class:`~ethoscope.core.data_point.DataPoint`)))
+        """
+        out = []
+        if self._motion_model is not None:
+            self._motion_model.predict(t)
+        is_static = self._change_detector is not None and not self._change_detector.has_changed(t, frame)
+        crops = self._roi_set.crop_all(frame) if not is_static else [None] * len(self._unit_trackers)
+        for track_u, crop in zip(self._unit_trackers, crops):
+            if is_static:
+                data_rows = track_u.carry_forward(t)
+            elif self._rate_scheduler is None:
+                data_rows = track_u.track(t, frame, crop)
+            elif self._rate_scheduler.should_track(track_u, t, frame):
+                start = time.time()
+                data_rows = track_u.track(t, frame, crop)
+                self._rate_scheduler.report(time.time() - start)
+            else:
+                # a quiescent ROI, skipped on this frame. Its last position is kept
+                continue
+
+            if len(data_rows) == 0:
+                self._last_positions[track_u.roi.idx] = []
+                continue
+
+            abs_pos = track_u.get_last_positions(absolute=True)
+
+            # if abs_pos is not None:
+            self._last_positions[track_u.roi.idx] = abs_pos
+            out.append((track_u, data_rows))
+
+        if self._motion_model is not None:
+            self._motion_model.correct()
+        return out
+
+    def _should_run(self, task):
+        return self._deadline is None or self._deadline.should_run(task)
+
+    def _checkpoint(self, t):
+        if self._checkpointer is None or not self._checkpointer.is_due(t):
+            return
+        def save():
+            # trackers work on aligned ROIs, so the alignment is saved with them
+            drift_state = self._drift_corrector.get_state() if self._drift_corrector is not None else None
+            self._checkpointer.save(t, self.tracker_states(), drift_state, self.shared_tracker_state())
+        if self._deadline is None:
+            save()
+        else:
+            self._deadline.run("checkpoint", save)
+
+    def _correct_drift(self, t, frame):
+        # ROIs are only moved between two frames, when no tracker uses them
+        if self._drift_corrector is None or not self._drift_corrector.is_due(t):
+            return
+        def correct():
+            if self._drift_corrector.correct(t, frame):
+                self._roi_set.refresh()
+        if self._deadline is None:
+            correct()
+        else:
+            self._deadline.run("drift_correction", correct)
+
+    def _persist_in_budget(self, result_writer, t, frame, tracked):
+        # rows are always saved. Snapshots and DAM activity are deferrable, so, when they are due, they only run
+        # if they fit in the budget of the frame, and their cost is measured
+        if result_writer is None or self._deadline is None:
+            self._persist(result_writer, t, frame, tracked)
+            return
+        snapshot = result_writer.snapshot_due(t)
+        dam = result_writer.dam_due(t)
+        self._persist(result_writer, t, None, tracked, False)
+        if snapshot:
+            self._deadline.run("snapshot", result_writer.flush, t, frame, False)
+        if dam:
+            self._deadline.run("dam", result_writer.flush, t, None, True)
+
+    def _persist(self, result_writer, t, frame, tracked, dam=True):
+        if result_writer is None:
+            return
+        for track_u, data_rows in tracked:
+            result_writer.write(t, track_u.roi, data_rows)
+        result_writer.flush(t, frame, dam)
+
+
+class PipelinedMonitor(Monitor):
+    _default_stage_policies = {"acquisition": (2, BLOCK),
+                               "persistence": (64, BLOCK),
+                               "drawing": (1, COALESCE)}
+
+    def __init__(self, camera, tracker_class,
+                 rois = None, stimulators=None, target_fps=None, checkpointer=None, rate_scheduler=None,
+                 change_detector=None, motion_model=None, drift_corrector=None, stage_policies=None, *args, **kwargs):
+        r"""
+        A :class:`~ethoscope.core.monitor.Monitor` that decouples acquisition, tracking, persistence and drawing.
+        Each of these stages runs in its own thread and they are linked by bounded
+        queues (:class:`~ethoscope.core.pipeline.StageQueue`).
+        Tracking and stimulation remain together in the calling thread, so a slow database or drawer never
+        delays the feedback loop with the animals.
+        Each stage has a policy defining what happens when it falls behind ("block", "drop_oldest" or "coalesce").
+        By default, acquisition and persistence block (no frame or data is lost) whilst
+        drawing coalesces (only the latest frame is drawn).
+        Frames are only queued for persistence when the result writer takes a snapshot of them
+        (see :meth:`~ethoscope.utils.io.ResultWriter.snapshot_due`), so a long persistence queue holds few frames.
+
+        :param stage_policies: a dictionary, with the keys "acquisition", "persistence" and/or "drawing", and, as values,
+            tuples ``(maxsize, policy)`` overriding the default for the corresponding stage.
+        :type stage_policies: dict
+        :param \*args: see :class:`~ethoscope.core.monitor.Monitor`
+        :param \*\*kwargs: see :class:`~ethoscope.core.monitor.Monitor`
+        """
+        self._stage_policies = self._default_stage_policies.copy()
+        if stage_policies is not None:
+            for k, v in stage_policies.items():
+                if k not in self._stage_policies:
+                    raise ValueError("Unknown pipeline stage: '%s'" % k)
+                self._stage_policies[k] = v
+        self._queues = {}
+        super(PipelinedMonitor, self).__init__(camera, tracker_class, rois, stimulators, target_fps, checkpointer,
+                                               rate_scheduler, change_detector, motion_model, drift_corrector,
+                                               *args, **kwargs)
+
+    @property
+    def stage_stats(self):
+        """
+        :return: The statistics of the queue feeding each stage (see :meth:`~ethoscope.core.pipeline.StageQueue.stats`)
+        :rtype: dict
+        """
+        return {k: q.stats for k, q in self._queues.items()}
+
+    def _acquire(self, queue, errors):
+        try:
+            for i, (t, frame) in enumerate(self._camera):
+                if self._force_stop:
+                    break
+                # cameras may reuse the same buffer for each frame, so downstream stages need their own copy
+                if not queue.put((i, t, frame.copy())):
+                    break
+        except Exception as e:
+            errors.append(traceback.format_exc(e))
+        finally:
+            queue.close()
+
+    def run(self, result_writer = None, drawer = None):
+        """
+        Runs the monitor until the camera stops, or :meth:`~ethoscope.core.monitor.Monitor.stop` is called.
+        See :meth:`~ethoscope.core.monitor.Monitor.run`.
+        """
+        self._queues = {k: StageQueue(*v) for k, v in self._stage_policies.items()}
+        acquisition_errors = []
+        acquisition = threading.Thread(name="acquisition", target=self._acquire,
+                                       args=(self._queues["acquisition"], acquisition_errors))
+        acquisition.daemon = True
+        stages = []
+        if result_writer is not None:
+            stages.append(PipelineStage("persistence", self._queues["persistence"],
+                                        lambda t, frame, tracked, dam: self._persist(result_writer, t, frame, tracked, dam)))
+        if drawer is not None:
+            stages.append(PipelineStage("drawing", self._queues["drawing"],
+                                        lambda frame, positions: drawer.draw(frame, positions, self._unit_trackers)))
+        try:
+            logging.info("Pipelined monitor starting a run")
+            self._is_running = True
+            for s in stages:
+                s.start()
+            acquisition.start()
+
+            while True:
+                try:
+                    i, t, frame = self._queues["acquisition"].get()
+                except StageQueueClosed:
+                    break
+
+                if self._force_stop:
+                    logging.info("Monitor object stopped from external request")
+                    break
+
+                for s in stages:
+                    if s.error is not None:
+                        raise Exception("Pipeline stage '%s' failed:\n%s" % (s.name, s.error))
+
+                self._last_frame_idx = i
+                self._last_time_stamp = t
+                self._frame_buffer = frame
 
+                if self._deadline is not None:
+                    self._deadline.start_frame()
 
+                tracked = self._track_frame(t, frame)
+                self._checkpoint(t)
+                self._correct_drift(t, frame)
 
+                if result_writer is not None:
+                    # the work is done by the persistence stage, so, here, only whether it is due costs time
+                    snapshot = result_writer.snapshot_due(t) and self._should_run("snapshot")
+                    dam = result_writer.dam_due(t) and self._should_run("dam")
+                    self._queues["persistence"].put((t, frame if snapshot else None, tracked, dam))
+                if drawer is not None and self._should_run("drawing"):
+                    self._queues["drawing"].put((frame, dict(self._last_positions)))
+                self._last_t = t
+
+            if len(acquisition_errors) > 0:
+                raise Exception("Frame acquisition failed:\n%s" % acquisition_errors[0])
+
+        except Exception as e:
+            logging.error("Monitor closing with an exception: '%s'" % traceback.format_exc(e))
+            raise e
+
+        finally:
+            self._force_stop = True
+            self._queues["acquisition"].close()
+            # pending results and frames are still processed before we return
+            for s in stages:
+                s.queue.close()
+                s.join()
+            acquisition.join()
+            self._is_running = False
+            logging.info("Monitor closing")
@@ -0,0 +1,171 @@
+__author__ = 'quentin'
+
+import threading
+import logging
+import traceback
+from collections import deque
+
+
+BLOCK = "block"
+DROP_OLDEST = "drop_oldest"
+COALESCE = "coalesce"
+
+
+class StageQueueClosed(Exception):
+    """
+    Raised when getting from a :class:`~ethoscope.core.pipeline.StageQueue` that was closed and is empty.
+    """
+    pass
+
+
+class StageQueue(object):
+    _policies = {BLOCK, DROP_OLDEST, COALESCE}
+
+    def __init__(self, maxsize=2, policy=BLOCK):
+        """
+        A bounded, thread-safe, FIFO queue linking two stages of a pipeline.
+        The policy defines what happens when an item is put in a full queue (i.e. when the consumer stage falls behind):
+
+        * ``"block"``: the producer waits until the consumer has taken an item. Nothing is lost.
+        * ``"drop_oldest"``: the oldest pending item is discarded to make room for the new one.
+        * ``"coalesce"``: the newest pending item is replaced by the new one, so the consumer only sees the latest state.
+
+        :param maxsize: the maximal number of pending items
+        :type maxsize: int
+        :param policy: one of ``"block"``, ``"drop_oldest"`` or ``"coalesce"``
+        :type policy: str
+        """
+        if policy not in self._policies:
+            raise ValueError("Unknown queue policy '%s'. Should be one of %s" % (policy, str(sorted(self._policies))))
+        if maxsize < 1:
+            raise ValueError("A stage queue must be able to hold at least one item")
+
+        self._maxsize = maxsize
+        self._policy = policy
+        self._items = deque()
+        self._closed = False
+        self._cond = threading.Condition(threading.Lock())
+
+        self._n_put = 0
+        self._n_dropped = 0
+        self._n_coalesced = 0
+        self._max_depth = 0
+
+    @property
+    def policy(self):
+        return self._policy
+
+    def put(self, item):
+        """
+        Add an item to the queue, applying the queue policy if it is full.
+
+        :param item: any object
+        :return: ``False`` if the queue was closed (and the item ignored), ``True`` otherwise.
+        :rtype: bool
+        """
+        with self._cond:
+            if self._closed:
+                return False
+
+            if len(self._items) >= self._maxsize:
+                if self._policy == BLOCK:
+                    while len(self._items) >= self._maxsize and not self._closed:
+                        self._cond.wait()
+                    if self._closed:
+                        return False
+
+                elif self._policy == DROP_OLDEST:
+                    self._items.popleft()
+                    self._n_dropped += 1
+
+                else:
+                    self._items.pop()
+                    self._n_coalesced += 1
+
+            self._items.append(item)
+            self._n_put += 1
+            self._max_depth = max(self._max_depth, len(self._items))
+            self._cond.notify_all()
+            return True
+
+    def get(self):
+        """
+        Wait for, remove and return the oldest item of the queue.
+
+        :return: the oldest item
+        :raise: :class:`~ethoscope.core.pipeline.StageQueueClosed` when the queue is closed and no item is left.
+        """
+        with self._cond:
+            while len(self._items) == 0:
+                if self._closed:
+                    raise StageQueueClosed()
+                self._cond.wait()
+            item = self._items.popleft()
+            self._cond.notify_all()
+            return item
+
+    def close(self):
+        """
+        Close the queue. Pending items can still be consumed, but new items are refused and blocked producers are released.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def __len__(self):
+        with self._cond:
+            return len(self._items)
+
+    @property
+    def stats(self):
+        """
+        :return: counters describing the life of this queue: the number of accepted ("put"), dropped and coalesced items,
+            as well as the current and maximal number of pending items.
+        :rtype: dict
+        """
+        with self._cond:
+            return {"policy": self._policy,
+                    "put": self._n_put,
+                    "dropped": self._n_dropped,
+                    "coalesced": self._n_coalesced,
+                    "depth": len(self._items),
+                    "max_depth": self._max_depth}
+
+
+class PipelineStage(threading.Thread):
+    def __init__(self, name, queue, work):
+        """
+        A thread consuming the items of a :class:`~ethoscope.core.pipeline.StageQueue`.
+        Each item is a tuple of arguments passed to ``work``.
+        The stage stops when its queue is closed and drained, or when ``work`` raises an exception.
+        In the latter case, the formatted exception is available through the ``error`` attribute, and the queue is closed,
+        so that the producer does not block forever.
+
+        :param name: a name for this stage, for logging purposes
+        :type name: str
+        :param queue: the queue to consume
+        :type queue: :class:`~ethoscope.core.pipeline.StageQueue`
+        :param work: a callable run on each item
+        """
+        self._queue = queue
+        self._work = work
+        self.error = None
+        super(PipelineStage, self).__init__(name=name)
+        self.daemon = True
+
+    @property
+    def queue(self):
+        return self._queue
+
+    def run(self):
+        try:
+            while True:
+                try:
+                    item = self._queue.get()
+                except StageQueueClosed:
+                    break
+                self._work(*item)
+        except Exception as e:
+            self.error = traceback.format_exc(e)
+            logging.error("Pipeline stage '%s' stopped with an exception:\n%s" % (self.name, self.error))
+            self._queue.close()
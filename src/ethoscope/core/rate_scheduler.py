@@ -0,0 +1,125 @@
+__author__ = 'quentin'
+
+import time
+import cv2
+import numpy as np
+from ethoscope.stimulators.stimulators import DefaultStimulator
+
+
+class AdaptiveRateScheduler(object):
+    def __init__(self, quiescent_period=1000, quiescence_delay=30 * 1000, change_threshold=10, scale=0.25):
+        """
+        Gives each tracking unit its own sampling rate, according to the activity in its ROI.
+        Active ROIs are tracked at every frame. When nothing changed in a ROI for ``quiescence_delay``,
+        it becomes quiescent, and is only tracked every ``quiescent_period``.
+        Change is assessed, at every frame, by a cheap check: the maximal absolute difference between a downsampled
+        version of the ROI and the one at the last change. As soon as it exceeds ``change_threshold``,
+        the ROI is active again, and is tracked on this very frame.
+        Units that have an actual stimulator (i.e. not a :class:`~ethoscope.stimulators.stimulators.DefaultStimulator`)
+        are always tracked at every frame, so their decisions are always made on up-to-date positions.
+
+        :param quiescent_period: the time between two tracked frames, for quiescent ROIs, in ms
+        :type quiescent_period: int
+        :param quiescence_delay: how long a ROI must stay unchanged to become quiescent, in ms
+        :type quiescence_delay: int
+        :param change_threshold: the minimal difference of grey level, in the downsampled ROI, considered as a change
+        :type change_threshold: int
+        :param scale: the downsampling factor for the change check
+        :type scale: float
+        """
+        self._quiescent_period = quiescent_period
+        self._quiescence_delay = quiescence_delay
+        self._change_threshold = change_threshold
+        self._scale = scale
+        self._units = {}
+        self._tracking_cost = None
+        self._check_time = 0.0
+
+    def _unit_state(self, unit, t):
+        idx = unit.roi.idx
+        if idx not in self._units:
+            self._units[idx] = {"reference": None,
+                                "last_change": t,
+                                "last_tracked": None,
+                                "always_active": not isinstance(unit.stimulator, DefaultStimulator),
+                                "tracked": 0,
+                                "skipped": 0}
+        return self._units[idx]
+
+    def _has_changed(self, state, unit, frame):
+        sub_img, _ = unit.roi.apply(frame)
+        small = cv2.resize(sub_img, None, fx=self._scale, fy=self._scale, interpolation=cv2.INTER_AREA)
+        small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        if state["reference"] is None or np.max(cv2.absdiff(small, state["reference"])) > self._change_threshold:
+            state["reference"] = small
+            return True
+        return False
+
+    def should_track(self, unit, t, frame):
+        """
+        Decide whether to track a unit on this frame. The decision is counted, so callers must abide by it.
+
+        :param unit: a tracking unit
+        :type unit: :class:`~ethoscope.core.tracking_unit.TrackingUnit`
+        :param t: the time of the frame, in ms
+        :type t: int
+        :param frame: the whole frame
+        :type frame: :class:`~numpy.ndarray`
+        :return: whether the unit should be tracked
+        :rtype: bool
+        """
+        state = self._unit_state(unit, t)
+        if not state["always_active"]:
+            start = time.time()
+            if self._has_changed(state, unit, frame):
+                state["last_change"] = t
+            self._check_time += time.time() - start
+
+        is_active = state["always_active"] or t - state["last_change"] < self._quiescence_delay
+        if is_active or state["last_tracked"] is None or t - state["last_tracked"] >= self._quiescent_period:
+            state["last_tracked"] = t
+            state["tracked"] += 1
+            return True
+        state["skipped"] += 1
+        return False
+
+    def report(self, duration):
+        """
+        Update the typical cost of tracking one unit.
+
+        :param duration: the time tracking a unit took, in seconds
+        :type duration: float
+        """
+        if self._tracking_cost is None:
+            self._tracking_cost = duration
+        else:
+            self._tracking_cost = 0.99 * self._tracking_cost + 0.01 * duration
+
+    def is_quiescent(self, idx, t):
+        """
+        :param idx: the index of a ROI
+        :param t: the current time, in ms
+        :return: whether the ROI is currently tracked at a lower rate
+        :rtype: bool
+        """
+        state = self._units.get(idx)
+        if state is None or state["always_active"]:
+            return False
+        return t - state["last_change"] >= self._quiescence_delay
+
+    def stats(self, t):
+        """
+        :param t: the current time, in ms
+        :return: the number of quiescent ROIs, the coverage (i.e. the proportion of unit-frames that were tracked),
+            and an estimate of the tracking time saved (in seconds, and as a proportion), net of the cost of change checks.
+        :rtype: dict
+        """
+        tracked = sum(s["tracked"] for s in self._units.values())
+        skipped = sum(s["skipped"] for s in self._units.values())
+        total = tracked + skipped
+        cost = self._tracking_cost or 0.0
+        saved = skipped * cost - self._check_time
+        return {"n_quiescent": sum(1 for idx in self._units if self.is_quiescent(idx, t)),
+                "coverage": round(float(tracked) / total, 3) if total else 1.0,
+                "cpu_saved_s": round(saved, 3),
+                "cpu_saved": round(saved / (total * cost), 3) if total and cost else 0.0}
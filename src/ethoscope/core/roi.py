@@ -36,6 +36,11 @@ class ROI(object):
         cv2.drawContours(self._mask, [self._polygon], 0, 255,-1,offset=(-x,-y))
 
         self._rectangle = x,y,w,h
+        # the ROI as it was built, which `align` moves
+        self._reference_polygon = self._polygon.copy()
+        self._reference_rectangle = self._rectangle
+        # incremented whenever the content of the mask changes (see `align`)
+        self._mask_version = 0
         # todo NOW! sort rois by value. if no values, left to right/ top to bottom!
         self._idx = idx
 
@@ -63,6 +68,15 @@ class ROI(object):
         """
         return self._mask
 
+    @property
+    def mask_version(self):
+        """
+        :return: A number that changes whenever the content of the mask changes (see :meth:`align`).
+            Objects that keep values computed from the mask (e.g. trackers) compare it to rebuild them.
+        :rtype: int
+        """
+        return self._mask_version
+
     @property
     def offset(self):
         """
@@ -124,6 +138,56 @@ class ROI(object):
 
 
 
+    @property
+    def reference_polygon(self):
+        """
+        :return: the polygon defining the ROI, as it was built (i.e. before any :meth:`align`).
+        :rtype: :class:`~numpy.ndarray`
+        """
+        return self._reference_polygon
+
+    def aligned_rectangle(self, matrix):
+        """
+        :param matrix: a 2x3 affine transformation matrix
+        :type matrix: :class:`~numpy.ndarray`
+        :return: The bounding rectangle the ROI would have after ``align(matrix)``, formatted (x,y,w,h)
+        :rtype: (int,int,int,int)
+        """
+        matrix = np.asarray(matrix, dtype=np.float64)
+        x, y, w, h = self._reference_rectangle
+        centre = np.array([x + w / 2.0, y + h / 2.0])
+        dx, dy = np.round(np.dot(matrix[:, 0:2], centre) + matrix[:, 2] - centre).astype(int)
+        return x + int(dx), y + int(dy), w, h
+
+    def align(self, matrix):
+        """
+        Moves the ROI, in place, to its original polygon (i.e. as it was built) mapped by an affine transformation,
+        for instance to follow a drift of the arena.
+        The bounding rectangle keeps its size and follows the centre of the polygon, and the mask is redrawn,
+        in the same array. Therefore, trackers can keep working on the ROI, but must rebuild what they computed
+        from the mask (see :attr:`mask_version`).
+
+        :param matrix: a 2x3 affine transformation matrix. The identity restores the original ROI.
+        :type matrix: :class:`~numpy.ndarray`
+        """
+        x, y, w, h = self.aligned_rectangle(matrix)
+        polygon = cv2.transform(self._reference_polygon.astype(np.float64), np.asarray(matrix, dtype=np.float64))
+        self._polygon = np.round(polygon).astype(self._reference_polygon.dtype)
+        self._mask.fill(0)
+        cv2.drawContours(self._mask, [self._polygon.astype(np.int32)], 0, 255, -1, offset=(-x, -y))
+        self._rectangle = x, y, w, h
+        self._mask_version += 1
+
+    def share_mask(self, buffer):
+        """
+        Move the mask into a preallocated array (e.g. a view in a buffer shared by several ROIs).
+
+        :param buffer: an array with the shape of the mask. Its content is overwritten.
+        :type buffer: :class:`~numpy.ndarray`
+        """
+        buffer[:] = self._mask
+        self._mask = buffer
+
     def set_value(self, new_val):
         """
         :param new_val: assign a nex value to a ROI
@@ -158,4 +222,99 @@ class ROI(object):
         if out.shape[0:2] != self._mask.shape:
             raise EthoscopeException("Error whilst slicing region of interest. Possibly, the region out of the image: %s" % str(self.get_feature_dict()), img )
 
-        return out, self._mask
\ No newline at end of file
+        return out, self._mask
+
+
+class ROISet(object):
+    def __init__(self, rois):
+        """
+        All the ROIs of an arena, packed for batch processing. It is built once, from the output of a ROI builder,
+        and shared by the objects that process every ROI on every frame (e.g. a :class:`~ethoscope.core.monitor.Monitor`
+        and its trackers):
+
+         * The slices that crop each ROI are precomputed, and checked against the shape of frames only when it changes,
+           rather than at each call of :meth:`~ethoscope.core.roi.ROI.apply`.
+         * The masks of all ROIs are stored in a single contiguous buffer (the ROIs use views of this buffer).
+         * The number of pixels in each mask is tabulated, for normalisations.
+
+        After ROIs have moved (see :meth:`~ethoscope.core.roi.ROI.align`), :meth:`refresh` must be called.
+
+        :param rois: the ROIs
+        :type rois: list(:class:`~ethoscope.core.roi.ROI`)
+        """
+        self._rois = list(rois)
+        sizes = [r.mask().size for r in self._rois]
+        self._mask_buffer = np.empty(sum(sizes), np.uint8)
+        offset = 0
+        for r, size in zip(self._rois, sizes):
+            r.share_mask(self._mask_buffer[offset: offset + size].reshape(r.mask().shape))
+            offset += size
+        self._slices = None
+        self._masks = None
+        self._mask_sums = None
+        self._checked_shape = None
+        self.refresh()
+
+    def refresh(self):
+        """
+        Recompute the slices and mask sums, after ROIs moved.
+        """
+        self._slices = []
+        for r in self._rois:
+            x, y, w, h = r.rectangle
+            self._slices.append((slice(y, y + h), slice(x, x + w)))
+        self._masks = [r.mask() for r in self._rois]
+        self._mask_sums = np.array([cv2.countNonZero(m) for m in self._masks], dtype=np.int64)
+        self._checked_shape = None
+
+    def __getstate__(self):
+        # the masks are packed again when unpickled
+        return {"rois": self._rois}
+
+    def __setstate__(self, state):
+        self.__init__(state["rois"])
+
+    def __len__(self):
+        return len(self._rois)
+
+    def __iter__(self):
+        return iter(self._rois)
+
+    def __getitem__(self, i):
+        return self._rois[i]
+
+    @property
+    def mask_buffer(self):
+        """
+        :return: the contiguous buffer holding the masks of all ROIs
+        :rtype: :class:`~numpy.ndarray`
+        """
+        return self._mask_buffer
+
+    @property
+    def mask_sums(self):
+        """
+        :return: the number of pixels in the mask of each ROI, in the order of the ROIs
+        :rtype: :class:`~numpy.ndarray`
+        """
+        return self._mask_sums
+
+    def _check(self, img):
+        for r, (rows, cols) in zip(self._rois, self._slices):
+            if rows.start < 0 or cols.start < 0 or rows.stop > img.shape[0] or cols.stop > img.shape[1]:
+                raise EthoscopeException("Error whilst slicing region of interest. Possibly, the region out of the image: %s" % str(r.get_feature_dict()), img)
+        self._checked_shape = img.shape[0:2]
+
+    def crop_all(self, img):
+        """
+        Cut an image where each ROI is defined.
+
+        :param img: An image. Typically either one or three channels `uint8`.
+        :type img: :class:`~numpy.ndarray`
+        :return: for each ROI, in order, a tuple containing the resulting cropped image (a view of ``img``)
+            and the associated mask (see :meth:`~ethoscope.core.roi.ROI.apply`).
+        :rtype: list((:class:`~numpy.ndarray`, :class:`~numpy.ndarray`))
+        """
+        if img.shape[0:2] != self._checked_shape:
+            self._check(img)
+        return [(img[s], m) for s, m in zip(self._slices, self._masks)]
@@ -49,6 +49,45 @@ class TrackingUnit(object):
         """
         return self._roi
 
+    @property
+    def time_to_first_position(self):
+        """
+        :return: The time, in ms, the tracker took to find the first valid position. ``None`` if not found yet.
+        :rtype: int
+        """
+        return self._tracker.time_to_first_position
+
+    @property
+    def memory_footprint(self):
+        """
+        :return: The memory, in bytes, used by the tracker of this unit (see :attr:`~ethoscope.trackers.trackers.BaseTracker.memory_footprint`)
+        :rtype: int
+        """
+        return self._tracker.memory_footprint
+
+    @property
+    def shared_memory_footprint(self):
+        return self._tracker.shared_memory_footprint
+
+    def set_motion_model(self, motion_model):
+        """
+        Make the tracker use a motion model (see :meth:`~ethoscope.trackers.trackers.BaseTracker.set_motion_model`)
+        """
+        self._tracker.set_motion_model(motion_model)
+
+    def get_state(self):
+        """
+        :return: The state of the tracker (see :meth:`~ethoscope.trackers.trackers.BaseTracker.get_state`)
+        :rtype: dict
+        """
+        return self._tracker.get_state()
+
+    def set_state(self, state):
+        """
+        Restore the state of the tracker (see :meth:`~ethoscope.trackers.trackers.BaseTracker.set_state`)
+        """
+        self._tracker.set_state(state)
+
     def get_last_positions(self,absolute=False):
         """
         The last position of the animal monitored by this `TrackingUnit`
@@ -79,7 +118,28 @@ class TrackingUnit(object):
 
 
 
-    def track(self, t, img):
+    def carry_forward(self, t):
+        """
+        Repeat the last position of the animal at time ``t``, without tracking, and run the stimulator object.
+        This is used when the frame is the same as the last tracked one.
+
+        :param t: the time stamp of the frame (in ms).
+        :type t: int
+        :return: The resulting data point
+        :rtype:  :class:`~ethoscope.core.data_point.DataPoint`
+        """
+        data_rows = self._tracker.carry_forward(t)
+
+        interact, result = self._stimulator.apply()
+        if len(data_rows) == 0:
+            return []
+
+        for dr in data_rows:
+            dr.append(interact)
+
+        return data_rows
+
+    def track(self, t, img, crop=None):
         """
         Uses the whole frame acquired, along with its time stamp to infer position of the animal.
         Also runs the stimulator object.
@@ -88,10 +148,12 @@ class TrackingUnit(object):
         :type t: int
         :param img: the entire frame to analyse
         :type img: :class:`~numpy.ndarray`
+        :param crop: the region of the ROI in ``img``, and its mask, when already cut. ``None`` means it is cut here.
+        :type crop: (:class:`~numpy.ndarray`, :class:`~numpy.ndarray`)
         :return: The resulting data point
         :rtype:  :class:`~ethoscope.core.data_point.DataPoint`
         """
-        data_rows = self._tracker.track(t,img)
+        data_rows = self._tracker.track(t, img, crop)
 
         interact, result = self._stimulator.apply()
         if len(data_rows) == 0:
@@ -22,6 +22,7 @@ class BaseCamera(object):
     capture = None
     _resolution = None
     _frame_idx = 0
+    _target_fps = None
 
     def __init__(self,drop_each=1, max_duration=None, *args, **kwargs):
         """
@@ -76,6 +77,14 @@ class BaseCamera(object):
         """
         return self._resolution
 
+    @property
+    def target_fps(self):
+        """
+        :return: The frame rate the camera tries to achieve, or ``None`` if it is not defined (e.g. for video files).
+        :rtype: float
+        """
+        return self._target_fps
+
     @property
     def width(self):
         """
@@ -403,6 +412,7 @@ class OurPiCameraAsync(BaseCamera):
             raise EthoscopeException("FPS must be an integer number")
         self._args = args
         self._kwargs = kwargs
+        self._target_fps = float(target_fps)
         self._queue = multiprocessing.Queue(maxsize=1)
         self._stop_queue = multiprocessing.JoinableQueue(maxsize=1)
         self._p = self._frame_grabber_class(target_fps,target_resolution,self._queue,self._stop_queue, *args, **kwargs)
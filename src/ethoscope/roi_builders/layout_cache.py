@@ -0,0 +1,127 @@
+__author__ = 'quentin'
+
+import os
+import time
+import logging
+import pickle
+import numpy as np
+
+
+class ROILayoutCache(object):
+    def __init__(self, path, max_drift=3.0):
+        """
+        Stores the ROIs built on a device, so that the next experiment, with the same ROI builder and options,
+        can reuse them instead of running the whole detection again.
+        Arenas rarely move, so, before being reused, a layout is only checked, cheaply, with
+        :meth:`~ethoscope.roi_builders.roi_builders.BaseROIBuilder.match_layout`.
+        When the check fails (or the builder cannot check layouts), ROIs are built as usual and the cache is updated.
+        Layouts are keyed by device, ROI builder class and options (see :meth:`key`).
+        The file is written atomically.
+
+        :param path: the file to store layouts into. Its directory is created if needed.
+        :type path: str
+        :param max_drift: the largest displacement of anchors (e.g. targets) for a layout to be reused, in pixels
+        :type max_drift: float
+        """
+        self._path = path
+        self._max_drift = max_drift
+
+    @property
+    def path(self):
+        return self._path
+
+    @staticmethod
+    def key(machine_id, roi_builder_class, roi_builder_kwargs):
+        """
+        :param machine_id: the id of the device
+        :type machine_id: str
+        :param roi_builder_class: the class of the ROI builder
+        :param roi_builder_kwargs: the arguments the ROI builder was instantiated with
+        :type roi_builder_kwargs: dict
+        :return: the key of a layout
+        :rtype: str
+        """
+        return "%s/%s/%s" % (machine_id, roi_builder_class.__name__, repr(sorted(roi_builder_kwargs.items())))
+
+    def build(self, roi_builder, input, key, n_frames=None):
+        """
+        Reuses the cached layout of ``key`` if it still matches ``input``. Otherwise, uses ``roi_builder`` to build ROIs,
+        and caches them.
+
+        :param roi_builder: the ROI builder
+        :type roi_builder: :class:`~ethoscope.roi_builders.roi_builders.BaseROIBuilder`
+        :param input: Either a camera object, or an image.
+        :type input: :class:`~ethoscope.hardware.input.camera.BaseCamera` or :class:`~numpy.ndarray`
+        :param key: the key of the layout (see :meth:`key`)
+        :type key: str
+        :param n_frames: the number of frames to build ROIs from, when a camera is used
+            (see :meth:`~ethoscope.roi_builders.roi_builders.BaseROIBuilder.build`)
+        :type n_frames: int
+        :return: list(:class:`~ethoscope.core.roi.ROI`)
+        """
+        if isinstance(input, np.ndarray):
+            img = input
+        else:
+            _, img = next(iter(input))
+
+        layout = self._load().get(key)
+        if layout is not None:
+            start = time.time()
+            if img.shape[0:2] == layout["shape"] and roi_builder.match_layout(img, layout["anchors"], self._max_drift):
+                logging.info("Reusing the ROI layout cached on %s (checked in %.3fs)" %
+                             (time.ctime(layout["time"]), time.time() - start))
+                roi_builder.layout_anchors = layout["anchors"]
+                return layout["rois"]
+            logging.info("The cached ROI layout does not match the arena anymore. Building ROIs from scratch")
+
+        rois = roi_builder.build(input, n_frames)
+        if roi_builder.layout_anchors is not None:
+            layouts = self._load()
+            layouts[key] = {"time": time.time(),
+                            "shape": img.shape[0:2],
+                            "anchors": roi_builder.layout_anchors,
+                            "rois": rois}
+            self._write(layouts)
+        return rois
+
+    def _load(self):
+        try:
+            with open(self._path, "rb") as f:
+                return pickle.load(f)
+        except IOError:
+            return {}
+        except Exception as e:
+            logging.warning("Could not load ROI layout cache %s: %s" % (self._path, str(e)))
+            return {}
+
+    def _write(self, layouts):
+        tmp_path = self._path + ".tmp"
+        try:
+            directory = os.path.dirname(self._path)
+            if directory and not os.path.exists(directory):
+                logging.warning("No cache dir detected. making one")
+                os.makedirs(directory)
+            with open(tmp_path, "wb") as f:
+                pickle.dump(layouts, f, pickle.HIGHEST_PROTOCOL)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp_path, self._path)
+        except (IOError, OSError) as e:
+            # the cache is only an optimisation
+            logging.warning("Could not save ROI layout cache %s: %s" % (self._path, str(e)))
+
+    def remove(self, key=None):
+        """
+        Forget a layout, so that ROIs are built from scratch next time.
+
+        :param key: the key of the layout. ``None`` means all layouts.
+        :type key: str
+        """
+        if key is None:
+            layouts = {}
+        else:
+            layouts = self._load()
+            if key not in layouts:
+                return
+            del layouts[key]
+        self._write(layouts)
@@ -5,39 +5,60 @@ __author__ = 'quentin'
 import numpy as np
 
 from ethoscope.utils.description import DescribedObject
+from ethoscope.utils.img_proc import StreamingMedian
 import logging
 import traceback
 
 
 class BaseROIBuilder(DescribedObject):
 
-    def __init__(self):
+    # the features of the arena the last layout was aligned on (see `layout_anchors`)
+    _layout_anchors = None
+    # the reference image is the median of this many frames (see `build`)
+    _n_reference_frames = 6
+    _reference_median_base = 9
+
+    def __init__(self, n_reference_frames=6):
         """
         Template to design ROIBuilders. Subclasses must implement a ``_rois_from_img`` method.
+
+        :param n_reference_frames: the number of frames to acquire from a camera to make the reference image
+            (see :meth:`build`)
+        :type n_reference_frames: int
         """
-        pass
+        if n_reference_frames < 1:
+            raise ValueError("The reference image needs at least one frame")
+        self._n_reference_frames = int(n_reference_frames)
 
-    def build(self, input):
+    def build(self, input, n_frames=None):
         """
         Uses an input (image or camera) to build ROIs.
-        When a camera is used, several frames are acquired and averaged to build a reference image.
+        When a camera is used, several frames are acquired and their per-pixel median is used as a reference image.
+        The median is computed as frames arrive (see :class:`~ethoscope.utils.img_proc.StreamingMedian`),
+        so that many frames can be used without holding them all in memory.
 
         :param input: Either a camera object, or an image.
         :type input: :class:`~ethoscope.hardware.input.camera.BaseCamera` or :class:`~numpy.ndarray`
+        :param n_frames: the number of frames to acquire from a camera.
+            ``None`` means the ``n_reference_frames`` the builder was created with.
+            The median is exact up to ``9`` frames, and approximate beyond.
+        :type n_frames: int
         :return: list(:class:`~ethoscope.core.roi.ROI`)
         """
+        if n_frames is None:
+            n_frames = self._n_reference_frames
 
-        accum = []
         if isinstance(input, np.ndarray):
             accum = np.copy(input)
 
         else:
+            reference = StreamingMedian(base=self._reference_median_base)
             for i, (_, frame) in enumerate(input):
-                accum.append(frame)
-                if i  >= 5:
+                reference.update(frame)
+                if i + 1 >= n_frames:
                     break
+            accum = reference.get()
 
-            accum = np.median(np.array(accum),0).astype(np.uint8)
         try:
             rois = self._rois_from_img(accum)
         except Exception as e:
@@ -60,6 +81,56 @@ class BaseROIBuilder(DescribedObject):
     def _rois_from_img(self,img):
         raise NotImplementedError
 
+    @property
+    def layout_anchors(self):
+        """
+        :return: The features of the arena (e.g. the position of targets) that the ROIs built by the last call to
+            :meth:`build` are aligned on, or ``None`` if this builder cannot check a layout (see :meth:`match_layout`).
+        """
+        return self._layout_anchors
+
+    @layout_anchors.setter
+    def layout_anchors(self, anchors):
+        # e.g. when the ROIs were not built, but reused from a previous experiment
+        self._layout_anchors = anchors
+
+    def locate_anchors(self, img, anchors, search_radius):
+        """
+        Finds, cheaply, the anchors of a layout in an image, only around their previous position.
+
+        :param img: the image to search
+        :type img: :class:`~numpy.ndarray`
+        :param anchors: the anchors of the layout, as returned by :attr:`layout_anchors`
+        :param search_radius: the largest displacement of anchors that will be searched for, in pixels
+        :type search_radius: float
+        :return: the anchors, at their new position, or ``None`` if any of them was not found
+        """
+        raise NotImplementedError
+
+    def anchor_transform(self, anchors, new_anchors):
+        """
+        :param anchors: anchors, as returned by :attr:`layout_anchors`
+        :param new_anchors: the same anchors, displaced (see :meth:`locate_anchors`)
+        :return: the 2x3 affine transformation matrix that maps ``anchors`` to ``new_anchors``
+        :rtype: :class:`~numpy.ndarray`
+        """
+        raise NotImplementedError
+
+    def match_layout(self, img, anchors, max_drift):
+        """
+        Checks, cheaply, that a layout built previously still applies to an image,
+        i.e. that its anchors have not moved.
+
+        :param img: the image to check
+        :type img: :class:`~numpy.ndarray`
+        :param anchors: the anchors of the layout, as returned by :attr:`layout_anchors`
+        :param max_drift: the largest acceptable displacement of anchors, in pixels
+        :type max_drift: float
+        :return: whether the anchors were found, all within ``max_drift`` of their previous position
+        :rtype: bool
+        """
+        raise NotImplementedError
+
     def _spatial_sorting(self, rois):
         out = []
         for i, sr in enumerate(sorted(rois, lambda  a,b: a.rectangle[0] - b.rectangle[0])):
@@ -25,6 +25,8 @@ import itertools
 class TargetGridROIBuilder(BaseROIBuilder):
 
     _adaptive_med_rad = 0.10
+    # targets are first searched for in an image downscaled by this factor
+    _coarse_factor = 2
     _expected__min_target_dist = 10 # the minimal distance between two targets, in 'target diameter'
     _n_rows = 10
     _n_cols = 2
@@ -45,10 +47,11 @@ class TargetGridROIBuilder(BaseROIBuilder):
                                     {"type": "number", "min": 0.0, "max": 1.0, "step":.001, "name": "right_margin", "description": "Same as top_margin, but for the right.","default":0.0},
                                     {"type": "number", "min": 0.0, "max": 1.0, "step":.001, "name": "left_margin", "description": "Same as top_margin, but for the left.","default":0.0},
                                     {"type": "number", "min": 0.0, "max": 1.0, "step":.001, "name": "horizontal_fill", "description": "The proportion of the grid space user by the roi, horizontally.","default":0.90},
-                                    {"type": "number", "min": 0.0, "max": 1.0, "step":.001, "name": "left_margin", "description": "Same as horizontal_margin, but vertically.","default":0.90}
+                                    {"type": "number", "min": 0.0, "max": 1.0, "step":.001, "name": "left_margin", "description": "Same as horizontal_margin, but vertically.","default":0.90},
+                                    {"type": "number", "min": 1, "max": 100, "step":1, "name": "n_reference_frames", "description": "The number of frames whose median is used to find the targets","default":6}
                                    ]}
     def __init__(self, n_rows=1, n_cols=1, top_margin=0, bottom_margin=0,
-                 left_margin=0, right_margin=0, horizontal_fill=.9, vertical_fill=.9):
+                 left_margin=0, right_margin=0, horizontal_fill=.9, vertical_fill=.9, n_reference_frames=6):
         """
         This roi builder uses three black circles drawn on the arena (targets) to align a grid layout:
 
@@ -70,6 +73,9 @@ class TargetGridROIBuilder(BaseROIBuilder):
         :type horizontal_fill: float
         :param vertical_fill: same as vertical_fill, but horizontally.
         :type vertical_fill: float
+        :param n_reference_frames: The number of frames whose median is used to find the targets.
+            More frames remove more animals, and noise, from the reference image.
+        :type n_reference_frames: int
         """
 
         self._n_rows = n_rows
@@ -87,36 +93,97 @@ class TargetGridROIBuilder(BaseROIBuilder):
         # if self._bottom_margin is None:
         #     self._bottom_margin = self._top_margin
 
-        super(TargetGridROIBuilder,self).__init__()
+        super(TargetGridROIBuilder,self).__init__(n_reference_frames)
 
-    def _find_blobs(self, im, scoring_fun):
-        grey= cv2.cvtColor(im,cv2.COLOR_BGR2GRAY)
-        rad = int(self._adaptive_med_rad * im.shape[1])
-        if rad % 2 == 0:
-            rad += 1
+    def _find_contours(self, bin):
+        if CV_VERSION == 3:
+            _, contours, h = cv2.findContours(bin, cv2.RETR_EXTERNAL, CHAIN_APPROX_SIMPLE)
+        else:
+            contours, h = cv2.findContours(bin, cv2.RETR_EXTERNAL, CHAIN_APPROX_SIMPLE)
+        return contours
 
+    def _normalised_grey(self, im):
+        grey = cv2.cvtColor(im, cv2.COLOR_BGR2GRAY)
         med = np.median(grey)
-        scale = 255/(med)
-        cv2.multiply(grey,scale,dst=grey)
-        bin = np.copy(grey)
-        score_map = np.zeros_like(bin)
-        for t in range(0, 255,5):
-            cv2.threshold(grey, t, 255,cv2.THRESH_BINARY_INV,bin)
-            if np.count_nonzero(bin) > 0.7 * im.shape[0] * im.shape[1]:
-                continue
-            if CV_VERSION == 3:
-                _, contours, h = cv2.findContours(bin,cv2.RETR_EXTERNAL,CHAIN_APPROX_SIMPLE)
+        scale = 255 / (med)
+        cv2.multiply(grey, scale, dst=grey)
+        return grey
+
+    def _blob_thresholds(self, grey):
+        # thresholds with no more than 70% of the image below them. The proportion grows with the threshold
+        cum_hist = np.cumsum(np.bincount(grey.ravel(), minlength=256))
+        return [t for t in range(0, 255, 5) if cum_hist[t] <= 0.7 * grey.size]
+
+    def _score_map(self, grey, thresholds, scoring_fun, ignore_border=False):
+        """
+        Thresholds ``grey`` at each value of ``thresholds`` and adds, to each pixel, the scores of the (dark) blobs
+        it belongs to. Consecutive thresholds that produce the same binary image are processed only once,
+        their score being counted as many times.
+
+        :param grey: a greyscale image
+        :type grey: :class:`~numpy.ndarray`
+        :param thresholds: the increasing thresholds to use
+        :type thresholds: list(int)
+        :param scoring_fun: a function of a contour, and of ``grey``, returning an integer score
+        :param ignore_border: whether to ignore blobs that touch the edge of ``grey`` (e.g. when it is a crop)
+        :type ignore_border: bool
+        :return: the score map
+        :rtype: :class:`~numpy.ndarray`
+        """
+        cum_hist = np.cumsum(np.bincount(grey.ravel(), minlength=256))
+        groups = []
+        for t in thresholds:
+            if groups and cum_hist[t] == cum_hist[groups[-1][0]]:
+                groups[-1][1] += 1
             else:
-                contours, h = cv2.findContours(bin,cv2.RETR_EXTERNAL,CHAIN_APPROX_SIMPLE)
+                groups.append([t, 1])
 
+        h, w = grey.shape
+        bin = np.empty_like(grey)
+        score_map = np.zeros_like(grey)
+        for t, n in groups:
+            if cum_hist[t] == 0:
+                continue
+            cv2.threshold(grey, t, 255, cv2.THRESH_BINARY_INV, bin)
+            contours = self._find_contours(bin)
             bin.fill(0)
             for c in contours:
-                score = scoring_fun(c, im)
-                if score >0:
-                    cv2.drawContours(bin,[c],0,score,-1)
-            cv2.add(bin, score_map,score_map)
+                if ignore_border:
+                    x, y, cw, ch = cv2.boundingRect(c)
+                    if x == 0 or y == 0 or x + cw == w or y + ch == h:
+                        continue
+                score = scoring_fun(c, grey)
+                if score > 0:
+                    cv2.drawContours(bin, [c], 0, score * n, -1)
+            cv2.add(bin, score_map, score_map)
         return score_map
 
+    def _find_blobs(self, im, scoring_fun):
+        grey = self._normalised_grey(im)
+        return self._score_map(grey, self._blob_thresholds(grey), scoring_fun)
+
+    def _select_blobs(self, score_map, n_expected):
+        """
+        Finds the lowest threshold of ``score_map`` that leaves no more than ``n_expected`` blobs.
+        The number of blobs decreases as the threshold increases, so this is a bisection
+        on the distinct values of the map.
+
+        :return: the blobs at this threshold
+        :rtype: list
+        """
+        bin = np.empty_like(score_map)
+        levels = np.unique(score_map)
+        lo, hi = 0, len(levels) - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            cv2.threshold(score_map, int(levels[mid]), 255, cv2.THRESH_BINARY, bin)
+            if len(self._find_contours(bin)) <= n_expected:
+                hi = mid
+            else:
+                lo = mid + 1
+        cv2.threshold(score_map, int(levels[lo]), 255, cv2.THRESH_BINARY, bin)
+        return self._find_contours(bin)
+
     def _make_grid(self, n_col, n_row,
               top_margin=0.0, bottom_margin=0.0,
               left_margin=0.0, right_margin=0.0,
@@ -156,25 +223,38 @@ class TargetGridROIBuilder(BaseROIBuilder):
             return 0
         return 1
 
-    def _find_target_coordinates(self, img):
-        map = self._find_blobs(img, self._score_targets)
-        bin = np.zeros_like(map)
-
-        # as soon as we have three objects, we stop
-        contours = []
-        for t in range(0, 255,1):
-            cv2.threshold(map, t, 255,cv2.THRESH_BINARY  ,bin)
-            if CV_VERSION == 3:
-                _, contours, h = cv2.findContours(bin,cv2.RETR_EXTERNAL, CHAIN_APPROX_SIMPLE)
-            else:
-                contours, h = cv2.findContours(bin, cv2.RETR_EXTERNAL, CHAIN_APPROX_SIMPLE)
-
-
-            if len(contours) <3:
-                raise EthoscopeException("There should be three targets. Only %i objects have been found" % (len(contours)), img)
-            if len(contours) == 3:
-                break
+    def _find_target_contours(self, img):
+        """
+        :param img: the image of the arena
+        :type img: :class:`~numpy.ndarray`
+        :return: the contours of the three targets, in no particular order
+        :rtype: list
+        """
+        grey = self._normalised_grey(img)
+        thresholds = self._blob_thresholds(grey)
+
+        # targets are first located on a downscaled image...
+        f = self._coarse_factor
+        small = cv2.resize(grey, None, fx=1. / f, fy=1. / f, interpolation=cv2.INTER_AREA)
+        contours = self._select_blobs(self._score_map(small, thresholds, self._score_targets), 3)
+        if len(contours) < 3:
+            raise EthoscopeException("There should be three targets. Only %i objects have been found" % (len(contours)), img)
+
+        # ... then refined, at full resolution, around each of them
+        refined = []
+        for c in contours:
+            x, y, w, h = cv2.boundingRect(c)
+            margin = max(w, h)
+            x0, y0 = max(x - margin, 0) * f, max(y - margin, 0) * f
+            crop = grey[y0: (y + h + margin) * f, x0: (x + w + margin) * f]
+            crop_contours = self._select_blobs(self._score_map(crop, thresholds, self._score_targets, True), 1)
+            if len(crop_contours) == 0:
+                raise EthoscopeException("Could not refine the position of a target", img)
+            refined.append(crop_contours[0] + np.array([x0, y0], dtype=np.int32))
+        return refined
 
+    def _find_target_coordinates(self, img):
+        contours = self._find_target_contours(img)
         target_diams = [cv2.boundingRect(c)[2] for c in contours]
 
         mean_diam = np.mean(target_diams)
@@ -214,8 +294,56 @@ class TargetGridROIBuilder(BaseROIBuilder):
         # the remaining point is a
         sorted_a = [sp for sp in src_points if not sp is sorted_b and not sp is sorted_c][0]
         sorted_src_pts = np.array([sorted_a, sorted_b, sorted_c], dtype=np.float32)
+        self._layout_anchors = {"points": sorted_src_pts, "diameter": mean_diam}
         return sorted_src_pts
 
+    def locate_anchors(self, img, anchors, search_radius):
+        """
+        Looks for each target, in a downscaled image, only around its previous position.
+
+        :param img: the image to search
+        :type img: :class:`~numpy.ndarray`
+        :param anchors: the position and diameter of the targets, as returned by :attr:`layout_anchors`
+        :type anchors: dict
+        :param search_radius: the largest displacement of targets that will be searched for, in pixels
+        :type search_radius: float
+        :return: the position and diameter of the targets, or ``None`` if any of them was not found
+        :rtype: dict
+        """
+        f = self._coarse_factor
+        small = cv2.resize(img, None, fx=1. / f, fy=1. / f, interpolation=cv2.INTER_AREA)
+        grey = self._normalised_grey(small)
+        thresholds = self._blob_thresholds(grey)
+        # the crops are large enough for a target, and its surroundings, even after moving
+        half_size = int((anchors["diameter"] + search_radius) / f) + 1
+
+        points = []
+        for x, y in anchors["points"]:
+            x0, y0 = max(int(x / f) - half_size, 0), max(int(y / f) - half_size, 0)
+            crop = grey[y0: int(y / f) + half_size + 1, x0: int(x / f) + half_size + 1]
+            contours = self._select_blobs(self._score_map(crop, thresholds, self._score_targets, True), 1)
+            if len(contours) != 1:
+                return None
+            moms = cv2.moments(contours[0])
+            if moms["m00"] == 0:
+                return None
+            # the centre of the pixel (i, j) of the downscaled image
+            points.append(((moms["m10"] / moms["m00"] + x0 + 0.5) * f - 0.5,
+                           (moms["m01"] / moms["m00"] + y0 + 0.5) * f - 0.5))
+        return {"points": np.array(points, dtype=np.float32), "diameter": anchors["diameter"]}
+
+    def anchor_transform(self, anchors, new_anchors):
+        return cv2.getAffineTransform(anchors["points"], new_anchors["points"])
+
+    def match_layout(self, img, anchors, max_drift=3.0):
+        new_anchors = self.locate_anchors(img, anchors, max_drift)
+        if new_anchors is None:
+            return False
+        for p, new_p in zip(anchors["points"], new_anchors["points"]):
+            if self._points_distance(p, new_p) > max_drift:
+                return False
+        return True
+
     def _rois_from_img(self,img):
         sorted_src_pts = self._find_target_coordinates(img)
         dst_points = np.array([(0,-1),
@@ -246,12 +374,17 @@ class TargetGridROIBuilder(BaseROIBuilder):
 class SleepMonitorWithTargetROIBuilder(TargetGridROIBuilder):
 
     _description = {"overview": "The default sleep monitor arena with ten rows of two tubes.",
-                    "arguments": []}
+                    "arguments": [
+                                    {"type": "number", "min": 1, "max": 100, "step":1, "name": "n_reference_frames", "description": "The number of frames whose median is used to find the targets","default":6}
+                                   ]}
 
-    def __init__(self):
+    def __init__(self, n_reference_frames=6):
         r"""
         Class to build ROIs for a two-columns, ten-rows for the sleep monitor
         (`see here <https://github.com/gilestrolab/ethoscope_hardware/tree/master/arenas/arena_10x2_shortTubes>`_).
+
+        :param n_reference_frames: The number of frames whose median is used to find the targets.
+        :type n_reference_frames: int
         """
         #`sleep monitor tube holder arena <todo>`_
 
@@ -262,18 +395,24 @@ class SleepMonitorWithTargetROIBuilder(TargetGridROIBuilder):
                                                                left_margin = -.033,
                                                                right_margin = -.033,
                                                                horizontal_fill = .975,
-                                                               vertical_fill= .7
+                                                               vertical_fill= .7,
+                                                               n_reference_frames=n_reference_frames
                                                                )
 
 
 
 class OlfactionAssayROIBuilder(TargetGridROIBuilder):
     _description = {"overview": "The default odor assay roi layout with ten rows of single tubes.",
-                    "arguments": []}
-    def __init__(self):
+                    "arguments": [
+                                    {"type": "number", "min": 1, "max": 100, "step":1, "name": "n_reference_frames", "description": "The number of frames whose median is used to find the targets","default":6}
+                                   ]}
+    def __init__(self, n_reference_frames=6):
         """
         Class to build ROIs for a one-column, ten-rows
         (`see here <https://github.com/gilestrolab/ethoscope_hardware/tree/master/arenas/arena_10x1_longTubes>`_)
+
+        :param n_reference_frames: The number of frames whose median is used to find the targets.
+        :type n_reference_frames: int
         """
         #`olfactory response arena <todo>`_
 
@@ -284,19 +423,25 @@ class OlfactionAssayROIBuilder(TargetGridROIBuilder):
                                                                left_margin = -.033,
                                                                right_margin = -.033,
                                                                horizontal_fill = .975,
-                                                               vertical_fill= .7
+                                                               vertical_fill= .7,
+                                                               n_reference_frames=n_reference_frames
                                                                )
 
 
 class HD12TubesRoiBuilder(TargetGridROIBuilder):
     _description = {"overview": "The default high resolution, 12 tubes (1 row) roi layout",
-                    "arguments": []}
+                    "arguments": [
+                                    {"type": "number", "min": 1, "max": 100, "step":1, "name": "n_reference_frames", "description": "The number of frames whose median is used to find the targets","default":6}
+                                   ]}
 
 
-    def __init__(self):
+    def __init__(self, n_reference_frames=6):
         r"""
         Class to build ROIs for a twelve columns, one row for the HD tracking arena
         (`see here <https://github.com/gilestrolab/ethoscope_hardware/tree/master/arenas/arena_mini_12_tubes>`_)
+
+        :param n_reference_frames: The number of frames whose median is used to find the targets.
+        :type n_reference_frames: int
         """
 
 
@@ -307,5 +452,6 @@ class HD12TubesRoiBuilder(TargetGridROIBuilder):
                                                    left_margin=0.05,
                                                    right_margin=0.05,
                                                    horizontal_fill=.7,
-                                                   vertical_fill=1.4
+                                                   vertical_fill=1.4,
+                                                   n_reference_frames=n_reference_frames
                                                    )
@@ -0,0 +1,53 @@
+"""
+Benchmark of the multi-animal assignment engine (:mod:`ethoscope.trackers.assignment`) on synthetic data.
+Animals perform correlated random walks in a ROI. We report the time per frame and the proportion of identity switches.
+
+Usage::
+
+    python bench_assignment.py
+"""
+from __future__ import print_function
+import time
+import numpy as np
+from ethoscope.trackers.assignment import MultiAnimalAssigner
+
+
+def simulate(n_animals, n_frames=500, roi_size=1000.0, speed=4.0, fps=20, seed=1):
+    rng = np.random.RandomState(seed)
+    pos = rng.uniform(0, roi_size, (n_animals, 2))
+    heading = rng.uniform(0, 2 * np.pi, n_animals)
+    for _ in range(n_frames):
+        heading += rng.normal(0, .3, n_animals)
+        step = rng.exponential(speed, n_animals)
+        pos += np.column_stack([np.cos(heading), np.sin(heading)]) * step[:, np.newaxis]
+        np.clip(pos, 0, roi_size, pos)
+        yield pos.copy()
+
+
+def run(n_animals, max_distance=25.0, fps=20):
+    assigner = MultiAnimalAssigner(max_distance)
+    dt = 1000 // fps
+    identity = None
+    switches = 0
+    elapsed = 0.0
+    n_frames = 0
+    rng = np.random.RandomState(2)
+    for i, truth in enumerate(simulate(n_animals, fps=fps)):
+        order = rng.permutation(n_animals)
+        start = time.time()
+        labels, _ = assigner.assign(truth[order], i * dt)
+        elapsed += time.time() - start
+        n_frames += 1
+        by_animal = np.empty(n_animals, np.int64)
+        by_animal[order] = labels
+        if identity is not None:
+            switches += np.count_nonzero(by_animal != identity)
+        identity = by_animal
+    return 1000.0 * elapsed / n_frames, switches / float(n_animals * n_frames)
+
+
+if __name__ == "__main__":
+    print("n_animals\tms_per_frame\tswitch_rate")
+    for n in [5, 10, 20, 50, 100, 200]:
+        ms, sw = run(n)
+        print("%i\t%.3f\t%.5f" % (n, ms, sw))
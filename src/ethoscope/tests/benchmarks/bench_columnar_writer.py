@@ -0,0 +1,66 @@
+"""
+Cost of saving results with :class:`~ethoscope.utils.io.ColumnarResultWriter`,
+against :class:`~ethoscope.utils.io.SQLiteResultWriter`: time spent in the tracking loop,
+time until all rows are on disk, size on disk, and time to read back one ROI.
+Data points are built once, so only the cost of the writers is measured.
+
+Usage::
+
+    python bench_columnar_writer.py
+"""
+from __future__ import print_function
+import os
+import sys
+import shutil
+import sqlite3
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "unittests"))
+from test_io import make_rois
+from ethoscope.core.data_point import DataPoint
+from ethoscope.core.variables import XPosVariable, YPosVariable, WidthVariable, HeightVariable, PhiVariable
+from ethoscope.utils.io import SQLiteResultWriter, ColumnarResultWriter, ColumnarResultReader
+
+
+def disk_usage(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(path) for f in files)
+
+
+def run(writer_class, path, n_rois, n_frames):
+    rois = make_rois(n_rois)
+    data = [[DataPoint([XPosVariable(i % 300), YPosVariable(r.idx), WidthVariable(10), HeightVariable(4),
+                        PhiVariable(i % 180)])] for r in rois for i in range(100)]
+    with writer_class(path, rois) as rw:
+        start = time.time()
+        for i in range(n_frames):
+            t = i * 50
+            for j, r in enumerate(rois):
+                rw.write(t, r, data[j * 100 + i % 100])
+            rw.flush(t)
+        write_time = time.time() - start
+    total_time = time.time() - start
+
+    start = time.time()
+    if writer_class is ColumnarResultWriter:
+        n = len(ColumnarResultReader(path).read(1)["x"])
+    else:
+        conn = sqlite3.connect(path)
+        n = len(conn.execute("SELECT t, x, y, w, h, phi FROM ROI_1").fetchall())
+        conn.close()
+    assert n == n_frames
+    return write_time, total_time, disk_usage(path) / 1e6, time.time() - start
+
+
+if __name__ == "__main__":
+    tmp_dir = tempfile.mkdtemp(prefix="ethoscope_bench_")
+    try:
+        print("writer\tn_rois\tn_frames\twrite_s\ttotal_s\tdisk_MB\tread_roi_s")
+        for n_rois, n_frames in [(20, 5000), (60, 5000)]:
+            for name, writer_class in [("sqlite", SQLiteResultWriter), ("columnar", ColumnarResultWriter)]:
+                path = os.path.join(tmp_dir, "%s_%i" % (name, n_rois))
+                print("%s\t%i\t%i\t%.2f\t%.2f\t%.1f\t%.4f" % ((name, n_rois, n_frames) + run(writer_class, path, n_rois, n_frames)))
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,54 @@
+"""
+Throughput of :class:`~ethoscope.trackers.frame_difference_tracker.FrameDifferenceTracker`, compared to
+:class:`~ethoscope.trackers.adaptive_bg_tracker.AdaptiveBGModel`, on the tube arena test video.
+We report the time per ROI and per frame, the frame rate that tracking all ROIs could sustain (on one core),
+and how far the positions of both trackers are from each other.
+
+Usage::
+
+    python bench_frame_difference_tracker.py
+"""
+from __future__ import print_function
+import time
+import numpy as np
+
+from ethoscope.hardware.input.cameras import MovieVirtualCamera
+from ethoscope.roi_builders.target_roi_builder import SleepMonitorWithTargetROIBuilder
+from ethoscope.trackers.adaptive_bg_tracker import AdaptiveBGModel
+from ethoscope.trackers.frame_difference_tracker import FrameDifferenceTracker
+from bench_tube_tracker import VIDEO
+
+
+def run(tracker_class, rois, frames):
+    trackers = [tracker_class(r) for r in rois]
+    positions = {}
+    elapsed = 0
+    for t, frame in frames:
+        start = time.time()
+        points = [tr.track(t, frame) for tr in trackers]
+        elapsed += time.time() - start
+        for i, p in enumerate(points):
+            if len(p) > 0 and not p[0]["is_inferred"]:
+                positions[(i, t)] = (p[0]["x"], p[0]["y"])
+    return elapsed, positions
+
+
+if __name__ == "__main__":
+    cam = MovieVirtualCamera(VIDEO, max_duration=20)
+    rois = SleepMonitorWithTargetROIBuilder().build(cam)
+    cam.restart()
+    frames = [(t, np.copy(f)) for t, f in cam]
+    print("%i ROIs, %i frames" % (len(rois), len(frames)))
+    print("tracker\tms_per_roi_frame\tmax_fps\tn_positions")
+    results = {}
+    for tracker_class in [AdaptiveBGModel, FrameDifferenceTracker]:
+        elapsed, positions = run(tracker_class, rois, frames)
+        results[tracker_class] = positions
+        print("%s\t%.3f\t%.1f\t%i" % (tracker_class.__name__, elapsed * 1000 / (len(frames) * len(rois)),
+                                      len(frames) / elapsed, len(positions)))
+
+    ref, fast = results[AdaptiveBGModel], results[FrameDifferenceTracker]
+    # once both trackers have settled
+    common = [k for k in ref if k in fast and k[1] > 5000]
+    dist = [np.hypot(ref[k][0] - fast[k][0], ref[k][1] - fast[k][1]) for k in common]
+    print("distance between trackers (px): p50 %.1f, p90 %.1f, p99 %.1f" % tuple(np.percentile(dist, [50, 90, 99])))
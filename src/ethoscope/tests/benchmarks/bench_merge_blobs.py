@@ -0,0 +1,36 @@
+"""
+Scaling benchmark of :func:`~ethoscope.utils.img_proc.merge_blobs`, against the original pairwise implementation.
+
+Usage::
+
+    python bench_merge_blobs.py
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "unittests"))
+from test_img_proc import merge_blobs_reference, random_blobs
+from ethoscope.utils.img_proc import merge_blobs
+
+
+def timeit(fun, contours, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.time()
+        fun(contours)
+        best = min(best, time.time() - start)
+    return best * 1000
+
+
+if __name__ == "__main__":
+    rng = np.random.RandomState(1)
+    print("n_blobs\treference_ms\tgrid_ms")
+    for n in [10, 100, 500, 1000, 2000, 5000, 10000]:
+        # constant blob density, as in a noisy foreground
+        size = 1000 * np.sqrt(n / 1000.0)
+        contours = random_blobs(rng, n, size)
+        ref = timeit(merge_blobs_reference, contours, 1) if n <= 2000 else float("nan")
+        print("%i\t%.1f\t%.1f" % (n, ref, timeit(merge_blobs, contours)))
@@ -0,0 +1,81 @@
+"""
+Write and backup time of the two layouts of :class:`~ethoscope.utils.io.SQLiteResultWriter`:
+one table per ROI, and a single ``POSITIONS`` table (``positions_table=True``).
+The backup is incremental, as the node does it: new rows (``id > last_id``) are fetched from the result
+database and inserted in a copy, every ``backup_every`` frames.
+That is one query per ROI table, or a single query for the positions table.
+The write time is the time spent writing rows in the tracking loop.
+
+Usage::
+
+    python bench_positions_table.py
+"""
+from __future__ import print_function
+import os
+import sys
+import shutil
+import sqlite3
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "unittests"))
+from test_io import make_rois, write_rows
+from ethoscope.utils.io import SQLiteResultWriter
+
+
+def incremental_backup(src_path, dst, tables, last_ids):
+    src = sqlite3.connect(src_path)
+    try:
+        for table in tables:
+            # with SQLite, only the id of the positions table is its rowid
+            rows = src.execute("SELECT rowid, * FROM %s WHERE rowid > ?" % table, (last_ids.get(table, 0),)).fetchall()
+            if len(rows) == 0:
+                continue
+            if table not in last_ids:
+                dst.execute("CREATE TABLE %s (%s)" % (table, ", ".join("c%i" % i for i in range(len(rows[0])))))
+            dst.executemany("INSERT INTO %s VALUES (%s)" % (table, ", ".join("?" * len(rows[0]))), rows)
+            last_ids[table] = rows[-1][0]
+        dst.commit()
+    finally:
+        src.close()
+
+
+def run(n_rois, n_frames, positions_table, backup_every=500):
+    tmp_dir = tempfile.mkdtemp(prefix="ethoscope_bench_")
+    try:
+        path = os.path.join(tmp_dir, "results.db")
+        rois = make_rois(n_rois)
+        tables = ["POSITIONS"] if positions_table else ["ROI_%i" % r.idx for r in rois]
+        dst = sqlite3.connect(os.path.join(tmp_dir, "backup.db"))
+        last_ids = {}
+        write_time, backup_time = 0, 0
+        with SQLiteResultWriter(path, rois, positions_table=positions_table) as rw:
+            for _ in range(n_frames // backup_every):
+                start = time.time()
+                write_rows(rw, rois, backup_every)
+                write_time += time.time() - start
+
+                # what is written is committed
+                for key in list(rw._insert_dict.keys()):
+                    rw._flush_rows(key)
+                while not rw._queue.empty():
+                    time.sleep(0.01)
+                time.sleep(rw._async_writer._commit_max_delay + 0.2)
+
+                start = time.time()
+                incremental_backup(path, dst, tables, last_ids)
+                backup_time += time.time() - start
+        n_rows = sum(dst.execute("SELECT COUNT(*) FROM %s" % t).fetchone()[0] for t in tables)
+        dst.close()
+        return write_time, backup_time, n_rows
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    print("n_rois\tn_frames\troi_tables_write_s\troi_tables_backup_s\tpositions_write_s\tpositions_backup_s")
+    for n_rois, n_frames in [(20, 5000), (60, 2000)]:
+        roi_tables = run(n_rois, n_frames, False)
+        positions = run(n_rois, n_frames, True)
+        assert roi_tables[2] == positions[2] == n_rois * n_frames
+        print("%i\t%i\t%.2f\t%.3f\t%.2f\t%.3f" % ((n_rois, n_frames) + roi_tables[0:2] + positions[0:2]))
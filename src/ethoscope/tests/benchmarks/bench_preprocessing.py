@@ -0,0 +1,111 @@
+"""
+Per-ROI cost of the preprocessing methods of :mod:`ethoscope.trackers.preprocessing`, on the tube arena test video,
+compared to the implementation they replaced (methods of
+:class:`~ethoscope.trackers.adaptive_bg_tracker.AdaptiveBGModel`, reproduced below).
+We also report how different the outputs are.
+
+Usage::
+
+    python bench_preprocessing.py
+"""
+from __future__ import print_function
+from collections import deque
+import time
+import cv2
+import numpy as np
+
+from ethoscope.hardware.input.cameras import MovieVirtualCamera
+from ethoscope.roi_builders.target_roi_builder import SleepMonitorWithTargetROIBuilder
+from ethoscope.trackers.preprocessing import MinimalPreprocessor, LocalContrastPreprocessor
+from bench_tube_tracker import VIDEO
+
+
+class LegacyMinimal(object):
+    def __init__(self):
+        self._object_expected_size = 0.05
+        self._buff_grey = None
+
+    def apply(self, img, mask, t, darker_fg=True):
+        blur_rad = int(self._object_expected_size * np.max(img.shape) / 2.0)
+        if blur_rad % 2 == 0:
+            blur_rad += 1
+        if self._buff_grey is None:
+            self._buff_grey = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        cv2.cvtColor(img, cv2.COLOR_BGR2GRAY, self._buff_grey)
+        cv2.GaussianBlur(self._buff_grey, (blur_rad, blur_rad), 1.2, self._buff_grey)
+        if darker_fg:
+            cv2.subtract(255, self._buff_grey, self._buff_grey)
+        mean = cv2.mean(self._buff_grey, mask)
+        scale = 128. / mean[0]
+        cv2.multiply(self._buff_grey, scale, dst=self._buff_grey)
+        cv2.bitwise_and(self._buff_grey, mask, self._buff_grey)
+        return self._buff_grey
+
+
+class LegacyLocalContrast(object):
+    def __init__(self):
+        self._object_expected_size = 0.05
+        self._smooth_mode = deque()
+        self._smooth_mode_tstamp = deque()
+        self._smooth_mode_window_dt = 30 * 1000
+        self._buff_grey = None
+
+    def apply(self, img, mask, t):
+        blur_rad = int(self._object_expected_size * np.max(img.shape) * 2.0)
+        if blur_rad % 2 == 0:
+            blur_rad += 1
+        if self._buff_grey is None:
+            self._buff_grey = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+            self._buff_grey_blurred = np.empty_like(self._buff_grey)
+            mask_conv = cv2.blur(mask, (blur_rad, blur_rad))
+            self._buff_convolved_mask = (1 / 255.0 * mask_conv.astype(np.float32))
+        cv2.cvtColor(img, cv2.COLOR_BGR2GRAY, self._buff_grey)
+        hist = cv2.calcHist([self._buff_grey], [0], None, [256], [0, 255]).ravel()
+        hist = np.convolve(hist, [1] * 3)
+        mode = np.argmax(hist)
+        self._smooth_mode.append(mode)
+        self._smooth_mode_tstamp.append(t)
+        if len(self._smooth_mode_tstamp) > 2 and self._smooth_mode_tstamp[-1] - self._smooth_mode_tstamp[0] > self._smooth_mode_window_dt:
+            self._smooth_mode.popleft()
+            self._smooth_mode_tstamp.popleft()
+        mode = np.mean(list(self._smooth_mode))
+        scale = 128. / mode
+        cv2.multiply(self._buff_grey, scale, dst=self._buff_grey)
+        cv2.bitwise_and(self._buff_grey, mask, self._buff_grey)
+        cv2.blur(self._buff_grey, (blur_rad, blur_rad), self._buff_grey_blurred)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            self._buff_grey_blurred = (self._buff_grey_blurred / self._buff_convolved_mask).astype(np.uint8)
+        cv2.absdiff(self._buff_grey, self._buff_grey_blurred, self._buff_grey)
+        cv2.bitwise_and(self._buff_grey, mask, self._buff_grey)
+        return self._buff_grey
+
+
+def run(preprocessor_class, rois, frames):
+    preprocessors = [preprocessor_class() for _ in rois]
+    sub_images = [[r.apply(frame) for r in rois] for _, frame in frames]
+    outputs = []
+    elapsed = 0
+    for (t, _), subs in zip(frames, sub_images):
+        start = time.time()
+        out = [p.apply(img, mask, t) for p, (img, mask) in zip(preprocessors, subs)]
+        elapsed += time.time() - start
+        outputs.append([o.copy() for o in out])
+    # in ms, per ROI and per frame
+    return elapsed * 1000 / (len(frames) * len(rois)), outputs
+
+
+if __name__ == "__main__":
+    cam = MovieVirtualCamera(VIDEO, max_duration=20)
+    rois = SleepMonitorWithTargetROIBuilder().build(cam)
+    cam.restart()
+    frames = [(t, np.copy(f)) for t, f in cam]
+    print("%i ROIs, %i frames" % (len(rois), len(frames)))
+    print("method\tms_legacy\tms_new\tmax_abs_diff\tprop_diff_gt_1")
+    for name, legacy, new in [("minimal", LegacyMinimal, MinimalPreprocessor),
+                              ("local_contrast", LegacyLocalContrast, LocalContrastPreprocessor)]:
+        ms_legacy, out_legacy = run(legacy, rois, frames)
+        ms_new, out_new = run(new, rois, frames)
+        diffs = [cv2.absdiff(a, b) for fa, fb in zip(out_legacy, out_new) for a, b in zip(fa, fb)]
+        max_diff = max(int(d.max()) for d in diffs)
+        prop = sum(np.count_nonzero(d > 1) for d in diffs) / float(sum(d.size for d in diffs))
+        print("%s\t%.3f\t%.3f\t%i\t%.5f" % (name, ms_legacy, ms_new, max_diff, prop))
@@ -0,0 +1,81 @@
+"""
+Throughput of :class:`~ethoscope.utils.io.SQLiteResultWriter`, with group commit and batches of parameterised rows,
+against the original writer, that builds SQL strings and whose process commits every command and polls the queue.
+``write_s`` is the time spent in the tracking loop (writing rows), ``total_s`` includes closing the writer,
+i.e. until all rows are on disk.
+
+Usage::
+
+    python bench_result_writer.py
+"""
+from __future__ import print_function
+import os
+import sys
+import shutil
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "unittests"))
+from test_io import make_rois, write_rows
+from ethoscope.utils.io import SQLiteResultWriter, AsyncSQLiteWriter
+
+
+class LegacyAsyncSQLiteWriter(AsyncSQLiteWriter):
+    def run(self):
+        db = self._get_connection()
+        while True:
+            msg = self._queue.get()
+            if msg == 'DONE':
+                break
+            command, args, seq = msg
+            self._execute(db.cursor(), command, args)
+            self._commit(db, 1, 0, seq)
+            if self._queue.empty():
+                time.sleep(.1)
+        db.close()
+
+
+class LegacySQLiteResultWriter(SQLiteResultWriter):
+    _async_writing_class = LegacyAsyncSQLiteWriter
+    _max_insert_string_len = 1000
+
+    def _add(self, t, roi, data_rows):
+        t = int(round(t))
+        roi_id = roi.idx
+        for dr in data_rows:
+            tp = (self._null, t) + tuple(dr.values())
+            if roi_id not in self._insert_dict or self._insert_dict[roi_id] == "":
+                self._insert_dict[roi_id] = 'INSERT INTO ROI_%i VALUES %s' % (roi_id, str(tp))
+            else:
+                self._insert_dict[roi_id] += ("," + str(tp))
+
+    def flush(self, t, img=None, dam=True):
+        for k, v in self._insert_dict.items():
+            if len(v) > self._max_insert_string_len:
+                self._flush_rows(k)
+
+    def _flush_rows(self, roi_id):
+        if self._insert_dict.get(roi_id):
+            self._write_async_command(self._insert_dict[roi_id])
+            self._insert_dict[roi_id] = ""
+
+
+def run(writer_class, n_rois, n_frames):
+    tmp_dir = tempfile.mkdtemp(prefix="ethoscope_bench_")
+    try:
+        rois = make_rois(n_rois)
+        with writer_class(os.path.join(tmp_dir, "results.db"), rois) as rw:
+            start = time.time()
+            write_rows(rw, rois, n_frames)
+            write_time = time.time() - start
+        return write_time, time.time() - start, rw._async_writer.counters
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    print("n_rois\tn_frames\tlegacy_write_s\tlegacy_total_s\twrite_s\ttotal_s\tcommits\tcommands")
+    for n_rois, n_frames in [(20, 1000), (20, 5000), (60, 2000)]:
+        legacy = run(LegacySQLiteResultWriter, n_rois, n_frames)
+        new = run(SQLiteResultWriter, n_rois, n_frames)
+        print("%i\t%i\t%.2f\t%.2f\t%.2f\t%.2f\t%i\t%i" % ((n_rois, n_frames) + legacy[0:2] + new[0:2] + new[2][0:2]))
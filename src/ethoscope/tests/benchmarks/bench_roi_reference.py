@@ -0,0 +1,63 @@
+"""
+Benchmark of the reference image that ROI builders compute from the first frames of a camera
+(see :meth:`~ethoscope.roi_builders.roi_builders.BaseROIBuilder.build`):
+the original stack-then-median against :class:`~ethoscope.utils.img_proc.StreamingMedian`.
+Peak memory is the growth of the resident memory of a child process, so each measurement is run in its own process.
+
+Usage::
+
+    python bench_roi_reference.py
+"""
+from __future__ import print_function
+import resource
+import time
+import multiprocessing
+import numpy as np
+
+from ethoscope.utils.img_proc import StreamingMedian
+
+
+def frames(n, shape=(960, 1280, 3)):
+    # the camera hands out the same buffer, refilled
+    rng = np.random.RandomState(1)
+    pool = [rng.randint(0, 256, shape).astype(np.uint8) for _ in range(3)]
+    for i in range(n):
+        yield pool[i % len(pool)]
+
+
+def legacy_reference(n):
+    accum = []
+    for frame in frames(n):
+        accum.append(frame.copy())
+    return np.median(np.array(accum), 0).astype(np.uint8)
+
+
+def streaming_reference(n):
+    reference = StreamingMedian(base=9)
+    for frame in frames(n):
+        reference.update(frame)
+    return reference.get()
+
+
+def _measure(fun, n, queue):
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    fun(n)
+    queue.put((time.time() - start, (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) / 1024.))
+
+
+def measure(fun, n):
+    queue = multiprocessing.Queue()
+    p = multiprocessing.Process(target=_measure, args=(fun, n, queue))
+    p.start()
+    out = queue.get()
+    p.join()
+    return out
+
+
+if __name__ == "__main__":
+    print("n_frames\tlegacy_s\tlegacy_MB\tstreaming_s\tstreaming_MB")
+    for n in [6, 20, 50, 100]:
+        legacy = measure(legacy_reference, n)
+        streaming = measure(streaming_reference, n)
+        print("%i\t%.2f\t%.0f\t%.2f\t%.0f" % ((n,) + legacy + streaming))
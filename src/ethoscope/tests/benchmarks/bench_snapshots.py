@@ -0,0 +1,92 @@
+"""
+Cost of snapshots in the tracking loop, and size of ``IMG_SNAPSHOTS``, for :class:`~ethoscope.utils.io.ImgToMySQLHelper`
+and for the legacy implementation, which wrote each snapshot to a temporary file, and read it back, in the loop.
+Frames are those of a video, upscaled to the resolution of the ethoscope (1280x960), and one snapshot is due
+every ``every`` frames. The loop time is the time spent in ``flush``, for the frames where a snapshot is due.
+
+Usage::
+
+    python bench_snapshots.py
+"""
+from __future__ import print_function
+import os
+import tempfile
+import time
+import cv2
+import numpy as np
+from ethoscope.utils.io import ImgToMySQLHelper
+
+VIDEO = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "static_files", "videos", "arena_10x2_sortTubes.mp4")
+
+
+class LegacyImgToMySQLHelper(object):
+    _table_name = "IMG_SNAPSHOTS"
+    def __init__(self, period=300.0):
+        self._period = period
+        self._last_tick = 0
+        self._tmp_file = tempfile.mktemp(prefix="ethoscope_", suffix=".jpg")
+
+    def __del__(self):
+        try:
+            os.remove(self._tmp_file)
+        except:
+            pass
+
+    def flush(self, t, img):
+        tick = int(round((t/1000.0)/self._period))
+        if tick == self._last_tick:
+            return
+        cv2.imwrite(self._tmp_file, img, [int(cv2.IMWRITE_JPEG_QUALITY), 50])
+        bstring = open(self._tmp_file, "rb").read()
+        cmd = 'INSERT INTO ' + self._table_name + '(id,t,img) VALUES(%s,%s,%s)'
+        args = (0, int(t), bstring)
+        self._last_tick = tick
+        return cmd, args
+
+    def close(self):
+        return []
+
+
+def read_frames(n_frames):
+    cap = cv2.VideoCapture(VIDEO)
+    frames = []
+    while len(frames) < n_frames:
+        ok, frame = cap.read()
+        if not ok:
+            break
+        grey = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        frames.append(cv2.resize(grey, (1280, 960)))
+    cap.release()
+    return frames
+
+
+def run(helper, frames, every, period=300.0):
+    loop_times, sizes = [], []
+    for i, frame in enumerate(frames):
+        # one snapshot is due every `every` frames
+        t = int((i // every + 1) * period * 1000 + 100 * (i % every))
+        start = time.time()
+        out = helper.flush(t, frame)
+        elapsed = time.time() - start
+        if i % every == 0:
+            loop_times.append(elapsed)
+        if isinstance(out, tuple):
+            sizes.append(len(out[1][2]))
+        elif out:
+            sizes += [len(jpeg) for _, jpeg in out]
+        # the frame rate of the tracking
+        time.sleep(0.01)
+    sizes += [len(jpeg) for _, jpeg in helper.close()]
+    return np.array(loop_times) * 1000, sizes
+
+
+if __name__ == "__main__":
+    frames = read_frames(600)
+    every = 10
+    print("n_frames = %i, one snapshot due every %i frames (every 5 min), %ix%i" %
+          ((len(frames), every) + frames[0].shape[::-1]))
+    print("helper\tmedian_loop_ms\tmax_loop_ms\tsaved\ttotal_kB\tmean_kB")
+    for name, helper in [("legacy", LegacyImgToMySQLHelper()), ("ImgToMySQLHelper", ImgToMySQLHelper())]:
+        loop_times, sizes = run(helper, frames, every)
+        print("%s\t%.2f\t%.2f\t%i\t%.0f\t%.1f" % (name, np.median(loop_times), np.max(loop_times), len(sizes),
+                                                   sum(sizes) / 1024.0, np.mean(sizes) / 1024.0 if sizes else 0))
@@ -0,0 +1,97 @@
+"""
+Write time of :class:`~ethoscope.utils.io.SQLiteResultWriter` and :class:`~ethoscope.utils.io.WALSQLiteResultWriter`,
+while a reader (e.g. a live dashboard) queries the result file every ``read_period`` seconds.
+The write time is the time from the first row to the end of the writer process (i.e. everything is committed).
+Reads that fail (e.g. ``database is locked``) are counted, and the slowest read is reported.
+
+``legacy`` is the writer with the pragmas of :class:`~ethoscope.utils.io.AsyncSQLiteWriter`
+(``journal_mode=OFF``, ``locking_mode=EXCLUSIVE``) applied on its own connection, as they were meant to be.
+``SQLiteResultWriter`` only sets them on a connection that is then closed, so its writer uses a rollback journal.
+
+Usage::
+
+    python bench_sqlite_wal.py
+"""
+from __future__ import print_function
+import os
+import sys
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "unittests"))
+from test_io import make_rois, write_rows
+from ethoscope.utils.io import SQLiteResultWriter, AsyncSQLiteWriter, WALSQLiteResultWriter
+
+
+class LegacyAsyncSQLiteWriter(AsyncSQLiteWriter):
+    def _get_connection(self):
+        db = sqlite3.connect(self._db_name)
+        for k, v in self._pragmas.items():
+            db.execute("PRAGMA %s = %s" % (str(k), str(v)))
+        return db
+
+
+class LegacySQLiteResultWriter(SQLiteResultWriter):
+    _async_writing_class = LegacyAsyncSQLiteWriter
+
+
+class Reader(threading.Thread):
+    def __init__(self, path, period):
+        super(Reader, self).__init__()
+        self._path = path
+        self._period = period
+        self._stop_event = threading.Event()
+        self.n_reads, self.n_failures, self.max_latency = 0, 0, 0
+
+    def run(self):
+        while not self._stop_event.wait(self._period):
+            start = time.time()
+            try:
+                conn = sqlite3.connect(self._path, timeout=1.0)
+                try:
+                    conn.execute("SELECT MAX(t) FROM ROI_1").fetchone()
+                finally:
+                    conn.close()
+                self.n_reads += 1
+            except sqlite3.Error:
+                self.n_failures += 1
+            self.max_latency = max(self.max_latency, time.time() - start)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+def run(result_writer_class, n_rois, n_frames, read_period=0.1):
+    tmp_dir = tempfile.mkdtemp(prefix="ethoscope_bench_")
+    try:
+        path = os.path.join(tmp_dir, "results.db")
+        rois = make_rois(n_rois)
+        with result_writer_class(path, rois) as rw:
+            reader = Reader(path, read_period)
+            reader.start()
+            start = time.time()
+            write_rows(rw, rois, n_frames)
+        write_time = time.time() - start
+        reader.stop()
+        conn = sqlite3.connect(path)
+        n_rows = sum(conn.execute("SELECT COUNT(*) FROM ROI_%i" % r.idx).fetchone()[0] for r in rois)
+        conn.close()
+        assert n_rows == n_rois * n_frames, n_rows
+        return write_time, reader.n_reads, reader.n_failures, reader.max_latency
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    print("writer\tn_rois\tn_frames\twrite_s\treads\tfailed_reads\tmax_read_latency_ms")
+    for n_rois, n_frames in [(20, 10000), (60, 5000)]:
+        for name, cls in [("legacy", LegacySQLiteResultWriter),
+                          ("SQLiteResultWriter", SQLiteResultWriter),
+                          ("WALSQLiteResultWriter", WALSQLiteResultWriter)]:
+            write_time, n_reads, n_failures, max_latency = run(cls, n_rois, n_frames)
+            print("%s\t%i\t%i\t%.2f\t%i\t%i\t%.1f" % (name, n_rois, n_frames, write_time, n_reads, n_failures,
+                                                      max_latency * 1000))
@@ -0,0 +1,70 @@
+"""
+Time taken by :class:`~ethoscope.roi_builders.target_roi_builder.TargetGridROIBuilder` to find the three targets,
+on the test images, compared to the exhaustive threshold sweeps it replaced (reproduced below).
+We also report how far the targets, and the vertices of the resulting ROIs, moved.
+
+Usage::
+
+    python bench_target_roi_builder.py
+"""
+from __future__ import print_function
+import os
+import time
+import cv2
+import numpy as np
+
+from ethoscope.roi_builders.target_roi_builder import SleepMonitorWithTargetROIBuilder
+
+IMG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "static_files", "img")
+
+
+class LegacyTargetROIBuilder(SleepMonitorWithTargetROIBuilder):
+    def _find_blobs(self, im, scoring_fun):
+        grey = cv2.cvtColor(im, cv2.COLOR_BGR2GRAY)
+        med = np.median(grey)
+        scale = 255 / (med)
+        cv2.multiply(grey, scale, dst=grey)
+        bin = np.copy(grey)
+        score_map = np.zeros_like(bin)
+        for t in range(0, 255, 5):
+            cv2.threshold(grey, t, 255, cv2.THRESH_BINARY_INV, bin)
+            if np.count_nonzero(bin) > 0.7 * im.shape[0] * im.shape[1]:
+                continue
+            contours = self._find_contours(bin)
+            bin.fill(0)
+            for c in contours:
+                score = scoring_fun(c, im)
+                if score > 0:
+                    cv2.drawContours(bin, [c], 0, score, -1)
+            cv2.add(bin, score_map, score_map)
+        return score_map
+
+    def _find_target_contours(self, img):
+        map = self._find_blobs(img, self._score_targets)
+        bin = np.zeros_like(map)
+        for t in range(0, 255, 1):
+            cv2.threshold(map, t, 255, cv2.THRESH_BINARY, bin)
+            contours = self._find_contours(bin)
+            if len(contours) <= 3:
+                return contours
+
+
+def run(builder, img, n_repeats=5):
+    start = time.time()
+    for _ in range(n_repeats):
+        points = builder._find_target_coordinates(img.copy())
+    return (time.time() - start) * 1000 / n_repeats, points
+
+
+if __name__ == "__main__":
+    legacy, new = LegacyTargetROIBuilder(), SleepMonitorWithTargetROIBuilder()
+    print("image\tms_legacy\tms_new\tmax_target_shift_px\tmax_roi_vertex_shift_px")
+    for name in sorted(os.listdir(IMG_DIR)):
+        img = cv2.imread(os.path.join(IMG_DIR, name))
+        ms_legacy, pts_legacy = run(legacy, img)
+        ms_new, pts_new = run(new, img)
+        target_shift = np.max(np.abs(pts_new - pts_legacy))
+        rois_legacy = legacy.build(img.copy())
+        rois_new = new.build(img.copy())
+        roi_shift = max(np.max(np.abs(a.polygon - b.polygon)) for a, b in zip(rois_legacy, rois_new))
+        print("%s\t%.1f\t%.1f\t%.2f\t%i" % (name, ms_legacy, ms_new, target_shift, roi_shift))
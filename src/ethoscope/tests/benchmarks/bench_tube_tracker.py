@@ -0,0 +1,44 @@
+"""
+Per-ROI cost of :class:`~ethoscope.trackers.tube_tracker.TubeProjectionTracker`, compared to
+:class:`~ethoscope.trackers.adaptive_bg_tracker.AdaptiveBGModel`, on the tube arena test video.
+
+Usage::
+
+    python bench_tube_tracker.py
+"""
+from __future__ import print_function
+import os
+import time
+import numpy as np
+
+from ethoscope.hardware.input.cameras import MovieVirtualCamera
+from ethoscope.roi_builders.target_roi_builder import SleepMonitorWithTargetROIBuilder
+from ethoscope.trackers.adaptive_bg_tracker import AdaptiveBGModel
+from ethoscope.trackers.tube_tracker import TubeProjectionTracker
+
+VIDEO = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "static_files", "videos", "arena_10x2_sortTubes.mp4")
+
+
+def time_tracker(tracker_class, rois, frames):
+    trackers = [tracker_class(r) for r in rois]
+    elapsed = 0
+    n_found = 0
+    for t, frame in frames:
+        start = time.time()
+        for tr in trackers:
+            n_found += len(tr.track(t, frame)) > 0
+        elapsed += time.time() - start
+    # in ms, per ROI and per frame
+    return elapsed * 1000 / (len(frames) * len(rois)), n_found
+
+
+if __name__ == "__main__":
+    cam = MovieVirtualCamera(VIDEO, max_duration=20)
+    rois = SleepMonitorWithTargetROIBuilder().build(cam)
+    cam.restart()
+    frames = [(t, np.copy(f)) for t, f in cam]
+    print("%i ROIs, %i frames" % (len(rois), len(frames)))
+    print("tracker\tms_per_roi_frame\tn_positions")
+    for tracker_class in [AdaptiveBGModel, TubeProjectionTracker]:
+        ms, n = time_tracker(tracker_class, rois, frames)
+        print("%s\t%.3f\t%i" % (tracker_class.__name__, ms, n))
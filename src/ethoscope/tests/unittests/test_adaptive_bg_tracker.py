@@ -0,0 +1,105 @@
+__author__ = 'quentin'
+
+import unittest
+from math import sqrt
+import cv2
+import numpy as np
+from ethoscope.core.roi import ROI
+from ethoscope.core.monitor import Monitor
+from ethoscope.trackers.adaptive_bg_tracker import AdaptiveBGModel, BackgroundModel, ObjectModel
+
+
+class FakeCamera(object):
+    def __init__(self, frames):
+        self._frames = frames
+
+    def __iter__(self):
+        return iter(self._frames)
+
+
+def make_frames(n, speed=20):
+    # a dark animal walking along a noisy, bright, tube, one frame every 100 ms
+    rng = np.random.RandomState(1)
+    out = []
+    for i in range(n):
+        img = np.full((41, 401, 3), 200, np.uint8)
+        cv2.ellipse(img, ((30 + (speed * i) % 340, 20), (16, 7), 0), (40, 40, 40), -1)
+        img = cv2.add(img, rng.randint(0, 6, img.shape).astype(np.uint8))
+        out.append((i * 100, img))
+    return out
+
+
+class TestBackgroundBootstrap(unittest.TestCase):
+
+    def _grey(self, frames):
+        return [cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) for _, img in frames]
+
+    def test_median_of_burst(self):
+        frames = self._grey(make_frames(7))
+        model = BackgroundModel(n_bootstrap_frames=7)
+        for i, img in enumerate(frames[:6]):
+            model.update(img, i * 100)
+            # no background until the burst is complete
+            self.assertTrue(model.is_bootstrapping)
+            self.assertIsNone(model.bg_img)
+        model.update(frames[6], 600)
+        self.assertFalse(model.is_bootstrapping)
+        self.assertEqual(model.last_t, 600)
+        np.testing.assert_array_equal(model.bg_img, np.median(frames, 0).astype(np.uint8))
+        # the animal moved, so it is not in the background
+        self.assertGreater(model.get_bg_uint8().min(), 150)
+
+    def test_seeded_learning_rate(self):
+        model = BackgroundModel(max_half_life=100. * 1000, min_half_life=1. * 1000, n_bootstrap_frames=3)
+        self.assertEqual(model.get_state()["current_half_life"], 1000.)
+        for i, img in enumerate(self._grey(make_frames(3))):
+            model.update(img, i * 100)
+        # the geometric mean of the minimal and maximal half lives, rather than the fastest rate
+        self.assertAlmostEqual(model.get_state()["current_half_life"], sqrt(1000. * 100000.))
+
+    def test_no_bootstrap(self):
+        frames = self._grey(make_frames(2))
+        model = BackgroundModel(n_bootstrap_frames=1)
+        self.assertFalse(model.is_bootstrapping)
+        model.update(frames[0], 0)
+        # the first frame is the background, and learning starts at the fastest rate
+        np.testing.assert_array_equal(model.bg_img, frames[0])
+        self.assertEqual(model.get_state()["current_half_life"], 1000.)
+
+    def test_restored_state_ends_bootstrap(self):
+        frames = self._grey(make_frames(7))
+        model = BackgroundModel()
+        for i, img in enumerate(frames):
+            model.update(img, i * 100)
+        restored = BackgroundModel()
+        restored.set_state(model.get_state())
+        self.assertFalse(restored.is_bootstrapping)
+        restored.update(frames[0], 700)
+        self.assertIsNotNone(restored.bg_img)
+
+
+class TestTimeToFirstPosition(unittest.TestCase):
+    def setUp(self):
+        # the model of the animal is shared by all trackers, so other tests must not affect it
+        self._fg_model = AdaptiveBGModel.fg_model
+        AdaptiveBGModel.fg_model = ObjectModel()
+        self._rois = [ROI(np.array([(0, 0), (400, 0), (400, 40), (0, 40)]), 1),
+                      ROI(np.array([(0, 0), (400, 0), (400, 40), (0, 40)]), 2)]
+
+    def tearDown(self):
+        AdaptiveBGModel.fg_model = self._fg_model
+
+    def test_found_after_burst(self):
+        monitor = Monitor(FakeCamera(make_frames(20)), AdaptiveBGModel, self._rois)
+        self.assertEqual(monitor.time_to_first_positions, {1: None, 2: None})
+        monitor.run()
+        ttfp = monitor.time_to_first_positions
+        # the background is ready after 7 frames, i.e. at 600 ms, and the animal is found on the next frame
+        self.assertEqual(ttfp, {1: 700, 2: 700})
+
+    def test_not_found(self):
+        # an empty tube: no position, ever
+        frames = [(t, np.full_like(img, 200)) for t, img in make_frames(20)]
+        monitor = Monitor(FakeCamera(frames), AdaptiveBGModel, self._rois)
+        monitor.run()
+        self.assertEqual(monitor.time_to_first_positions, {1: None, 2: None})
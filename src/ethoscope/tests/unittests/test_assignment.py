@@ -0,0 +1,53 @@
+__author__ = 'quentin'
+
+import unittest
+import numpy as np
+from ethoscope.trackers.assignment import MultiAnimalAssigner, optimal_assignment, _hungarian
+
+
+class TestAssignment(unittest.TestCase):
+
+    def test_hungarian(self):
+        rng = np.random.RandomState(1)
+        for shape in [(5, 5), (3, 6), (6, 3)]:
+            cost = rng.uniform(0, 10, shape)
+            r1, c1 = _hungarian(cost)
+            r2, c2 = optimal_assignment(cost)
+            self.assertAlmostEqual(cost[r1, c1].sum(), cost[r2, c2].sum())
+            self.assertEqual(len(r1), min(shape))
+
+    def test_identities_are_stable(self):
+        rng = np.random.RandomState(2)
+        n = 30
+        # animals on a grid, each moving a little, in a shuffled order every frame
+        truth = np.array([(x, y) for x in range(0, 600, 100) for y in range(0, 500, 100)], np.float64)
+        assigner = MultiAnimalAssigner(max_distance=30)
+        identity = None
+        for t in range(0, 5000, 50):
+            truth += rng.normal(0, 3, truth.shape)
+            order = rng.permutation(n)
+            labels, dists = assigner.assign(truth[order], t)
+            by_animal = np.empty(n, np.int64)
+            by_animal[order] = labels
+            if identity is None:
+                identity = by_animal
+                self.assertEqual(sorted(identity.tolist()), range(n))
+                self.assertTrue(np.all(dists == 0))
+            else:
+                self.assertTrue(np.all(by_animal == identity))
+                self.assertTrue(np.all(dists < 30))
+
+    def test_birth_and_death(self):
+        assigner = MultiAnimalAssigner(max_distance=10, max_unmatched_duration=1000)
+        labels, _ = assigner.assign([(0, 0), (100, 100)], 0)
+        self.assertEqual(labels.tolist(), [0, 1])
+        # the first animal disappears for a while
+        labels, _ = assigner.assign([(101, 101)], 500)
+        self.assertEqual(labels.tolist(), [1])
+        self.assertEqual(assigner.n_tracks, 2)
+        labels, _ = assigner.assign([(102, 102)], 2000)
+        self.assertEqual(labels.tolist(), [1])
+        self.assertEqual(assigner.n_tracks, 1)
+        # a new animal gets the freed label
+        labels, _ = assigner.assign([(102, 102), (300, 300)], 2050)
+        self.assertEqual(labels.tolist(), [1, 0])
@@ -0,0 +1,108 @@
+__author__ = 'quentin'
+
+import os
+import shutil
+import tempfile
+import unittest
+import cv2
+import numpy as np
+from ethoscope.core.roi import ROI
+from ethoscope.core.monitor import Monitor
+from ethoscope.trackers.adaptive_bg_tracker import AdaptiveBGModel, ObjectModel
+from ethoscope.trackers.tube_tracker import TubeProjectionTracker
+from ethoscope.utils.checkpoint import TrackerCheckpointer
+
+
+class FakeCamera(object):
+    def __init__(self, frames):
+        self._frames = frames
+
+    def __iter__(self):
+        return iter(self._frames)
+
+
+def make_frames(start, n):
+    rng = np.random.RandomState(start)
+    out = []
+    for i in range(start, start + n):
+        img = np.full((41, 401, 3), 200, np.uint8)
+        cv2.ellipse(img, ((50 + (3 * i) % 300, 20), (16, 7), 0), (40, 40, 40), -1)
+        img = cv2.add(img, rng.randint(0, 6, img.shape).astype(np.uint8))
+        out.append((i * 100, img))
+    return out
+
+
+class TestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp(prefix="ethoscope_test_")
+        self._rois = [ROI(np.array([(0, 0), (400, 0), (400, 40), (0, 40)]), 1)]
+        # the model of the animal is shared by all trackers, so other tests must not affect it
+        self._fg_model = AdaptiveBGModel.fg_model
+        AdaptiveBGModel.fg_model = ObjectModel()
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+        AdaptiveBGModel.fg_model = self._fg_model
+
+    def _warm_restart(self, tracker_class):
+        checkpointer = TrackerCheckpointer(os.path.join(self._dir, "cache", "checkpoint.pkl"), period=1000)
+        monitor = Monitor(FakeCamera(make_frames(0, 60)), tracker_class, self._rois, checkpointer=checkpointer)
+        monitor.run()
+        self.assertTrue(os.path.exists(checkpointer.path))
+
+        # after a restart, frames (and time) continue
+        frames = make_frames(80, 5)
+        cold = Monitor(FakeCamera(frames), tracker_class, self._rois)
+        cold.run()
+        warm = Monitor(FakeCamera(frames), tracker_class, self._rois)
+        self.assertEqual(warm.restore_tracker_states(TrackerCheckpointer(checkpointer.path).load()), 1)
+        warm.run()
+
+        # a cold tracker needs to build its background first, a warm one does not
+        self.assertIsNone(cold.time_to_first_positions[1])
+        self.assertEqual(warm.last_positions[1][0]["is_inferred"], 0)
+
+    def test_adaptive_bg_model(self):
+        self._warm_restart(AdaptiveBGModel)
+
+    def test_tube_tracker(self):
+        self._warm_restart(TubeProjectionTracker)
+
+    def test_unusable_checkpoint(self):
+        path = os.path.join(self._dir, "checkpoint.pkl")
+        checkpointer = TrackerCheckpointer(path)
+        self.assertIsNone(checkpointer.load())
+        with open(path, "w") as f:
+            f.write("truncated")
+        self.assertIsNone(checkpointer.load())
+        checkpointer.remove()
+        self.assertFalse(os.path.exists(path))
+
+    def test_state_of_other_roi(self):
+        states = Monitor(FakeCamera([]), AdaptiveBGModel, self._rois).tracker_states()
+        other = [ROI(np.array([(0, 0), (200, 0), (200, 40), (0, 40)]), 1)]
+        self.assertEqual(Monitor(FakeCamera([]), AdaptiveBGModel, other).restore_tracker_states(states), 0)
+
+    def test_shared_state(self):
+        rois = [ROI(np.array([(0, 0), (400, 0), (400, 40), (0, 40)]), 1),
+                ROI(np.array([(0, 0), (400, 0), (400, 40), (0, 40)]), 2)]
+        checkpointer = TrackerCheckpointer(os.path.join(self._dir, "checkpoint.pkl"), period=1000)
+        monitor = Monitor(FakeCamera(make_frames(0, 60)), AdaptiveBGModel, rois, checkpointer=checkpointer)
+        monitor.run()
+        saved = AdaptiveBGModel.fg_model.get_state()
+        self.assertGreater(saved["ring_buff_idx"], 0)
+
+        # the model of the animal is saved once, not with each ROI
+        checkpointer = TrackerCheckpointer(checkpointer.path)
+        states = checkpointer.load()
+        for state in states.values():
+            self.assertNotIn("fg_model", state)
+        self.assertIsNotNone(checkpointer.shared_state)
+
+        # after a restart, the model is restored, whatever the number of ROIs
+        AdaptiveBGModel.fg_model = ObjectModel()
+        warm = Monitor(FakeCamera([]), AdaptiveBGModel, rois)
+        self.assertEqual(warm.restore_tracker_states(states, shared_state=checkpointer.shared_state), 2)
+        restored = AdaptiveBGModel.fg_model.get_state()
+        self.assertEqual(restored["ring_buff_idx"], checkpointer.shared_state["fg_model"]["ring_buff_idx"])
+        np.testing.assert_array_equal(restored["ring_buff"], checkpointer.shared_state["fg_model"]["ring_buff"])
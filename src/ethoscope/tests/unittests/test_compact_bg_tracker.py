@@ -0,0 +1,84 @@
+__author__ = 'quentin'
+
+import unittest
+from collections import deque
+import cv2
+import numpy as np
+from ethoscope.core.roi import ROI
+from ethoscope.trackers.adaptive_bg_tracker import AdaptiveBGModel, BackgroundModel
+from ethoscope.trackers.compact_bg_tracker import BufferPool, CompactBackgroundModel, CompactAdaptiveBGModel
+from ethoscope.trackers.trackers import _owned_nbytes
+
+
+class TestCompactBackground(unittest.TestCase):
+
+    def test_pool(self):
+        pool = BufferPool()
+        a = pool.get("a", (10, 20), np.uint8)
+        b = pool.get("a", (5, 5), np.float32)
+        self.assertEqual(b.shape, (5, 5))
+        # the same memory is reused
+        self.assertEqual(pool.nbytes, 200)
+        pool.get("a", (30, 20), np.uint8)
+        self.assertEqual(pool.nbytes, 600)
+
+    def test_same_as_float_model(self):
+        rng = np.random.RandomState(1)
+        models = [BackgroundModel(n_bootstrap_frames=1), CompactBackgroundModel(BufferPool(), n_bootstrap_frames=1)]
+        img = rng.randint(50, 200, (40, 100)).astype(np.uint8)
+        fg = np.zeros_like(img)
+        fg[10:20, 10:20] = 255
+        for m in models:
+            m.update(img, 0)
+        for i in range(1, 500):
+            # slow illumination drift, with the foreground excluded from learning
+            frame = cv2.add(img, i // 50)
+            for m in models:
+                m.update(frame, i * 100, np.copy(fg))
+        ref = models[0].bg_img
+        compact = models[1].bg_img / 256.
+        self.assertLess(np.max(np.abs(ref - compact)), 0.1)
+        # foreground pixels were never learnt
+        np.testing.assert_array_equal(models[1].get_bg_uint8()[13:17, 13:17], img[13:17, 13:17])
+
+    def test_tracker(self):
+        roi = ROI(np.array([(0, 0), (400, 0), (400, 40), (0, 40)]), 1)
+        trackers = [AdaptiveBGModel(roi), CompactAdaptiveBGModel(roi)]
+        for tr in trackers:
+            # measured at every frame, so that it is not the one of the background bootstrap
+            tr._footprint_period = 0
+        rng = np.random.RandomState(2)
+        for i in range(100):
+            img = np.full((41, 401, 3), 200, np.uint8)
+            cv2.ellipse(img, ((50 + 3 * i, 20), (16, 7), 0), (40, 40, 40), -1)
+            img = cv2.add(img, rng.randint(0, 6, img.shape).astype(np.uint8))
+            ref, compact = [tr.track(i * 100, img) for tr in trackers]
+            self.assertEqual(len(ref), len(compact))
+            if len(ref) > 0:
+                self.assertLessEqual(abs(ref[0]["x"] - compact[0]["x"]), 1)
+                self.assertLessEqual(abs(ref[0]["y"] - compact[0]["y"]), 1)
+        self.assertLess(trackers[1].memory_footprint * 5, trackers[0].memory_footprint)
+        self.assertGreater(trackers[1].shared_memory_footprint, 0)
+
+    def test_footprint_measured_by_tracking(self):
+        roi = ROI(np.array([(0, 0), (400, 0), (400, 40), (0, 40)]), 1)
+        tracker = CompactAdaptiveBGModel(roi)
+        self.assertEqual(tracker.memory_footprint, 0)
+        n_measures = [0]
+        owned_memory = tracker._owned_memory
+
+        def counting_owned_memory():
+            n_measures[0] += 1
+            return owned_memory()
+        tracker._owned_memory = counting_owned_memory
+
+        img = np.full((41, 401, 3), 200, np.uint8)
+        for i in range(50):
+            tracker.track(i * 100, img)
+        # once after the first frame, then every `_footprint_period`
+        self.assertEqual(n_measures[0], 1)
+        self.assertGreater(tracker.memory_footprint, 0)
+        tracker.track(tracker._footprint_period, img)
+        self.assertEqual(n_measures[0], 2)
+        # histories are not walked
+        self.assertEqual(_owned_nbytes(deque([np.zeros(100)]), set()), 0)
@@ -0,0 +1,36 @@
+__author__ = 'quentin'
+
+import unittest
+from ethoscope.core.monitor import Monitor, PipelinedMonitor
+from ethoscope.core.rate_scheduler import AdaptiveRateScheduler
+from ethoscope.core.frame_change import FrameChangeDetector
+from ethoscope.trackers.motion_model import KalmanMotionBank
+from ethoscope.web_utils.control_thread import ControlThread, MonitorOptions
+
+
+class TestMonitorOptions(unittest.TestCase):
+
+    def test_defaults(self):
+        self.assertEqual(MonitorOptions().monitor_kwargs, {})
+        # offered to users
+        self.assertIn("monitor_options", ControlThread.user_options())
+
+    def test_adaptive_rate(self):
+        # the web interface may send numbers as strings
+        self.assertEqual(MonitorOptions(adaptive_rate="0").monitor_kwargs, {})
+        kwargs = MonitorOptions(adaptive_rate=1).monitor_kwargs
+        self.assertIsInstance(kwargs["rate_scheduler"], AdaptiveRateScheduler)
+
+    def test_skip_static_frames(self):
+        kwargs = MonitorOptions(skip_static_frames=1).monitor_kwargs
+        self.assertEqual(list(kwargs.keys()), ["change_detector"])
+        self.assertIsInstance(kwargs["change_detector"], FrameChangeDetector)
+
+    def test_motion_model(self):
+        kwargs = MonitorOptions(motion_model=1).monitor_kwargs
+        self.assertEqual(list(kwargs.keys()), ["motion_model"])
+        self.assertIsInstance(kwargs["motion_model"], KalmanMotionBank)
+
+    def test_pipelined(self):
+        self.assertIs(MonitorOptions().monitor_class, Monitor)
+        self.assertIs(MonitorOptions(pipelined=1).monitor_class, PipelinedMonitor)
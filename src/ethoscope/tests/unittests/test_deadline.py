@@ -0,0 +1,79 @@
+__author__ = 'quentin'
+
+import time
+import unittest
+import numpy as np
+from ethoscope.core.deadline import FrameDeadlineScheduler
+from ethoscope.core.monitor import Monitor
+from ethoscope.core.roi import ROI
+from ethoscope.trackers.tube_tracker import TubeProjectionTracker
+
+
+class FakeCamera(object):
+    # a blank frame every 100 ms
+    def __init__(self, n_frames):
+        self._n_frames = n_frames
+
+    def __iter__(self):
+        for i in range(self._n_frames):
+            yield i * 100, np.full((41, 401, 3), 200, np.uint8)
+
+
+class SlowSnapshotWriter(object):
+    # a snapshot is due every second, and takes 0.2 s. DAM activity is due every second too, and is cheap
+    def __init__(self):
+        self._last_snapshot = None
+        self._last_dam = None
+        self.snapshots = []
+        self.dam_flushes = []
+
+    def write(self, t, roi, data_rows):
+        pass
+
+    def snapshot_due(self, t):
+        return self._last_snapshot is None or t - self._last_snapshot >= 1000
+
+    def dam_due(self, t):
+        return self._last_dam is None or t - self._last_dam >= 1000
+
+    def flush(self, t, frame=None, dam=True):
+        if frame is not None and self.snapshot_due(t):
+            time.sleep(0.2)
+            self._last_snapshot = t
+            self.snapshots.append(t)
+        if dam and self.dam_due(t):
+            self._last_dam = t
+            self.dam_flushes.append(t)
+
+
+class TestFrameDeadlineScheduler(unittest.TestCase):
+
+    def test_shedding(self):
+        sched = FrameDeadlineScheduler(target_fps=10, max_postponement=3)
+        sched.start_frame()
+        # critical work always runs
+        self.assertTrue(sched.should_run("tracking"))
+        # deferrable work fits in the budget
+        self.assertTrue(sched.should_run("drawing"))
+        sched.report("drawing", 1.0)
+        # now drawing is known to be too expensive, so it is shed...
+        for i in range(3):
+            sched.start_frame()
+            self.assertFalse(sched.should_run("drawing"))
+        # ... but not forever
+        sched.start_frame()
+        self.assertTrue(sched.should_run("drawing"))
+        self.assertEqual(sched.stats["drawing"], {"run": 2, "shed": 3})
+
+    def test_monitor_sheds_expensive_snapshots(self):
+        roi = ROI(np.array([(0, 0), (400, 0), (400, 40), (0, 40)]), 1)
+        writer = SlowSnapshotWriter()
+        monitor = Monitor(FakeCamera(30), TubeProjectionTracker, [roi], target_fps=10)
+        monitor.run(writer)
+        # the first snapshot shows it does not fit in the budget, so it is shed whenever it is due afterwards.
+        # Frames where nothing is due are not counted
+        self.assertEqual(writer.snapshots, [0])
+        self.assertEqual(monitor.deadline_stats["snapshot"], {"run": 1, "shed": 20})
+        # DAM activity is cheap, but, on the first frame, the snapshot took the whole budget, so it was postponed
+        self.assertEqual(writer.dam_flushes, [100, 1100, 2100])
+        self.assertEqual(monitor.deadline_stats["dam"], {"run": 3, "shed": 1})
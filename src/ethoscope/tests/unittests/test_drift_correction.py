@@ -0,0 +1,173 @@
+__author__ = 'quentin'
+
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+import cv2
+import numpy as np
+
+from ethoscope.core.roi import ROI
+from ethoscope.core.monitor import Monitor
+from ethoscope.core.drift_correction import ROIDriftCorrector
+from ethoscope.roi_builders.target_roi_builder import SleepMonitorWithTargetROIBuilder
+from ethoscope.trackers.trackers import BaseTracker, NoPositionError
+from ethoscope.trackers.tube_tracker import TubeProjectionTracker
+from ethoscope.trackers.adaptive_bg_tracker import AdaptiveBGModel, ObjectModel
+from ethoscope.utils.checkpoint import TrackerCheckpointer
+
+IMG = "../static_files/img/bright_targets.png"
+
+
+class FakeCamera(object):
+    def __init__(self, frames):
+        self._frames = frames
+
+    def __iter__(self):
+        return iter(self._frames)
+
+
+class NullTracker(BaseTracker):
+    def _find_position(self, img, mask, t):
+        raise NoPositionError
+
+
+def shifted(img, dx, dy, angle=0):
+    m = cv2.getRotationMatrix2D((img.shape[1] / 2.0, img.shape[0] / 2.0), angle, 1.0)
+    m[:, 2] += dx, dy
+    return cv2.warpAffine(img, m, (img.shape[1], img.shape[0]), borderMode=cv2.BORDER_REPLICATE)
+
+
+class TestROIAlign(unittest.TestCase):
+    def setUp(self):
+        # the model of the animal is shared by all trackers, so other tests must not affect it
+        self._fg_model = AdaptiveBGModel.fg_model
+        AdaptiveBGModel.fg_model = ObjectModel()
+
+    def tearDown(self):
+        AdaptiveBGModel.fg_model = self._fg_model
+
+    def test_align(self):
+        roi = ROI(np.array([(10, 10), (60, 12), (58, 40), (12, 38)]), 1)
+        mask = roi.mask()
+        x, y, w, h = roi.rectangle
+        original_mask = mask.copy()
+
+        roi.align(np.array([[1, 0, 5], [0, 1, -3]]))
+        self.assertEqual(roi.rectangle, (x + 5, y - 3, w, h))
+        # the mask is updated in place
+        self.assertIs(roi.mask(), mask)
+        np.testing.assert_array_equal(mask, original_mask)
+        np.testing.assert_array_equal(roi.polygon, roi.reference_polygon + [5, -3])
+
+        # a rotation changes the mask, not its size
+        roi.align(cv2.getRotationMatrix2D((35, 25), 3, 1.0))
+        self.assertEqual(roi.mask().shape, original_mask.shape)
+        self.assertGreater(np.count_nonzero(roi.mask() != original_mask), 0)
+
+        roi.align(np.array([[1, 0, 0], [0, 1, 0]]))
+        self.assertEqual(roi.rectangle, (x, y, w, h))
+        np.testing.assert_array_equal(roi.mask(), original_mask)
+
+    def test_trackers_follow_mask(self):
+        rng = np.random.RandomState(1)
+        frames = []
+        for i in range(11):
+            img = np.full((80, 460, 3), 200, np.uint8)
+            cv2.ellipse(img, ((60 + 5 * i, 40), (16, 7), 0), (40, 40, 40), -1)
+            frames.append(cv2.add(img, rng.randint(0, 6, img.shape).astype(np.uint8)))
+        roi = ROI(np.array([(20, 20), (420, 20), (420, 60), (20, 60)]), 1)
+        make_trackers = lambda: [TubeProjectionTracker(roi), AdaptiveBGModel(roi, preprocessing="local_contrast")]
+        trackers = make_trackers()
+        for i, img in enumerate(frames[0:10]):
+            for tr in trackers:
+                tr.track(i * 100, img)
+
+        roi.align(cv2.getRotationMatrix2D((220, 40), 2, 1.0))
+        # what trackers computed from the mask is rebuilt, as a new tracker would
+        fresh = make_trackers()
+        for tr in trackers + fresh:
+            tr.track(1000, frames[10])
+        np.testing.assert_allclose(trackers[0]._inv_count, fresh[0]._inv_count)
+        np.testing.assert_allclose(trackers[0]._section_inv_count, fresh[0]._section_inv_count)
+        np.testing.assert_allclose(trackers[1]._preprocessor._inv_weights, fresh[1]._preprocessor._inv_weights)
+
+
+class TestROIDriftCorrector(unittest.TestCase):
+    def setUp(self):
+        self._img = cv2.imread(IMG)
+        self._builder = SleepMonitorWithTargetROIBuilder()
+        self._rois = self._builder.build(self._img)
+        self._rectangles = [r.rectangle for r in self._rois]
+
+    def test_correction(self):
+        corrector = ROIDriftCorrector(self._builder, self._rois)
+        # small differences are noise
+        self.assertFalse(corrector.correct(0, shifted(self._img, 1, 0)))
+        self.assertEqual([r.rectangle for r in self._rois], self._rectangles)
+
+        self.assertTrue(corrector.correct(1000, shifted(self._img, 8, -5)))
+        for r, (x, y, w, h) in zip(self._rois, self._rectangles):
+            rx, ry, rw, rh = r.rectangle
+            self.assertLessEqual(abs(rx - x - 8), 1)
+            self.assertLessEqual(abs(ry - y + 5), 1)
+            self.assertEqual((rw, rh), (w, h))
+
+        # anchors are searched around their last position, so drift can accumulate beyond the search radius
+        self.assertTrue(corrector.correct(2000, shifted(self._img, 8 + 15, -5, 0.5)))
+        self.assertEqual(corrector.stats["corrections"], 2)
+        self.assertAlmostEqual(corrector.stats["last_correction"]["angle"], -0.5, delta=0.15)
+
+    def test_refused(self):
+        corrector = ROIDriftCorrector(self._builder, self._rois, max_correction=5)
+        self.assertFalse(corrector.correct(0, shifted(self._img, 10, 0)))
+        self.assertEqual(corrector.stats["refused"], 1)
+        self.assertEqual([r.rectangle for r in self._rois], self._rectangles)
+
+        # the targets are not in the frame
+        self.assertFalse(corrector.correct(0, np.full_like(self._img, 128)))
+        self.assertEqual(corrector.stats["failed"], 1)
+
+    def test_monitor(self):
+        corrector = ROIDriftCorrector(self._builder, self._rois, period=1000)
+        frames = [(t, shifted(self._img, 6, 0)) for t in range(0, 3000, 500)]
+        monitor = Monitor(FakeCamera(frames), NullTracker, self._rois, drift_corrector=corrector)
+        monitor.run()
+        self.assertEqual(monitor.drift_stats["checks"], 2)
+        self.assertEqual(monitor.drift_stats["corrections"], 1)
+        self.assertEqual(self._rois[0].rectangle[0], self._rectangles[0][0] + 6)
+
+    def test_resume_after_align(self):
+        tmp_dir = tempfile.mkdtemp(prefix="ethoscope_test_")
+        try:
+            # as pickled by the control thread, before the experiment starts, i.e. before any alignment
+            saved = pickle.dumps((self._rois, self._builder))
+            checkpointer = TrackerCheckpointer(os.path.join(tmp_dir, "checkpoint.pkl"), period=1000)
+            corrector = ROIDriftCorrector(self._builder, self._rois, period=1000)
+            frames = [(t, shifted(self._img, 6, 0)) for t in range(0, 2500, 500)]
+            monitor = Monitor(FakeCamera(frames), TubeProjectionTracker, self._rois,
+                              checkpointer=checkpointer, drift_corrector=corrector)
+            monitor.run()
+            self.assertEqual(monitor.drift_stats["corrections"], 1)
+            aligned = [r.rectangle for r in self._rois]
+            self.assertNotEqual(aligned, self._rectangles)
+
+            # after a restart
+            rois, builder = pickle.loads(saved)
+            self.assertEqual([r.rectangle for r in rois], self._rectangles)
+            checkpointer = TrackerCheckpointer(checkpointer.path)
+            states = checkpointer.load()
+            corrector = ROIDriftCorrector(builder, rois, period=1000)
+            frames = [(t, shifted(self._img, 6, 0)) for t in range(2500, 4000, 500)]
+            monitor = Monitor(FakeCamera(frames), TubeProjectionTracker, rois, drift_corrector=corrector)
+            # the ROIs are aligned as they were, so all trackers are restored
+            self.assertEqual(monitor.restore_tracker_states(states, checkpointer.drift_state), len(rois))
+            self.assertEqual([r.rectangle for r in rois], aligned)
+            # and the corrector carries on from there
+            monitor.run()
+            self.assertEqual(monitor.drift_stats["checks"], 1)
+            self.assertEqual(monitor.drift_stats["corrections"], 0)
+            self.assertEqual([r.rectangle for r in rois], aligned)
+        finally:
+            shutil.rmtree(tmp_dir)
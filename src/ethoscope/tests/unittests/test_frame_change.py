@@ -0,0 +1,55 @@
+__author__ = 'quentin'
+
+import unittest
+import cv2
+import numpy as np
+from ethoscope.core.roi import ROI
+from ethoscope.core.monitor import Monitor
+from ethoscope.core.frame_change import FrameChangeDetector
+from ethoscope.trackers.adaptive_bg_tracker import AdaptiveBGModel
+
+
+class FakeCamera(object):
+    def __init__(self, frames):
+        self._frames = frames
+
+    def __iter__(self):
+        return iter(self._frames)
+
+
+class TestFrameChangeDetector(unittest.TestCase):
+
+    def _frame(self, x, rng):
+        img = np.full((40, 400, 3), 200, np.uint8)
+        cv2.ellipse(img, ((x, 20), (16, 7), 0), (40, 40, 40), -1)
+        return cv2.add(img, rng.randint(0, 4, img.shape).astype(np.uint8))
+
+    def test_detector(self):
+        rng = np.random.RandomState(1)
+        det = FrameChangeDetector(max_skip_duration=1000)
+        self.assertTrue(det.has_changed(0, self._frame(100, rng)))
+        # only sensor noise
+        self.assertFalse(det.has_changed(100, self._frame(100, rng)))
+        # the animal moved
+        self.assertTrue(det.has_changed(200, self._frame(110, rng)))
+        # background maintenance
+        decisions = [det.has_changed(t, self._frame(110, rng)) for t in range(300, 1300, 100)]
+        self.assertEqual(decisions, [False] * 9 + [True])
+        self.assertEqual(det.stats["skipped"], 10)
+
+    def test_static_frames_are_carried_forward(self):
+        rng = np.random.RandomState(2)
+        roi = ROI(np.array([(0, 0), (399, 0), (399, 39), (0, 39)]), 1)
+        # the animal moves for a while, then stops
+        frames = [(i * 100, self._frame(50 + 3 * min(i, 40), rng)) for i in range(80)]
+        detector = FrameChangeDetector()
+        monitor = Monitor(FakeCamera(frames), AdaptiveBGModel, [roi], change_detector=detector)
+        monitor.run()
+        self.assertGreater(detector.stats["skipped"], 30)
+        tracker = monitor._unit_trackers[0]._tracker
+        # all frames still have a position, at the time of the frame
+        self.assertEqual(tracker.times[-1], 7900)
+        self.assertEqual(tracker.last_time_point, 7900)
+        last = tracker.positions[-1][0]
+        self.assertEqual(last["is_inferred"], 0)
+        self.assertLessEqual(abs(last["x"] - 170), 2)
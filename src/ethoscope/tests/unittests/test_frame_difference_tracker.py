@@ -0,0 +1,40 @@
+__author__ = 'quentin'
+
+import unittest
+import cv2
+import numpy as np
+from ethoscope.core.roi import ROI
+from ethoscope.trackers.frame_difference_tracker import FrameDifferenceTracker
+
+
+class TestFrameDifferenceTracker(unittest.TestCase):
+
+    def _frame(self, x, y, angle, rng):
+        img = np.full((60, 400, 3), 200, np.uint8)
+        cv2.ellipse(img, ((x, y), (16, 6), angle), (40, 40, 40), -1)
+        return cv2.add(img, rng.randint(0, 6, img.shape).astype(np.uint8))
+
+    def test_moving_then_still(self):
+        rng = np.random.RandomState(1)
+        roi = ROI(np.array([(0, 0), (399, 0), (399, 59), (0, 59)]), 1)
+        tracker = FrameDifferenceTracker(roi)
+        # the animal moves at 60 fps, then stays still for 20 s, longer than the half-life of the background
+        for i in range(1500):
+            x = 50 + 0.5 * min(i, 500)
+            points = tracker.track(int(i * 1000 / 60.), self._frame(x, 30, 30, rng))
+            if i > 30:
+                self.assertEqual(len(points), 1)
+                self.assertEqual(points[0]["is_inferred"], 0)
+                self.assertLessEqual(abs(points[0]["x"] - x), 1)
+                self.assertLessEqual(abs(points[0]["y"] - 30), 1)
+        self.assertLessEqual(abs(points[0]["phi"] - 30), 5)
+        self.assertLessEqual(abs(points[0]["w"] - 16), 2)
+        self.assertLessEqual(abs(points[0]["h"] - 6), 2)
+
+    def test_no_animal(self):
+        rng = np.random.RandomState(2)
+        roi = ROI(np.array([(0, 0), (399, 0), (399, 59), (0, 59)]), 1)
+        tracker = FrameDifferenceTracker(roi)
+        for i in range(50):
+            img = cv2.add(np.full((60, 400, 3), 200, np.uint8), rng.randint(0, 6, (60, 400, 3)).astype(np.uint8))
+            self.assertEqual(tracker.track(i * 16, img), [])
@@ -0,0 +1,155 @@
+__author__ = 'quentin'
+
+import unittest
+import itertools
+import cv2
+import numpy as np
+from ethoscope.utils.img_proc import merge_blobs, StreamingMedian
+from ethoscope.roi_builders.roi_builders import DefaultROIBuilder
+
+
+def merge_blobs_reference(contours, prop = .5):
+    # the original, quadratic, implementation
+    idx_pos_w = []
+    for i, c in enumerate(contours):
+        (x,y) ,(w,h), angle  = cv2.minAreaRect(c)
+        w = max(w,h)
+        h = min(w,h)
+        idx_pos_w.append((i, x+1j*y,w + h))
+
+    pairs_to_group = []
+    for a,b in itertools.combinations(idx_pos_w,2):
+        d = abs(a[1] - b[1])
+        wm = max(a[2], b[2]) * prop
+        if d < wm:
+            pairs_to_group.append({a[0], b[0]})
+
+    if len(pairs_to_group) == 0:
+        return contours
+
+    repeat = True
+    out_sets = pairs_to_group
+    while repeat:
+        comps = out_sets
+        out_sets = []
+        repeat=False
+        for s in comps:
+            connected = False
+            for i,o in enumerate(out_sets):
+                if o & s:
+                    out_sets[i] = s | out_sets[i]
+                    connected = True
+                    repeat=True
+            if not connected:
+                out_sets.append(s)
+
+    out_hulls = []
+    for c in comps:
+        out_hulls.append(np.concatenate([contours[s] for s in c]))
+    return [cv2.convexHull(o) for o in out_hulls]
+
+
+def random_blobs(rng, n, size=1000, max_blob_size=40):
+    out = []
+    for _ in range(n):
+        centre = rng.uniform(0, size, 2)
+        wh = rng.exponential(max_blob_size / 4.0, 2) + 1
+        angle = rng.uniform(0, 180)
+        pts = cv2.boxPoints((tuple(centre), tuple(wh), angle)) if hasattr(cv2, "boxPoints") else cv2.cv.BoxPoints((tuple(centre), tuple(wh), angle))
+        out.append(np.array(pts, np.int32).reshape((-1, 1, 2)))
+    return out
+
+
+def as_set(hulls):
+    return sorted(sorted(tuple(p) for p in h.reshape(-1, 2).tolist()) for h in hulls)
+
+
+class TestMergeBlobs(unittest.TestCase):
+
+    def test_same_as_reference(self):
+        rng = np.random.RandomState(1)
+        for i in range(200):
+            n = rng.randint(0, 60)
+            size = rng.choice([100, 300, 1000])
+            contours = random_blobs(rng, n, size)
+            ref = merge_blobs_reference(contours)
+            new = merge_blobs(contours)
+            self.assertEqual(as_set(ref), as_set(new), "Mismatch for sample %i (%i blobs)" % (i, n))
+
+    def test_same_as_reference_with_large_blobs(self):
+        rng = np.random.RandomState(2)
+        for i in range(50):
+            contours = random_blobs(rng, 40, 300) + random_blobs(rng, 2, 300, max_blob_size=2000)
+            self.assertEqual(as_set(merge_blobs_reference(contours)), as_set(merge_blobs(contours)))
+
+    def test_no_merge(self):
+        contours = random_blobs(np.random.RandomState(3), 1)
+        self.assertIs(merge_blobs(contours), contours)
+
+
+class TestStreamingMedian(unittest.TestCase):
+
+    def test_exact_up_to_base(self):
+        rng = np.random.RandomState(4)
+        frames = rng.randint(0, 256, (9, 20, 30, 3)).astype(np.uint8)
+        for n in [1, 2, 6, 9]:
+            med = StreamingMedian(base=9)
+            for f in frames[:n]:
+                med.update(f)
+            self.assertEqual(med.n, n)
+            np.testing.assert_array_equal(med.get(), np.median(frames[:n], 0).astype(np.uint8))
+
+    def test_bounded_memory(self):
+        # noisy frames of a constant scene
+        rng = np.random.RandomState(5)
+        scene = rng.randint(50, 200, (20, 30)).astype(np.uint8)
+        frames = [cv2.add(scene, rng.randint(0, 20, scene.shape).astype(np.uint8)) for _ in range(100)]
+        med = StreamingMedian(base=5, max_levels=2)
+        for f in frames:
+            med.update(f)
+        self.assertLessEqual(sum(len(b) for b in med._levels), 10)
+        # an approximation of the exact median
+        error = np.abs(med.get().astype(np.int16) - np.median(frames, 0))
+        self.assertLess(np.mean(error), 2)
+        self.assertLess(np.max(error), 8)
+
+    def test_single_level(self):
+        # as used to bootstrap backgrounds: one buffer, collapsed to its median when full
+        rng = np.random.RandomState(7)
+        frames = rng.randint(0, 256, (12, 20, 30)).astype(np.uint8)
+        med = StreamingMedian(base=5, max_levels=1)
+        for f in frames:
+            med.update(f)
+        self.assertEqual(med.n, 12)
+        self.assertEqual(len(med._levels), 1)
+        first = np.median(frames[:5], 0).astype(np.uint8)
+        second = np.median(np.concatenate([first[None], frames[5:9]]), 0).astype(np.uint8)
+        expected = np.median(np.concatenate([second[None], frames[9:]]), 0).astype(np.uint8)
+        np.testing.assert_array_equal(med.get(), expected)
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, StreamingMedian, 0)
+        self.assertRaises(ValueError, StreamingMedian, 5, 0)
+        med = StreamingMedian()
+        self.assertIsNone(med.get())
+        med.update(np.zeros((4, 4), np.uint8))
+        self.assertRaises(ValueError, med.update, np.zeros((4, 5), np.uint8))
+
+    def test_roi_builder_reference(self):
+        class FrameList(list):
+            def __iter__(self):
+                return enumerate(list.__iter__(self))
+
+        rng = np.random.RandomState(6)
+        frames = FrameList(rng.randint(0, 256, (60, 20, 30)).astype(np.uint8))
+        references = []
+
+        class Builder(DefaultROIBuilder):
+            def _rois_from_img(self, img):
+                references.append(img)
+                return super(Builder, self)._rois_from_img(img)
+
+        Builder().build(frames)
+        np.testing.assert_array_equal(references[-1], np.median(frames[:6], 0).astype(np.uint8))
+        Builder().build(frames, n_frames=50)
+        self.assertEqual(references[-1].shape, frames[0].shape)
@@ -0,0 +1,459 @@
+__author__ = 'quentin'
+
+import os
+import signal
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+import cv2
+import numpy as np
+from ethoscope.core.roi import ROI
+from ethoscope.core.data_point import DataPoint
+from ethoscope.core.variables import XPosVariable, YPosVariable
+from ethoscope.utils.io import SQLiteResultWriter, AsyncSQLiteWriter, AsyncWALSQLiteWriter, WALSQLiteResultWriter, \
+    ColumnarResultWriter, ColumnarResultReader, columnar_to_sqlite, SpillLog, ImgToMySQLHelper
+
+
+def make_rois(n):
+    return [ROI(np.array([(10 * i, 0), (10 * i + 10, 0), (10 * i + 10, 10), (10 * i, 10)]), i + 1) for i in range(n)]
+
+
+def write_rows(rw, rois, n_frames, start=0):
+    for i in range(n_frames):
+        t = (start + i) * 50
+        for r in rois:
+            rw.write(t, r, [DataPoint([XPosVariable(i % 100), YPosVariable(r.idx)])])
+        rw.flush(t)
+
+
+class TestGroupCommit(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp(prefix="ethoscope_test_")
+        self._db = os.path.join(self._dir, "results.db")
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def _count_rows(self, rois):
+        conn = sqlite3.connect(self._db)
+        try:
+            return [conn.execute("SELECT COUNT(*) FROM ROI_%i" % r.idx).fetchone()[0] for r in rois]
+        finally:
+            conn.close()
+
+    def test_all_rows_written(self):
+        rois = make_rois(10)
+        with SQLiteResultWriter(self._db, rois) as rw:
+            write_rows(rw, rois, 300)
+        self.assertEqual(self._count_rows(rois), [300] * 10)
+        commits, commands, rows = rw._async_writer.counters[0:3]
+        # commands are grouped
+        self.assertLess(commits, commands)
+        self.assertGreaterEqual(rows, 3000)
+
+    def test_row_batches(self):
+        rois = make_rois(3)
+        with SQLiteResultWriter(self._db, rois) as rw:
+            write_rows(rw, rois, 10)
+            # fewer rows than a batch are kept
+            self.assertEqual(len(rw._insert_dict[1]), 10)
+            self.assertEqual(rw._insert_dict[1][3], (150, 3, 1))
+            self.assertEqual(rw._insert_commands[2], "INSERT INTO ROI_2 (t, x, y) VALUES (?, ?, ?)")
+            write_rows(rw, rois, rw._max_insert_rows - 10)
+            self.assertEqual(len(rw._insert_dict[1]), 0)
+
+        conn = sqlite3.connect(self._db)
+        try:
+            rows = conn.execute("SELECT t, x, y FROM ROI_3").fetchall()
+        finally:
+            conn.close()
+        self.assertEqual(len(rows), rw._max_insert_rows)
+        self.assertEqual(rows[0:2], [(0, 0, 3), (50, 1, 3)])
+
+    def test_commits_old_transactions(self):
+        class QuickCommitWriter(AsyncSQLiteWriter):
+            _commit_max_delay = 0.05
+
+        class QuickCommitResultWriter(SQLiteResultWriter):
+            _async_writing_class = QuickCommitWriter
+
+        rois = make_rois(2)
+        with QuickCommitResultWriter(self._db, rois) as rw:
+            write_rows(rw, rois, 100)
+            rw._flush_rows(1)
+            # committed without more commands, nor closing the writer
+            deadline = time.time() + 5
+            while self._count_rows(rois[0:1])[0] == 0 and time.time() < deadline:
+                time.sleep(0.05)
+            self.assertEqual(self._count_rows(rois[0:1]), [100])
+            stats = rw.stats
+            self.assertGreater(stats["commits"], 0)
+            self.assertGreaterEqual(stats["rows"], 100)
+            self.assertIn("queue_depth", stats)
+
+    def test_stats(self):
+        class QuickStatsResultWriter(SQLiteResultWriter):
+            _stats_interval = 0.1
+
+        rois = make_rois(2)
+        with QuickStatsResultWriter(self._db, rois) as rw:
+            # no complete interval yet
+            self.assertIsNone(rw.stats["commits_per_s"])
+            write_rows(rw, rois, 100)
+            rw._flush_rows(1)
+            rw._flush_rows(2)
+            deadline = time.time() + 5
+            while self._count_rows(rois) != [100, 100] and time.time() < deadline:
+                time.sleep(0.05)
+            time.sleep(0.1)
+            rw.flush(5000)
+            # reading the stats does not reset them
+            stats = rw.stats
+            self.assertEqual(stats, rw.stats)
+            self.assertGreaterEqual(stats["rows"], 200)
+            self.assertGreater(stats["commits_per_s"], 0)
+            self.assertGreater(stats["rows_per_commit"], 0)
+
+
+class TestWALSQLiteWriter(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp(prefix="ethoscope_test_")
+        self._db = os.path.join(self._dir, "results.db")
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def _wait_for_commit(self, rw, seq):
+        deadline = time.time() + 5
+        while rw._async_writer.counters[4] < seq and time.time() < deadline:
+            time.sleep(0.02)
+        self.assertGreaterEqual(rw._async_writer.counters[4], seq)
+
+    def test_read_while_writing(self):
+        class QuickCommitWriter(AsyncWALSQLiteWriter):
+            _commit_max_delay = 0.05
+            _checkpoint_period = 0
+
+        class QuickCommitResultWriter(WALSQLiteResultWriter):
+            _async_writing_class = QuickCommitWriter
+
+        rois = make_rois(2)
+        with QuickCommitResultWriter(self._db, rois) as rw:
+            write_rows(rw, rois, rw._max_insert_rows)
+            self._wait_for_commit(rw, rw._seq)
+
+            reader = sqlite3.connect(self._db, isolation_level=None)
+            try:
+                self.assertEqual(reader.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+                # an open read transaction neither blocks, nor is blocked by, the writer
+                reader.execute("BEGIN")
+                self.assertEqual(reader.execute("SELECT COUNT(*) FROM ROI_1").fetchone()[0], rw._max_insert_rows)
+                write_rows(rw, rois, rw._max_insert_rows)
+                self._wait_for_commit(rw, rw._seq)
+                self.assertEqual(rw._async_writer.counters[5], -1)
+                self.assertEqual(reader.execute("SELECT COUNT(*) FROM ROI_1").fetchone()[0], rw._max_insert_rows)
+                reader.execute("COMMIT")
+                self.assertEqual(reader.execute("SELECT COUNT(*) FROM ROI_1").fetchone()[0], 2 * rw._max_insert_rows)
+            finally:
+                reader.close()
+
+        # the WAL is emptied when the writer stops
+        wal = self._db + "-wal"
+        self.assertTrue(not os.path.exists(wal) or os.path.getsize(wal) == 0)
+        conn = sqlite3.connect(self._db)
+        try:
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM ROI_2").fetchone()[0], 2 * rw._max_insert_rows)
+        finally:
+            conn.close()
+
+
+class TestSnapshots(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp(prefix="ethoscope_test_")
+        rng = np.random.RandomState(1)
+        self._frames = [cv2.GaussianBlur(rng.randint(0, 256, (480, 640)).astype(np.uint8), (5, 5), 0) for _ in range(2)]
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def _wait(self, helper):
+        deadline = time.time() + 5
+        while helper._pending.is_set() and time.time() < deadline:
+            time.sleep(0.01)
+
+    def _take(self, helper, t, img):
+        shots = helper.flush(t, img)
+        self._wait(helper)
+        return shots
+
+    def test_skip_unchanged(self):
+        helper = ImgToMySQLHelper(period=1.0, max_period=10.0)
+        shots = []
+        for i, frame in enumerate([0, 0, 0, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1]):
+            shots += self._take(helper, (i + 1) * 1000, self._frames[frame])
+        shots += helper.close()
+        # the frame changed at 4s, and nothing was saved for 10s from then
+        self.assertEqual([t for t, _ in shots], [1000, 4000, 14000])
+        self.assertEqual(helper.stats["unchanged"], 12)
+        img = cv2.imdecode(np.frombuffer(shots[0][1], np.uint8), cv2.IMREAD_GRAYSCALE)
+        self.assertEqual(img.shape, (480, 640))
+
+    def test_snapshot_due(self):
+        path = os.path.join(self._dir, "results.db")
+        with SQLiteResultWriter(path, make_rois(1), take_frame_shots=True) as rw:
+            self.assertFalse(rw.snapshot_due(1000))
+            self.assertTrue(rw.snapshot_due(300 * 1000))
+            rw.flush(300 * 1000, self._frames[0])
+            self._wait(rw._shot_saver)
+            self.assertFalse(rw.snapshot_due(301 * 1000))
+        with SQLiteResultWriter(path, make_rois(1)) as rw:
+            self.assertFalse(rw.snapshot_due(300 * 1000))
+
+    def test_quality_follows_budget(self):
+        helper = ImgToMySQLHelper(period=60.0, bytes_per_hour=60 * 25000, change_threshold=0)
+        shots = []
+        for i in range(10):
+            shots += self._take(helper, (i + 1) * 60000, self._frames[i % 2])
+        shots += helper.close()
+        self.assertEqual(len(shots), 10)
+        self.assertLess(helper.stats["quality"], 50)
+        sizes = [len(jpeg) for _, jpeg in shots[5:]]
+        self.assertLess(abs(np.mean(sizes) - 25000), 2500)
+
+    def test_sqlite_blobs(self):
+        path = os.path.join(self._dir, "results.db")
+        rois = make_rois(2)
+        with SQLiteResultWriter(path, rois, take_frame_shots=True) as rw:
+            for i in range(3):
+                # snapshots are due every 5 minutes
+                t = i * 300 * 1000 + 1000
+                for r in rois:
+                    rw.write(t, r, [DataPoint([XPosVariable(1), YPosVariable(r.idx)])])
+                rw.flush(t, self._frames[i % 2])
+                self._wait(rw._shot_saver)
+        conn = sqlite3.connect(path)
+        try:
+            rows = conn.execute("SELECT t, typeof(img), img FROM IMG_SNAPSHOTS").fetchall()
+        finally:
+            conn.close()
+        self.assertEqual([(t, kind) for t, kind, _ in rows], [(301000, "blob"), (601000, "blob")])
+        img = cv2.imdecode(np.frombuffer(bytes(rows[0][2]), np.uint8), cv2.IMREAD_GRAYSCALE)
+        self.assertEqual(img.shape, (480, 640))
+
+
+class TestPositionsTable(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp(prefix="ethoscope_test_")
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def _write(self, name, n_frames, **kwargs):
+        path = os.path.join(self._dir, name)
+        rois = make_rois(4)
+        with SQLiteResultWriter(path, rois, **kwargs) as rw:
+            write_rows(rw, rois, n_frames)
+        return path, rw
+
+    def test_same_data_as_roi_tables(self):
+        ref_path, _ = self._write("ref.db", 100)
+        path, rw = self._write("positions.db", 100, positions_table=True)
+        # a single batch for all ROIs
+        self.assertEqual(list(rw._insert_dict.keys()), ["POSITIONS"])
+
+        ref, conn = sqlite3.connect(ref_path), sqlite3.connect(path)
+        try:
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM POSITIONS").fetchone()[0], 400)
+            for i in range(1, 5):
+                # the views are read like the tables
+                command = "SELECT t, x, y FROM ROI_%i ORDER BY id" % i
+                self.assertEqual(conn.execute(command).fetchall(), ref.execute(command).fetchall())
+            self.assertEqual(conn.execute("SELECT * FROM VAR_MAP").fetchall(),
+                             ref.execute("SELECT * FROM VAR_MAP").fetchall())
+            # ids increase, so backups can fetch new rows
+            ids = [r[0] for r in conn.execute("SELECT id FROM ROI_2 ORDER BY t")]
+            self.assertEqual(ids, sorted(ids))
+            self.assertNotIn(None, ids)
+        finally:
+            ref.close()
+            conn.close()
+
+
+class TestColumnarResultWriter(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp(prefix="ethoscope_test_")
+        self._path = os.path.join(self._dir, "results.columnar")
+        self._rois = make_rois(3)
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def _write(self, n_frames, erase_old_db=True):
+        class SmallSegmentWriter(ColumnarResultWriter):
+            _segment_rows = 64
+
+        with SmallSegmentWriter(self._path, self._rois, {"machine_id": "abc"}, erase_old_db=erase_old_db) as rw:
+            write_rows(rw, self._rois, n_frames)
+        return rw
+
+    def test_read(self):
+        rw = self._write(500)
+        reader = ColumnarResultReader(self._path)
+        self.assertEqual(reader.columns, [("t", "<i4"), ("x", "<i2"), ("y", "<i2")])
+        self.assertEqual(reader.var_map[0][0:2], ("x", "SMALLINT"))
+        self.assertEqual(reader.metadata["machine_id"], "abc")
+        self.assertIn("stop_date_time", reader.metadata)
+        # segments are memory-mapped
+        segments = reader.segments(2)
+        self.assertEqual([len(s["t"]) for s in segments], [64] * 7 + [52])
+        self.assertIsInstance(segments[0]["x"].base, np.memmap)
+
+        data = reader.read(2)
+        np.testing.assert_array_equal(data["t"], np.arange(500) * 50)
+        np.testing.assert_array_equal(data["x"], np.arange(500) % 100)
+        np.testing.assert_array_equal(data["y"], np.full(500, 2))
+        stats = rw.stats
+        self.assertEqual(stats["buffered_rows"], 0)
+        self.assertEqual(stats["rows_written"], 500 * 3)
+        self.assertEqual(stats, rw.stats)
+
+    def test_truncated_file(self):
+        self._write(100)
+        file_path = os.path.join(self._path, "ROI_1.bin")
+        # e.g. a crash whilst writing a segment
+        with open(file_path, "ab") as f:
+            f.write(b"ETCS\x40\x00\x00\x00\x01\x02")
+        self.assertEqual(len(ColumnarResultReader(self._path).read(1)["t"]), 100)
+
+        # resuming drops the incomplete segment
+        self._write(100, erase_old_db=False)
+        reader = ColumnarResultReader(self._path)
+        self.assertEqual(len(reader.read(1)["t"]), 200)
+        self.assertEqual([e[1] for e in reader.start_events], ["graceful_start", "crash_recovery"])
+
+    def test_convert_to_sqlite(self):
+        self._write(300)
+        db_path = os.path.join(self._dir, "converted.db")
+        columnar_to_sqlite(self._path, db_path)
+
+        ref_path = os.path.join(self._dir, "ref.db")
+        with SQLiteResultWriter(ref_path, self._rois, {"machine_id": "abc"}) as rw:
+            write_rows(rw, self._rois, 300)
+
+        ref, conn = sqlite3.connect(ref_path), sqlite3.connect(db_path)
+        try:
+            for command in ["SELECT t, x, y FROM ROI_3", "SELECT * FROM ROI_MAP", "SELECT * FROM VAR_MAP"]:
+                self.assertEqual(conn.execute(command).fetchall(), ref.execute(command).fetchall())
+            self.assertEqual(conn.execute("SELECT value FROM METADATA WHERE field = 'machine_id'").fetchall(), [("abc",)])
+        finally:
+            ref.close()
+            conn.close()
+
+
+class TestSpillLog(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp(prefix="ethoscope_test_")
+        self._path = os.path.join(self._dir, "spill", "commands.log")
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_resume_after_crash(self):
+        log = SpillLog(self._path)
+        for i in range(10):
+            log.append(("command %i" % i, [(i, i)]))
+        records = log.read(4)
+        self.assertEqual([r[1][0] for r in records], ["command %i" % i for i in range(4)])
+        log.commit(records[1][0])
+        # a record that was not completely written
+        with open(self._path, "ab") as f:
+            f.write(b"\xff\x00\x00\x00abc")
+
+        # the records after the last commit are read again
+        log = SpillLog(self._path)
+        self.assertFalse(log.empty)
+        records = log.read(100)
+        self.assertEqual([r[1][0] for r in records], ["command %i" % i for i in range(2, 10)])
+        self.assertTrue(log.empty)
+        log.commit(records[-1][0])
+        self.assertEqual(log.pending_bytes, 0)
+        self.assertEqual(os.path.getsize(self._path), 0)
+
+    def test_prepend(self):
+        log = SpillLog(self._path)
+        for i in range(4):
+            log.append(i)
+        log.read(1)
+        log.prepend(["a", "b"])
+        self.assertEqual([r for _, r in log.read(100)], ["a", "b", 1, 2, 3])
+
+
+class TestWriterRecovery(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp(prefix="ethoscope_test_")
+        self._db = os.path.join(self._dir, "results.db")
+        self._spill = os.path.join(self._dir, "spill.log")
+        self._rois = make_rois(4)
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def _distinct_rows(self):
+        conn = sqlite3.connect(self._db)
+        try:
+            return [conn.execute("SELECT COUNT(DISTINCT t) FROM ROI_%i" % r.idx).fetchone()[0] for r in self._rois]
+        finally:
+            conn.close()
+
+    def test_killed_writer(self):
+        class RestartingResultWriter(SQLiteResultWriter):
+            _restart_delay = 0
+
+        with RestartingResultWriter(self._db, self._rois, spill_path=self._spill) as rw:
+            for i in range(5):
+                write_rows(rw, self._rois, 200, start=i * 200)
+                # kill the writer mid-stream
+                os.kill(rw._async_writer.pid, signal.SIGKILL)
+                rw._async_writer.join()
+            write_rows(rw, self._rois, 200, start=1000)
+            self.assertGreaterEqual(rw.stats["writer_restarts"], 5)
+        # the counters of all writers add up
+        self.assertGreaterEqual(rw.stats["rows"], 1200 * 4)
+
+        # each round writes its own times, so no row of any of the 6 rounds is lost
+        self.assertEqual(self._distinct_rows(), [1200] * 4)
+        self.assertFalse(os.path.exists(self._spill))
+
+    def test_spill_when_writer_is_slow(self):
+        class SlowWriter(AsyncSQLiteWriter):
+            _commit_max_delay = 0.05
+
+            def _execute(self, cursor, command, args):
+                time.sleep(0.002)
+                return super(SlowWriter, self)._execute(cursor, command, args)
+
+        class SpillingResultWriter(SQLiteResultWriter):
+            _async_writing_class = SlowWriter
+            _spill_max_pending = 20
+
+        with SpillingResultWriter(self._db, self._rois, spill_path=self._spill) as rw:
+            write_rows(rw, self._rois, 2000)
+            stats = rw.stats
+            self.assertGreater(stats["spilled_commands"], 0)
+            self.assertLessEqual(stats["uncommitted"], 20)
+        self.assertEqual(self._distinct_rows(), [2000] * 4)
+
+    def test_replay_after_crash(self):
+        # a previous run left commands in the spill log
+        with SQLiteResultWriter(self._db, self._rois, spill_path=self._spill) as rw:
+            write_rows(rw, self._rois, 100)
+        log = SpillLog(self._spill)
+        log.append(("INSERT INTO ROI_1 (t, x, y) VALUES (?, ?, ?)", [(10000, 1, 1), (10050, 1, 1)]))
+        log.close(remove_if_empty=False)
+
+        with SQLiteResultWriter(self._db, self._rois, spill_path=self._spill, erase_old_db=False) as rw:
+            write_rows(rw, self._rois, 1)
+        self.assertEqual(self._distinct_rows(), [102, 100, 100, 100])
+        self.assertFalse(os.path.exists(self._spill))
@@ -0,0 +1,103 @@
+__author__ = 'quentin'
+
+import os
+import shutil
+import tempfile
+import unittest
+import cv2
+import numpy as np
+
+from ethoscope.roi_builders.target_roi_builder import SleepMonitorWithTargetROIBuilder
+from ethoscope.roi_builders.roi_builders import DefaultROIBuilder
+from ethoscope.roi_builders.layout_cache import ROILayoutCache
+
+IMG = "../static_files/img/bright_targets.png"
+
+
+class CountingROIBuilder(SleepMonitorWithTargetROIBuilder):
+    n_builds = 0
+
+    def _rois_from_img(self, img):
+        CountingROIBuilder.n_builds += 1
+        return super(CountingROIBuilder, self)._rois_from_img(img)
+
+
+class CountingCamera(object):
+    # always shows the same image, and counts the frames that were read
+    def __init__(self, img):
+        self._img = img
+        self.n_frames = 0
+
+    def __iter__(self):
+        while True:
+            self.n_frames += 1
+            yield self.n_frames * 100, self._img
+
+
+def shifted(img, dx, dy):
+    m = np.float32([[1, 0, dx], [0, 1, dy]])
+    return cv2.warpAffine(img, m, (img.shape[1], img.shape[0]), borderMode=cv2.BORDER_REPLICATE)
+
+
+class TestROILayoutCache(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._cache = ROILayoutCache(os.path.join(self._dir, "layouts.pkl"))
+        self._key = self._cache.key("machine_1", CountingROIBuilder, {})
+        self._img = cv2.imread(IMG)
+        CountingROIBuilder.n_builds = 0
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_reuse(self):
+        rois = self._cache.build(CountingROIBuilder(), self._img, self._key)
+        self.assertEqual(CountingROIBuilder.n_builds, 1)
+        self.assertTrue(os.path.exists(self._cache.path))
+
+        cached_rois = self._cache.build(CountingROIBuilder(), self._img, self._key)
+        self.assertEqual(CountingROIBuilder.n_builds, 1)
+        self.assertEqual([r.idx for r in rois], [r.idx for r in cached_rois])
+        for r, c in zip(rois, cached_rois):
+            np.testing.assert_array_equal(r.polygon, c.polygon)
+
+        # a small drift is accepted
+        self._cache.build(CountingROIBuilder(), shifted(self._img, 1, 1), self._key)
+        self.assertEqual(CountingROIBuilder.n_builds, 1)
+
+    def test_moved_arena(self):
+        self._cache.build(CountingROIBuilder(), self._img, self._key)
+        rois = self._cache.build(CountingROIBuilder(), shifted(self._img, 20, 0), self._key)
+        self.assertEqual(CountingROIBuilder.n_builds, 2)
+        # the cache now holds the new layout
+        cached_rois = self._cache.build(CountingROIBuilder(), shifted(self._img, 20, 0), self._key)
+        self.assertEqual(CountingROIBuilder.n_builds, 2)
+        for r, c in zip(rois, cached_rois):
+            np.testing.assert_array_equal(r.polygon, c.polygon)
+
+    def test_keys(self):
+        self._cache.build(CountingROIBuilder(), self._img, self._key)
+        self._cache.build(CountingROIBuilder(), self._img, self._cache.key("machine_2", CountingROIBuilder, {}))
+        self.assertEqual(CountingROIBuilder.n_builds, 2)
+        self._cache.remove(self._key)
+        self._cache.build(CountingROIBuilder(), self._img, self._key)
+        self.assertEqual(CountingROIBuilder.n_builds, 3)
+        self.assertNotEqual(self._cache.key("machine_1", CountingROIBuilder, {"n_rows": 10}), self._key)
+
+    def test_builder_without_anchors(self):
+        rois = self._cache.build(DefaultROIBuilder(), self._img, self._key)
+        self.assertEqual(len(rois), 1)
+        self.assertFalse(os.path.exists(self._cache.path))
+
+    def test_reference_frames(self):
+        # one frame is read to check the cached layout, then the reference is made of `n_reference_frames` frames
+        camera = CountingCamera(self._img)
+        builder = CountingROIBuilder(**{"n_reference_frames": 12.0})
+        rois = self._cache.build(builder, camera, self._cache.key("machine_1", CountingROIBuilder, {"n_reference_frames": 12.0}))
+        self.assertEqual(camera.n_frames, 1 + 12)
+        self.assertEqual(len(rois), 20)
+
+        camera = CountingCamera(self._img)
+        self._cache.build(CountingROIBuilder(), camera, self._key, n_frames=3)
+        self.assertEqual(camera.n_frames, 1 + 3)
+        self.assertRaises(ValueError, CountingROIBuilder, 0)
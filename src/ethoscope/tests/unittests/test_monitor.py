@@ -0,0 +1,120 @@
+__author__ = 'quentin'
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+import cv2
+import numpy as np
+from ethoscope.core.roi import ROI
+from ethoscope.core.monitor import Monitor, PipelinedMonitor
+from ethoscope.trackers.tube_tracker import TubeProjectionTracker
+from ethoscope.utils.io import SQLiteResultWriter, ImgToMySQLHelper
+
+VIDEO = "../static_files/videos/arena_10x2_sortTubes.mp4"
+
+
+class VideoCamera(object):
+    # the first frames of a video, with their time in ms
+    def __init__(self, path, n_frames, frame_delay=0):
+        self._path = path
+        self._n_frames = n_frames
+        self._frame_delay = frame_delay
+
+    def __iter__(self):
+        capture = cv2.VideoCapture(self._path)
+        try:
+            for i in range(self._n_frames):
+                ok, frame = capture.read()
+                if not ok:
+                    break
+                time.sleep(self._frame_delay)
+                yield i * 50, frame
+        finally:
+            capture.release()
+
+
+class RecordingWriter(object):
+    def __init__(self, snapshot_period=1000):
+        self._snapshot_period = snapshot_period
+        self._last_snapshot = None
+        self.rows = []
+        self.snapshots = []
+        self.n_frames = 0
+
+    def write(self, t, roi, data_rows):
+        self.rows.append((t, roi.idx, [sorted(dr.items()) for dr in data_rows]))
+
+    def snapshot_due(self, t):
+        return self._last_snapshot is None or t - self._last_snapshot >= self._snapshot_period
+
+    def dam_due(self, t):
+        return True
+
+    def flush(self, t, frame=None, dam=True):
+        if frame is not None:
+            self.n_frames += 1
+            if self.snapshot_due(t):
+                self._last_snapshot = t
+                self.snapshots.append((t, frame.shape))
+
+
+def make_rois():
+    # horizontal bands across the tubes of the video
+    return [ROI(np.array([(100, y), (1180, y), (1180, y + 40), (100, y + 40)]), i + 1)
+            for i, y in enumerate(range(100, 900, 80))]
+
+
+class TestPipelinedMonitor(unittest.TestCase):
+
+    def _run(self, monitor_class):
+        writer = RecordingWriter()
+        monitor = monitor_class(VideoCamera(VIDEO, 100), TubeProjectionTracker, make_rois())
+        monitor.run(writer)
+        return monitor, writer
+
+    def test_same_results_as_monitor(self):
+        _, ref = self._run(Monitor)
+        monitor, writer = self._run(PipelinedMonitor)
+        self.assertGreater(len(ref.rows), 0)
+        self.assertEqual(writer.rows, ref.rows)
+        self.assertEqual(writer.snapshots, ref.snapshots)
+        self.assertEqual(monitor.last_frame_idx, 99)
+        # all results went through the persistence queue, nothing was lost
+        stats = monitor.stage_stats["persistence"]
+        self.assertEqual(stats["put"], 100)
+        self.assertEqual(stats["dropped"], 0)
+
+    def test_frames_queued_for_snapshots_only(self):
+        _, writer = self._run(PipelinedMonitor)
+        # 5 s of video, one snapshot per second
+        self.assertEqual(len(writer.snapshots), 5)
+        self.assertEqual(writer.n_frames, 5)
+
+    def test_snapshots_saved_while_running(self):
+        tmp_dir = tempfile.mkdtemp(prefix="ethoscope_test_")
+        try:
+            path = os.path.join(tmp_dir, "results.db")
+            rois = make_rois()
+            with SQLiteResultWriter(path, rois, take_frame_shots=True) as rw:
+                rw._shot_saver = ImgToMySQLHelper(period=1.0, change_threshold=0)
+                # frames arrive at a realistic pace, so snapshots are encoded before the end
+                monitor = PipelinedMonitor(VideoCamera(VIDEO, 100, frame_delay=0.01), TubeProjectionTracker, rois)
+                monitor.run(rw)
+                n_saved = rw._shot_saver.stats["saved"]
+                self.assertEqual(n_saved, 5)
+                # before the writer is closed, all snapshots are in the database, including the last one
+                deadline = time.time() + 5
+                n_rows = 0
+                while n_rows < n_saved and time.time() < deadline:
+                    time.sleep(0.05)
+                    conn = sqlite3.connect(path)
+                    try:
+                        n_rows = conn.execute("SELECT COUNT(*) FROM IMG_SNAPSHOTS").fetchone()[0]
+                    finally:
+                        conn.close()
+                self.assertEqual(n_rows, n_saved)
+        finally:
+            shutil.rmtree(tmp_dir)
@@ -0,0 +1,78 @@
+__author__ = 'quentin'
+
+import unittest
+import cv2
+import numpy as np
+from ethoscope.core.roi import ROI
+from ethoscope.core.monitor import Monitor
+from ethoscope.trackers.adaptive_bg_tracker import AdaptiveBGModel
+from ethoscope.trackers.trackers import NoPositionError
+from ethoscope.trackers.motion_model import KalmanMotionBank
+
+
+class FakeCamera(object):
+    def __init__(self, frames):
+        self._frames = frames
+
+    def __iter__(self):
+        return iter(self._frames)
+
+
+class DroppingTracker(AdaptiveBGModel):
+    # misses the animal on one frame out of three, once tracking is established
+    def _find_position(self, img, mask, t):
+        out = super(DroppingTracker, self)._find_position(img, mask, t)
+        if t > 3000 and (t // 100) % 3 == 0:
+            raise NoPositionError
+        return out
+
+
+class TestKalmanMotionBank(unittest.TestCase):
+
+    def test_prediction(self):
+        bank = KalmanMotionBank()
+        for idx in (1, 2):
+            bank.register(idx)
+        self.assertIsNone(bank.prediction(1))
+        for i in range(20):
+            bank.predict(i * 100)
+            # animal 1 moves at 50 px/s, animal 2 does not move
+            bank.observe(1, 10 + 5 * i, 20)
+            bank.observe(2, 30, 5)
+        bank.predict(2000)
+        x, y, sd = bank.prediction(1)
+        self.assertAlmostEqual(x, 110, delta=2)
+        self.assertAlmostEqual(y, 20, delta=1)
+        x2, y2, sd2 = bank.prediction(2)
+        self.assertAlmostEqual(x2, 30, delta=0.5)
+        # the uncertainty grows without observations
+        bank.predict(3000)
+        x, _, sd_later = bank.prediction(1)
+        self.assertGreater(sd_later, sd)
+        self.assertGreater(x, 115)
+
+    def test_inferred_positions_follow_motion(self):
+        errors = {}
+        for use_model in (False, True):
+            rng = np.random.RandomState(3)
+            roi = ROI(np.array([(0, 0), (399, 0), (399, 39), (0, 39)]), 1)
+            frames = []
+            for i in range(80):
+                img = np.full((40, 400, 3), 200, np.uint8)
+                cv2.ellipse(img, ((40 + 4 * i, 20), (16, 7), 0), (40, 40, 40), -1)
+                frames.append((i * 100, cv2.add(img, rng.randint(0, 4, img.shape).astype(np.uint8))))
+            model = KalmanMotionBank() if use_model else None
+            monitor = Monitor(FakeCamera(frames), DroppingTracker, [roi], motion_model=model)
+            monitor.run()
+            tracker = monitor._unit_trackers[0]._tracker
+            points = [(t, p[0]) for t, p in zip(tracker.times, tracker.positions) if t > 3000]
+            inferred = [(t, p) for t, p in points if p["is_inferred"]]
+            self.assertGreater(len(inferred), 10)
+            # the tracker may measure the animal with a small constant offset
+            offset = np.mean([p["x"] - (40 + 4 * t / 100) for t, p in points if not p["is_inferred"]])
+            errors[use_model] = np.mean([abs(p["x"] - offset - (40 + 4 * t / 100)) for t, p in inferred])
+            if use_model:
+                self.assertIsNotNone(tracker.search_region())
+        # repeating the last position is one frame late, i.e. 4 px off
+        self.assertGreater(errors[False], 3)
+        self.assertLess(errors[True], 1.5)
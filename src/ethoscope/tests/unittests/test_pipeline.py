@@ -0,0 +1,72 @@
+__author__ = 'quentin'
+
+import unittest
+import threading
+from ethoscope.core.pipeline import StageQueue, StageQueueClosed, PipelineStage, BLOCK, DROP_OLDEST, COALESCE
+
+
+class TestStageQueue(unittest.TestCase):
+
+    def _drain(self, q):
+        q.close()
+        out = []
+        while True:
+            try:
+                out.append(q.get())
+            except StageQueueClosed:
+                return out
+
+    def test_drop_oldest(self):
+        q = StageQueue(3, DROP_OLDEST)
+        for i in range(5):
+            q.put(i)
+        self.assertEqual(self._drain(q), [2, 3, 4])
+        self.assertEqual(q.stats["dropped"], 2)
+
+    def test_coalesce(self):
+        q = StageQueue(2, COALESCE)
+        for i in range(5):
+            q.put(i)
+        self.assertEqual(self._drain(q), [0, 4])
+        self.assertEqual(q.stats["coalesced"], 3)
+
+    def test_block(self):
+        q = StageQueue(1, BLOCK)
+        q.put(0)
+        producer = threading.Thread(target=q.put, args=(1,))
+        producer.start()
+        producer.join(.1)
+        # the producer waits for the consumer
+        self.assertTrue(producer.is_alive())
+        self.assertEqual(q.get(), 0)
+        producer.join(1)
+        self.assertFalse(producer.is_alive())
+        self.assertEqual(self._drain(q), [1])
+
+    def test_closed_releases_producer(self):
+        q = StageQueue(1, BLOCK)
+        q.put(0)
+        q.close()
+        self.assertFalse(q.put(1))
+
+    def test_stage(self):
+        q = StageQueue(4, BLOCK)
+        out = []
+        stage = PipelineStage("test", q, lambda a, b: out.append(a + b))
+        stage.start()
+        for i in range(10):
+            q.put((i, 1))
+        q.close()
+        stage.join(1)
+        self.assertEqual(out, range(1, 11))
+        self.assertIsNone(stage.error)
+
+    def test_stage_error(self):
+        q = StageQueue(4, BLOCK)
+        stage = PipelineStage("test", q, lambda a: 1 / a)
+        stage.start()
+        q.put((0,))
+        stage.join(1)
+        self.assertIsNotNone(stage.error)
+        # the queue is closed so producers never wait for a dead stage
+        self.assertFalse(q.put((1,)))
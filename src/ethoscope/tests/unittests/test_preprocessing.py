@@ -0,0 +1,73 @@
+__author__ = 'quentin'
+
+import unittest
+import cv2
+import numpy as np
+from ethoscope.core.roi import ROI
+from ethoscope.trackers.preprocessing import MinimalPreprocessor, LocalContrastPreprocessor
+from ethoscope.trackers.adaptive_bg_tracker import AdaptiveBGModel, ObjectModel
+from ethoscope.trackers.compact_bg_tracker import CompactAdaptiveBGModel, BufferPool
+
+
+class TestPreprocessing(unittest.TestCase):
+
+    def setUp(self):
+        # the model of the animal is shared by all trackers, so other tests must not affect it
+        self._fg_model = AdaptiveBGModel.fg_model
+        AdaptiveBGModel.fg_model = ObjectModel()
+
+    def tearDown(self):
+        AdaptiveBGModel.fg_model = self._fg_model
+
+    def test_local_contrast(self):
+        rng = np.random.RandomState(1)
+        grey = rng.randint(100, 140, (40, 200)).astype(np.uint8)
+        mask = np.zeros_like(grey)
+        cv2.circle(mask, (100, 20), 60, 255, -1)
+        img = cv2.cvtColor(grey, cv2.COLOR_GRAY2BGR)
+        prep = LocalContrastPreprocessor()
+        out = prep.apply(img, mask, 0)
+
+        # brute force: the scaled image minus the mean of its neighbourhood, within the mask
+        hist = np.convolve(cv2.calcHist([grey], [0], None, [256], [0, 255]).ravel(), [1] * 3)
+        scaled = cv2.multiply(grey, 128. / np.argmax(hist))
+        scaled[mask == 0] = 0
+        r = int(0.05 * 200 * 2) // 2
+        padded = cv2.copyMakeBorder(scaled, r, r, r, r, cv2.BORDER_REFLECT_101).astype(np.float64)
+        padded_mask = cv2.copyMakeBorder(mask, r, r, r, r, cv2.BORDER_REFLECT_101) / 255.
+        for y, x in zip(*np.nonzero(mask))[::37]:
+            local = padded[y: y + 2 * r + 1, x: x + 2 * r + 1].sum() / padded_mask[y: y + 2 * r + 1, x: x + 2 * r + 1].sum()
+            self.assertLessEqual(abs(out[y, x] - abs(scaled[y, x] - local)), 1)
+        self.assertEqual(np.count_nonzero(out[mask == 0]), 0)
+
+    def test_mode_window(self):
+        prep = LocalContrastPreprocessor(mode_window=1000)
+        img = np.full((20, 100, 3), 100, np.uint8)
+        for t in range(0, 2000, 100):
+            prep.apply(img, None, t)
+        img[:] = 150
+        prep.apply(img, None, 2000)
+        # 10 frames at 100 and one at 150, within the window
+        self.assertAlmostEqual(prep._update_mode(img[:, :, 0], 2100), (9 * 100 + 2 * 150) / 11.)
+
+    def test_pooled_buffers(self):
+        pool = BufferPool()
+        img = np.random.RandomState(2).randint(0, 255, (20, 100, 3)).astype(np.uint8)
+        for cls in (MinimalPreprocessor, LocalContrastPreprocessor):
+            own = cls().apply(img, None, 0)
+            pooled = cls(pool=pool).apply(img, None, 0)
+            np.testing.assert_array_equal(own, pooled)
+        self.assertGreater(pool.nbytes, 0)
+
+    def test_tracker_selection(self):
+        roi = ROI(np.array([(0, 0), (399, 0), (399, 39), (0, 39)]), 1)
+        self.assertRaises(ValueError, AdaptiveBGModel, roi, None, "unknown")
+        rng = np.random.RandomState(3)
+        for cls in (AdaptiveBGModel, CompactAdaptiveBGModel):
+            tracker = cls(roi, preprocessing="local_contrast")
+            for i in range(60):
+                img = np.full((40, 400, 3), 200, np.uint8)
+                cv2.ellipse(img, ((50 + 4 * i, 20), (16, 7), 0), (40, 40, 40), -1)
+                points = tracker.track(i * 100, cv2.add(img, rng.randint(0, 4, img.shape).astype(np.uint8)))
+            self.assertEqual(points[0]["is_inferred"], 0)
+            self.assertLessEqual(abs(points[0]["x"] - (50 + 4 * 59)), 2)
@@ -0,0 +1,51 @@
+__author__ = 'quentin'
+
+import unittest
+import cv2
+import numpy as np
+from ethoscope.core.roi import ROI
+from ethoscope.core.tracking_unit import TrackingUnit
+from ethoscope.core.rate_scheduler import AdaptiveRateScheduler
+from ethoscope.trackers.adaptive_bg_tracker import AdaptiveBGModel
+from ethoscope.stimulators.stimulators import BaseStimulator
+
+
+class AlwaysStimulator(BaseStimulator):
+    def _decide(self):
+        return 1, {}
+
+
+class TestAdaptiveRateScheduler(unittest.TestCase):
+
+    def _frame(self, x):
+        img = np.full((40, 400, 3), 200, np.uint8)
+        if x is not None:
+            cv2.circle(img, (x, 20), 6, (30, 30, 30), -1)
+        return img
+
+    def test_quiescent_roi(self):
+        roi = ROI(np.array([(0, 0), (399, 0), (399, 39), (0, 39)]), 1)
+        unit = TrackingUnit(AdaptiveBGModel, roi)
+        sched = AdaptiveRateScheduler(quiescent_period=1000, quiescence_delay=2000)
+        decisions = []
+        # a static scene for 5s, at 10 fps
+        for t in range(0, 5000, 100):
+            decisions.append(sched.should_track(unit, t, self._frame(None)))
+        # active for the first 2s
+        self.assertTrue(all(decisions[:20]))
+        # then tracked once per second only
+        self.assertEqual(sum(decisions[20:]), 3)
+        self.assertTrue(sched.is_quiescent(1, 4900))
+
+        # something moves: the ROI is promoted immediately
+        self.assertTrue(sched.should_track(unit, 5000, self._frame(200)))
+        self.assertFalse(sched.is_quiescent(1, 5000))
+        stats = sched.stats(5000)
+        self.assertEqual(stats["n_quiescent"], 0)
+        self.assertAlmostEqual(stats["coverage"], 24 / 51., 3)
+
+    def test_stimulated_roi_is_always_tracked(self):
+        roi = ROI(np.array([(0, 0), (399, 0), (399, 39), (0, 39)]), 1)
+        unit = TrackingUnit(AdaptiveBGModel, roi, AlwaysStimulator(None))
+        sched = AdaptiveRateScheduler(quiescent_period=1000, quiescence_delay=2000)
+        self.assertTrue(all(sched.should_track(unit, t, self._frame(None)) for t in range(0, 5000, 100)))
@@ -0,0 +1,51 @@
+__author__ = 'quentin'
+
+import pickle
+import unittest
+import numpy as np
+
+from ethoscope.core.roi import ROI, ROISet
+from ethoscope.utils.debug import EthoscopeException
+
+
+class TestROISet(unittest.TestCase):
+    def setUp(self):
+        self._rois = [ROI(np.array([(10, 10), (60, 12), (58, 40), (12, 38)]), 1),
+                      ROI(np.array([(70, 5), (90, 5), (90, 45), (70, 45)]), 2),
+                      ROI(np.array([(5, 50), (40, 50), (22, 70)]), 3)]
+        self._img = np.random.RandomState(1).randint(0, 255, (80, 100, 3)).astype(np.uint8)
+
+    def test_crop_all(self):
+        expected = [r.apply(self._img) for r in self._rois]
+        roi_set = ROISet(self._rois)
+        self.assertEqual(len(roi_set), 3)
+        self.assertIs(roi_set[1], self._rois[1])
+
+        for (sub_img, mask), (e_sub_img, e_mask) in zip(roi_set.crop_all(self._img), expected):
+            np.testing.assert_array_equal(sub_img, e_sub_img)
+            np.testing.assert_array_equal(mask, e_mask)
+            self.assertTrue(np.may_share_memory(sub_img, self._img))
+            self.assertTrue(np.may_share_memory(mask, roi_set.mask_buffer))
+
+        self.assertEqual(list(roi_set.mask_sums), [np.count_nonzero(m) for _, m in expected])
+        self.assertEqual(roi_set.mask_buffer.size, sum(m.size for _, m in expected))
+
+    def test_out_of_frame(self):
+        roi_set = ROISet(self._rois)
+        self.assertRaises(EthoscopeException, roi_set.crop_all, self._img[0:60, 0:60])
+
+    def test_refresh(self):
+        roi_set = ROISet(self._rois)
+        roi_set.crop_all(self._img)
+        for r in self._rois:
+            r.align(np.array([[1, 0, 3], [0, 1, 2]]))
+        roi_set.refresh()
+        for (sub_img, mask), r in zip(roi_set.crop_all(self._img), self._rois):
+            np.testing.assert_array_equal(sub_img, r.apply(self._img)[0])
+            self.assertTrue(np.may_share_memory(mask, roi_set.mask_buffer))
+
+    def test_pickle(self):
+        roi_set = pickle.loads(pickle.dumps(ROISet(self._rois)))
+        for (sub_img, mask), r in zip(roi_set.crop_all(self._img), self._rois):
+            np.testing.assert_array_equal(mask, r.mask())
+            self.assertTrue(np.may_share_memory(mask, roi_set.mask_buffer))
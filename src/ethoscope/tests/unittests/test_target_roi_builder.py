@@ -1,6 +1,7 @@
 __author__ = 'quentin'
 
 import cv2
+import numpy as np
 import unittest
 import os
 from ethoscope.roi_builders.target_roi_builder import SleepMonitorWithTargetROIBuilder, TargetGridROIBuilder
@@ -46,3 +47,32 @@ class TestTargetROIBuilder(unittest.TestCase):
 
 
 
+
+
+class FullResolutionTargetROIBuilder(SleepMonitorWithTargetROIBuilder):
+    _coarse_factor = 1
+
+
+class TestTargetSearch(unittest.TestCase):
+
+    roi_builder = SleepMonitorWithTargetROIBuilder()
+
+    def test_bisection_matches_sweep(self):
+        for k, i in images.items():
+            score_map = self.roi_builder._find_blobs(cv2.imread(i), self.roi_builder._score_targets)
+            bin = np.empty_like(score_map)
+            for t in range(0, 255):
+                cv2.threshold(score_map, t, 255, cv2.THRESH_BINARY, bin)
+                expected = self.roi_builder._find_contours(bin)
+                if len(expected) <= 3:
+                    break
+            found = self.roi_builder._select_blobs(score_map, 3)
+            self.assertEqual(len(found), 3)
+            self.assertEqual(sorted(c.tolist() for c in found), sorted(c.tolist() for c in expected))
+
+    def test_coarse_search(self):
+        for k, i in images.items():
+            img = cv2.imread(i)
+            coarse = self.roi_builder._find_target_coordinates(img)
+            full = FullResolutionTargetROIBuilder()._find_target_coordinates(img)
+            self.assertLess(np.max(np.abs(coarse - full)), 0.5)
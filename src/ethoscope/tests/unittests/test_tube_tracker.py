@@ -0,0 +1,50 @@
+__author__ = 'quentin'
+
+import unittest
+import cv2
+import numpy as np
+from ethoscope.core.roi import ROI
+from ethoscope.trackers.tube_tracker import TubeProjectionTracker
+
+
+class TestTubeProjectionTracker(unittest.TestCase):
+
+    def _track(self, vertical):
+        rng = np.random.RandomState(1)
+        length, width = 400, 40
+        roi = ROI(np.array([(0, 0), (length, 0), (length, width), (0, width)]), 1)
+        if vertical:
+            roi = ROI(np.array([(0, 0), (width, 0), (width, length), (0, length)]), 1)
+        tracker = TubeProjectionTracker(roi)
+        errors = []
+        for i in range(60):
+            x, y = 50 + 5 * i, 25
+            img = np.full((width + 1, length + 1, 3), 200, np.uint8)
+            img[5, :] = 120
+            cv2.ellipse(img, ((x, y), (16, 7), 0), (40, 40, 40), -1)
+            img = cv2.add(img, rng.randint(0, 6, img.shape).astype(np.uint8))
+            if vertical:
+                img = np.ascontiguousarray(np.transpose(img, (1, 0, 2)))
+                x, y = y, x
+            points = tracker.track(i * 100, img)
+            if i >= 10:
+                self.assertEqual(len(points), 1)
+                p = points[0]
+                self.assertEqual(p["is_inferred"], 0)
+                errors.append((abs(p["x"] - x), abs(p["y"] - y)))
+        errors = np.array(errors)
+        self.assertLessEqual(np.max(errors), 2)
+
+    def test_horizontal(self):
+        self._track(vertical=False)
+
+    def test_vertical(self):
+        self._track(vertical=True)
+
+    def test_empty_tube(self):
+        roi = ROI(np.array([(0, 0), (400, 0), (400, 40), (0, 40)]), 1)
+        tracker = TubeProjectionTracker(roi)
+        rng = np.random.RandomState(1)
+        for i in range(30):
+            img = cv2.add(np.full((41, 401, 3), 200, np.uint8), rng.randint(0, 6, (41, 401, 3)).astype(np.uint8))
+            self.assertEqual(tracker.track(i * 100, img), [])
@@ -1,7 +1,6 @@
 
 __author__ = 'quentin'
 
-from collections import deque
 from math import log10, sqrt, pi
 import cv2
 
@@ -16,6 +15,8 @@ from scipy import ndimage
 from ethoscope.core.variables import XPosVariable, YPosVariable, XYDistance, WidthVariable, HeightVariable, PhiVariable, Label
 from ethoscope.core.data_point import DataPoint
 from ethoscope.trackers.trackers import BaseTracker, NoPositionError
+from ethoscope.utils.img_proc import StreamingMedian
+from ethoscope.trackers.preprocessing import MinimalPreprocessor, LocalContrastPreprocessor
 
 import logging
 
@@ -54,6 +55,24 @@ class ObjectModel(object):
     def features_header(self):
         return self._features_header
 
+    def get_state(self):
+        """
+        :return: a copy of the history of features, to restore the model later
+        :rtype: dict
+        """
+        return {"ring_buff": np.copy(self._ring_buff),
+                "ring_buff_idx": self._ring_buff_idx,
+                "is_ready": self._is_ready}
+
+    def set_state(self, state):
+        if state["ring_buff"].shape != self._ring_buff.shape:
+            raise ValueError("The saved history does not match the size of this model")
+        self._ring_buff[:] = state["ring_buff"]
+        self._ring_buff_idx = state["ring_buff_idx"]
+        self._is_ready = state["is_ready"]
+        # the time of the last update is unknown. We do not want the model to be reset because of the restart itself
+        self._last_updated_time = None
+
 
     def update(self, img, contour,time):
         self._last_updated_time = time
@@ -69,6 +88,9 @@ class ObjectModel(object):
         return self._ring_buff[self._ring_buff_idx]
 
     def distance(self, features,time):
+        if self._last_updated_time is None:
+            self._last_updated_time = time
+
         if time - self._last_updated_time > self._max_unupdated_duration:
             logging.warning("FG model not updated for too long. Resetting.")
             self.__init__(self._history_length)
@@ -153,9 +175,11 @@ class ObjectModel(object):
 
 class BackgroundModel(object):
     """
-    A class to model background. It uses a dynamic running average and support arbitrary and heterogeneous frame rates
+    A class to model background. It uses a dynamic running average and support arbitrary and heterogeneous frame rates.
+    Before the running average starts, the background is bootstrapped as the median of the first few frames,
+    so that it does not contain the animal, and does not need minutes to converge.
     """
-    def __init__(self, max_half_life=100. * 1000, min_half_life=1.* 1000, increment = 1.2):
+    def __init__(self, max_half_life=100. * 1000, min_half_life=1.* 1000, increment = 1.2, n_bootstrap_frames=7):
         # the maximal half life of a pixel from background, in seconds
         self._max_half_life = float(max_half_life)
         # the minimal one
@@ -175,10 +199,56 @@ class BackgroundModel(object):
         # the time stamp of the frame las used to update
         self.last_t = 0
 
+        # a bootstrapped background is already robust, so we do not need to start with the fastest learning rate
+        self._bootstrapped_half_life = sqrt(self._min_half_life * self._max_half_life)
+        self._n_bootstrap_frames = n_bootstrap_frames
+        self._bootstrap = None
+        if self._n_bootstrap_frames > 1:
+            self._bootstrap = StreamingMedian(base=self._n_bootstrap_frames, max_levels=1)
+
+    @property
+    def is_bootstrapping(self):
+        return self._bootstrap is not None
+
     @property
     def bg_img(self):
         return self._bg_mean
 
+    def get_bg_uint8(self, out=None):
+        """
+        :param out: an optional ``uint8`` image to write the result into
+        :type out: :class:`~numpy.ndarray`
+        :return: The background, truncated to an 8 bit image
+        :rtype: :class:`~numpy.ndarray`
+        """
+        if out is None:
+            return self._bg_mean.astype(np.uint8)
+        np.copyto(out, self._bg_mean, casting="unsafe")
+        return out
+
+    def get_state(self):
+        """
+        :return: the background (as half precision floats, to save space), the current learning rate and
+            the time of the last update. The background is ``None`` if it is not built yet.
+        :rtype: dict
+        """
+        bg = None
+        if self._bg_mean is not None:
+            bg = self._bg_mean.astype(np.float16)
+        return {"bg": bg,
+                "current_half_life": self._current_half_life,
+                "last_t": self.last_t}
+
+    def set_state(self, state):
+        if state["bg"] is None:
+            return
+        self._bg_mean = state["bg"].astype(np.float32)
+        self._buff_alpha_matrix = None
+        self._buff_invert_alpha_mat = None
+        self._bootstrap = None
+        self._current_half_life = state["current_half_life"]
+        self.last_t = state["last_t"]
+
     def increase_learning_rate(self):
         self._current_half_life  /=  self._increment
 
@@ -196,14 +266,21 @@ class BackgroundModel(object):
         self._current_half_life = np.clip(self._current_half_life, self._min_half_life, self._max_half_life)
 
         # ensure preallocated buffers exist. otherwise, initialise them
+        if self._bg_mean is None and self._bootstrap is not None:
+            self._bootstrap.update(img_t)
+            self.last_t = t
+            if self._bootstrap.n < self._n_bootstrap_frames:
+                return
+            self._set_background(self._bootstrap.get())
+            self._current_half_life = self._bootstrapped_half_life
+            self._bootstrap = None
+            return
+
         if self._bg_mean is None:
-            self._bg_mean = img_t.astype(np.float32)
+            self._set_background(img_t)
             # self._bg_sd = np.zeros_like(img_t)
             # self._bg_sd.fill(128)
 
-        if self._buff_alpha_matrix is None:
-            self._buff_alpha_matrix = np.ones_like(img_t,dtype = np.float32)
-
         # the learning rate, alpha, is an exponential function of half life
         # it correspond to how much the present frame should account for the background
 
@@ -211,6 +288,16 @@ class BackgroundModel(object):
         # how much the current frame should be accounted for
         alpha = 1 - np.exp(-lam * dt)
 
+        self._accumulate(img_t, alpha, fg_mask)
+        self.last_t = t
+
+    def _set_background(self, img):
+        self._bg_mean = img.astype(np.float32)
+
+    def _accumulate(self, img_t, alpha, fg_mask):
+        if self._buff_alpha_matrix is None:
+            self._buff_alpha_matrix = np.ones_like(img_t,dtype = np.float32)
+
         # set-p a matrix of learning rate. it is 0 where foreground map is true
         self._buff_alpha_matrix.fill(alpha)
         if fg_mask is not None:
@@ -227,135 +314,82 @@ class BackgroundModel(object):
         np.multiply(self._buff_invert_alpha_mat, self._bg_mean, self._buff_invert_alpha_mat)
         np.add(self._buff_alpha_matrix, self._buff_invert_alpha_mat, self._bg_mean)
 
-        self.last_t = t
-
 
 class AdaptiveBGModel(BaseTracker):
     _description = {"overview": "The default tracker for fruit flies. One animal per ROI.",
-                    "arguments": []}
+                    "arguments": [
+                        {"type": "str", "name": "preprocessing", "description": "The preprocessing of images: 'minimal' (default) or 'local_contrast' (for uneven illumination)", "default": "minimal"}
+                    ]}
 
     fg_model = ObjectModel()
 
-    def __init__(self, roi, data=None):
+    # the available preprocessing methods, by name
+    _preprocessors = {"minimal": MinimalPreprocessor,
+                      "local_contrast": LocalContrastPreprocessor}
+
+    def __init__(self, roi, data=None, preprocessing="minimal"):
         """
         An adaptive background subtraction model to find position of one animal in one roi.
 
         TODO more description here
         :param roi:
         :param data:
+        :param preprocessing: The name of the preprocessing method: "minimal"
+            (see :class:`~ethoscope.trackers.preprocessing.MinimalPreprocessor`) or "local_contrast"
+            (see :class:`~ethoscope.trackers.preprocessing.LocalContrastPreprocessor`)
+        :type preprocessing: str
         :return:
         """
         self._previous_shape=None
         self._object_expected_size = 0.05 # proportion of the roi main axis
         self._max_area = (5 * self._object_expected_size) ** 2
 
-        self._smooth_mode = deque()
-        self._smooth_mode_tstamp = deque()
-        self._smooth_mode_window_dt = 30 * 1000 #miliseconds
-
+        if preprocessing not in self._preprocessors:
+            raise ValueError("Unknown preprocessing method: '%s'. Available: %s" % (preprocessing, sorted(self._preprocessors.keys())))
+        self._preprocessor = self._make_preprocessor(self._preprocessors[preprocessing])
 
         self._bg_model = BackgroundModel()
         self._max_m_log_lik = 6.
-        self._buff_grey = None
         self._buff_object = None
         self._buff_object_old = None
-        self._buff_grey_blurred = None
         self._buff_fg = None
-        self._buff_convolved_mask = None
+        self._buff_bg = None
         self._buff_fg_backup = None
         self._buff_fg_diff = None
         self._old_sum_fg = 0
+        self._old_pos = 0.0 +0.0j
 
         super(AdaptiveBGModel, self).__init__(roi, data)
 
-    def _pre_process_input_minimal(self, img, mask, t, darker_fg=True):
-        blur_rad = int(self._object_expected_size * np.max(img.shape) / 2.0)
-
-        if blur_rad % 2 == 0:
-            blur_rad += 1
+    def _make_preprocessor(self, preprocessor_class):
+        return preprocessor_class(self._object_expected_size)
 
-        if self._buff_grey is None:
-            self._buff_grey = cv2.cvtColor(img,cv2.COLOR_BGR2GRAY)
-            if mask is None:
-                mask = np.ones_like(self._buff_grey) * 255
+    def _mask_changed(self):
+        self._preprocessor.mask_changed()
 
-        cv2.cvtColor(img,cv2.COLOR_BGR2GRAY, self._buff_grey)
-        # cv2.imshow("dbg",self._buff_grey)
-        cv2.GaussianBlur(self._buff_grey,(blur_rad,blur_rad),1.2, self._buff_grey)
-        if darker_fg:
-            cv2.subtract(255, self._buff_grey, self._buff_grey)
-
-        #
-        mean = cv2.mean(self._buff_grey, mask)
+    @classmethod
+    def get_shared_state(cls):
+        # the model of the animal is learnt from, and used by, all ROIs
+        return {"fg_model": cls.fg_model.get_state()}
 
-        scale = 128. / mean[0]
+    @classmethod
+    def set_shared_state(cls, state):
+        cls.fg_model.set_state(state["fg_model"])
 
-        cv2.multiply(self._buff_grey, scale, dst = self._buff_grey)
-
-
-        if mask is not None:
-            cv2.bitwise_and(self._buff_grey, mask, self._buff_grey)
-            return self._buff_grey
-
-    def _pre_process_input(self, img, mask, t):
-
-        blur_rad = int(self._object_expected_size * np.max(img.shape) * 2.0)
-        if blur_rad % 2 == 0:
-            blur_rad += 1
-
-
-        if self._buff_grey is None:
-            self._buff_grey = cv2.cvtColor(img,cv2.COLOR_BGR2GRAY)
-            self._buff_grey_blurred = np.empty_like(self._buff_grey)
-            # self._buff_grey_blurred = np.empty_like(self._buff_grey)
-            if mask is None:
-                mask = np.ones_like(self._buff_grey) * 255
-
-            mask_conv = cv2.blur(mask,(blur_rad, blur_rad))
-
-            self._buff_convolved_mask  = (1/255.0 *  mask_conv.astype(np.float32))
-
-
-        cv2.cvtColor(img,cv2.COLOR_BGR2GRAY, self._buff_grey)
-
-        hist = cv2.calcHist([self._buff_grey], [0], None, [256], [0,255]).ravel()
-        hist = np.convolve(hist, [1] * 3)
-        mode =  np.argmax(hist)
-
-        self._smooth_mode.append(mode)
-        self._smooth_mode_tstamp.append(t)
-
-        if len(self._smooth_mode_tstamp) >2 and self._smooth_mode_tstamp[-1] - self._smooth_mode_tstamp[0] > self._smooth_mode_window_dt:
-            self._smooth_mode.popleft()
-            self._smooth_mode_tstamp.popleft()
-
-
-        mode = np.mean(list(self._smooth_mode))
-        scale = 128. / mode
-
-        # cv2.GaussianBlur(self._buff_grey,(5,5), 1.5,self._buff_grey)
-
-        cv2.multiply(self._buff_grey, scale, dst = self._buff_grey)
-
-
-        cv2.bitwise_and(self._buff_grey, mask, self._buff_grey)
-
-        cv2.blur(self._buff_grey,(blur_rad, blur_rad), self._buff_grey_blurred)
-        #fixme could be optimised
-        self._buff_grey_blurred = (self._buff_grey_blurred / self._buff_convolved_mask).astype(np.uint8)
-
-
-        cv2.absdiff(self._buff_grey, self._buff_grey_blurred, self._buff_grey)
-
-        if mask is not None:
-            cv2.bitwise_and(self._buff_grey, mask, self._buff_grey)
-            return self._buff_grey
+    def get_state(self):
+        state = super(AdaptiveBGModel, self).get_state()
+        state["bg_model"] = self._bg_model.get_state()
+        state["old_pos"] = self._old_pos
+        return state
 
+    def set_state(self, state):
+        super(AdaptiveBGModel, self).set_state(state)
+        self._bg_model.set_state(state["bg_model"])
+        self._old_pos = state["old_pos"]
 
     def _find_position(self, img, mask,t):
 
-        grey = self._pre_process_input_minimal(img, mask, t)
-        # grey = self._pre_process_input(img, mask, t)
+        grey = self._preprocessor.apply(img, mask, t)
         try:
             return self._track(img, grey, mask, t)
         except NoPositionError:
@@ -363,18 +397,36 @@ class AdaptiveBGModel(BaseTracker):
             raise NoPositionError
 
 
+    def _select_near_prediction(self, contours):
+        # when a motion model predicts where the animal is, blobs elsewhere are ignored, if any blob is there
+        region = self.search_region()
+        if region is None:
+            return contours
+        x0, y0, w, h = region
+        near = []
+        for c in contours:
+            cx, cy, cw, ch = cv2.boundingRect(c)
+            if x0 <= cx + cw / 2.0 < x0 + w and y0 <= cy + ch / 2.0 < y0 + h:
+                near.append(c)
+        if len(near) == 0:
+            return contours
+        return near
+
     def _track(self, img,  grey, mask,t):
 
-        if self._bg_model.bg_img is None:
+        if self._buff_fg is None:
             self._buff_fg = np.empty_like(grey)
+            self._buff_bg = np.empty_like(grey)
             self._buff_object= np.empty_like(grey)
             self._buff_fg_backup = np.empty_like(grey)
   #          self._buff_fg_diff = np.empty_like(grey)
-            self._old_pos = 0.0 +0.0j
    #         self._old_sum_fg = 0
+
+        if self._bg_model.bg_img is None:
+            self._old_pos = 0.0 +0.0j
             raise NoPositionError
 
-        bg = self._bg_model.bg_img.astype(np.uint8)
+        bg = self._bg_model.get_bg_uint8(self._buff_bg)
         cv2.subtract(grey, bg, self._buff_fg)
 
         cv2.threshold(self._buff_fg,20,255,cv2.THRESH_TOZERO, dst=self._buff_fg)
@@ -382,7 +434,7 @@ class AdaptiveBGModel(BaseTracker):
         # cv2.bitwise_and(self._buff_fg_backup,self._buff_fg,dst=self._buff_fg_diff)
         # sum_fg = cv2.countNonZero(self._buff_fg)
 
-        self._buff_fg_backup = np.copy(self._buff_fg)
+        np.copyto(self._buff_fg_backup, self._buff_fg)
 
         n_fg_pix = np.count_nonzero(self._buff_fg)
         prop_fg_pix  = n_fg_pix / (1.0 * grey.shape[0] * grey.shape[1])
@@ -406,6 +458,9 @@ class AdaptiveBGModel(BaseTracker):
 
         contours = [cv2.approxPolyDP(c,1.2,True) for c in contours]
 
+        if len(contours) > 1:
+            contours = self._select_near_prediction(contours)
+
         if len(contours) == 0:
             self._bg_model.increase_learning_rate()
             raise NoPositionError
@@ -0,0 +1,272 @@
+"""
+Frame-to-frame assignment of detections to animal identities, for trackers that monitor several animals per ROI.
+
+The :class:`~ethoscope.trackers.assignment.MultiAnimalAssigner` keeps one track per animal.
+For each frame, it:
+
+1. Gates candidate (track, detection) pairs using a spatial hash grid, so only nearby pairs are considered.
+2. Splits the gated pairs into independent clusters (connected components).
+3. Solves an optimal (minimal total distance) assignment for each cluster.
+4. Creates tracks for unmatched detections (birth) and removes tracks that have not been matched for too long (death).
+"""
+
+__author__ = 'quentin'
+
+from collections import defaultdict
+import numpy as np
+
+try:
+    from scipy.optimize import linear_sum_assignment
+except ImportError:
+    linear_sum_assignment = None
+
+
+def _hungarian(cost):
+    """
+    Minimal cost assignment on a dense rectangular matrix (O(n^3) shortest augmenting path).
+    This is used when scipy does not provide ``linear_sum_assignment``.
+
+    :param cost: a ``n x m`` cost matrix
+    :type cost: :class:`~numpy.ndarray`
+    :return: the row and column indices of the assigned pairs
+    :rtype: (:class:`~numpy.ndarray`, :class:`~numpy.ndarray`)
+    """
+    transposed = cost.shape[0] > cost.shape[1]
+    a = cost.T if transposed else cost
+    n, m = a.shape
+    inf = float("inf")
+    u = [0.0] * (n + 1)
+    v = [0.0] * (m + 1)
+    p = [0] * (m + 1)
+    way = [0] * (m + 1)
+    for i in range(1, n + 1):
+        p[0] = i
+        j0 = 0
+        minv = [inf] * (m + 1)
+        used = [False] * (m + 1)
+        while True:
+            used[j0] = True
+            i0 = p[j0]
+            delta = inf
+            j1 = 0
+            for j in range(1, m + 1):
+                if not used[j]:
+                    cur = a[i0 - 1, j - 1] - u[i0] - v[j]
+                    if cur < minv[j]:
+                        minv[j] = cur
+                        way[j] = j0
+                    if minv[j] < delta:
+                        delta = minv[j]
+                        j1 = j
+            for j in range(m + 1):
+                if used[j]:
+                    u[p[j]] += delta
+                    v[j] -= delta
+                else:
+                    minv[j] -= delta
+            j0 = j1
+            if p[j0] == 0:
+                break
+        while True:
+            j1 = way[j0]
+            p[j0] = p[j1]
+            j0 = j1
+            if j0 == 0:
+                break
+
+    rows = np.array([p[j] - 1 for j in range(1, m + 1) if p[j] != 0], dtype=np.int64)
+    cols = np.array([j - 1 for j in range(1, m + 1) if p[j] != 0], dtype=np.int64)
+    if transposed:
+        rows, cols = cols, rows
+    order = np.argsort(rows)
+    return rows[order], cols[order]
+
+
+def optimal_assignment(cost):
+    """
+    Solve the linear assignment problem on a dense cost matrix.
+
+    :param cost: a ``n x m`` cost matrix
+    :type cost: :class:`~numpy.ndarray`
+    :return: the row and column indices of the assigned pairs
+    :rtype: (:class:`~numpy.ndarray`, :class:`~numpy.ndarray`)
+    """
+    if cost.size == 0:
+        return np.zeros(0, np.int64), np.zeros(0, np.int64)
+    if linear_sum_assignment is not None:
+        return linear_sum_assignment(cost)
+    return _hungarian(cost)
+
+
+class SpatialGrid(object):
+    def __init__(self, points, cell_size):
+        """
+        A spatial hash grid, to find all points within a given distance of a query point, without testing all pairs.
+
+        :param points: a ``n x 2`` array of coordinates
+        :type points: :class:`~numpy.ndarray`
+        :param cell_size: the size of the grid cells. Queries are exact for distances up to this size.
+        :type cell_size: float
+        """
+        self._points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        self._cell_size = float(cell_size)
+        self._cells = defaultdict(list)
+        keys = np.floor(self._points / self._cell_size).astype(np.int64)
+        for i, (cx, cy) in enumerate(keys):
+            self._cells[(cx, cy)].append(i)
+
+    def neighbours(self, point, max_distance):
+        """
+        :param point: the query coordinates (x, y)
+        :param max_distance: the gating distance. It must not exceed the cell size.
+        :return: the indices of the points within ``max_distance`` of ``point``, and their distances
+        :rtype: (list(int), list(float))
+        """
+        cx, cy = int(np.floor(point[0] / self._cell_size)), int(np.floor(point[1] / self._cell_size))
+        idx, dists = [], []
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for i in self._cells.get((cx + dx, cy + dy), ()):
+                    px, py = self._points[i]
+                    d = ((px - point[0]) ** 2 + (py - point[1]) ** 2) ** 0.5
+                    if d <= max_distance:
+                        idx.append(i)
+                        dists.append(d)
+        return idx, dists
+
+
+class MultiAnimalAssigner(object):
+    def __init__(self, max_distance, max_unmatched_duration=10 * 1000):
+        """
+        Maintains the identity of several animals across frames.
+        Identities are small integers, starting at 0. When an animal is lost for longer than ``max_unmatched_duration``,
+        its identity is freed, and will be given to the next new track, so labels stay bounded by the number of animals.
+
+        :param max_distance: the maximal distance an animal can move between two consecutive observations (gating).
+        :type max_distance: float
+        :param max_unmatched_duration: how long (in ms) a track is kept without any matching detection.
+        :type max_unmatched_duration: int
+        """
+        self._max_distance = float(max_distance)
+        self._max_unmatched_duration = max_unmatched_duration
+        self._labels = np.zeros(0, np.int64)
+        self._positions = np.zeros((0, 2), np.float64)
+        self._velocities = np.zeros((0, 2), np.float64)
+        self._last_seen = np.zeros(0, np.float64)
+        self._last_t = None
+
+    @property
+    def n_tracks(self):
+        return len(self._labels)
+
+    def _predict(self, t):
+        out = np.copy(self._positions)
+        if self._last_t is None:
+            return out
+        # we only extrapolate tracks that were seen in the previous frame
+        fresh = self._last_seen == self._last_t
+        out[fresh] += self._velocities[fresh] * float(t - self._last_t)
+        return out
+
+    def _clusters(self, n_tracks, n_dets, edges):
+        # union find over tracks (0..n_tracks-1) and detections (n_tracks..)
+        parent = range(n_tracks + n_dets)
+
+        def find(a):
+            while parent[a] != a:
+                parent[a] = parent[parent[a]]
+                a = parent[a]
+            return a
+
+        for ti, di, _ in edges:
+            ra, rb = find(ti), find(n_tracks + di)
+            if ra != rb:
+                parent[ra] = rb
+
+        out = defaultdict(list)
+        for e in edges:
+            out[find(e[0])].append(e)
+        return out.values()
+
+    def assign(self, positions, t):
+        """
+        Assign identities to detections.
+
+        :param positions: a ``n x 2`` array with the (x, y) coordinates of the detections in this frame.
+        :type positions: :class:`~numpy.ndarray`
+        :param t: the time of the frame, in ms
+        :type t: int
+        :return: The identity (label) of each detection, and the distance each animal moved since its last observation
+            (0 for new tracks).
+        :rtype: (:class:`~numpy.ndarray`, :class:`~numpy.ndarray`)
+        """
+        positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+        n_dets = len(positions)
+        n_tracks = len(self._labels)
+        det_track = np.full(n_dets, -1, np.int64)
+
+        if n_tracks > 0 and n_dets > 0:
+            predicted = self._predict(t)
+            grid = SpatialGrid(predicted, self._max_distance)
+            edges = []
+            for di, p in enumerate(positions):
+                idx, dists = grid.neighbours(p, self._max_distance)
+                edges.extend((ti, di, d) for ti, d in zip(idx, dists))
+
+            # each cluster is an independent (and generally tiny) assignment problem
+            for cluster in self._clusters(n_tracks, n_dets, edges):
+                tracks = sorted({e[0] for e in cluster})
+                dets = sorted({e[1] for e in cluster})
+                t_pos = {k: i for i, k in enumerate(tracks)}
+                d_pos = {k: i for i, k in enumerate(dets)}
+                # non-gated pairs get a cost so high they are only used if nothing else is possible, and then discarded
+                forbidden = self._max_distance * (len(cluster) + 1) * 10
+                cost = np.full((len(tracks), len(dets)), forbidden)
+                for ti, di, d in cluster:
+                    cost[t_pos[ti], d_pos[di]] = d
+                rows, cols = optimal_assignment(cost)
+                for r, c in zip(rows, cols):
+                    if cost[r, c] < forbidden:
+                        det_track[dets[c]] = tracks[r]
+
+        distances = np.zeros(n_dets, np.float64)
+        matched = det_track >= 0
+        if np.any(matched):
+            ti = det_track[matched]
+            distances[matched] = np.sqrt(np.sum((positions[matched] - self._positions[ti]) ** 2, 1))
+            dt = (t - self._last_seen[ti]).reshape(-1, 1)
+            dt[dt <= 0] = 1
+            self._velocities[ti] = (positions[matched] - self._positions[ti]) / dt
+            self._positions[ti] = positions[matched]
+            self._last_seen[ti] = t
+
+        # death of tracks not seen for too long
+        alive = (t - self._last_seen) <= self._max_unmatched_duration
+        if not np.all(alive):
+            remap = np.full(n_tracks, -1, np.int64)
+            remap[alive] = np.arange(np.count_nonzero(alive))
+            det_track[matched] = remap[det_track[matched]]
+            self._labels = self._labels[alive]
+            self._positions = self._positions[alive]
+            self._velocities = self._velocities[alive]
+            self._last_seen = self._last_seen[alive]
+
+        # birth of new tracks, using the smallest free labels
+        unmatched = np.where(det_track < 0)[0]
+        if len(unmatched) > 0:
+            used = set(self._labels.tolist())
+            new_labels = []
+            label = 0
+            while len(new_labels) < len(unmatched):
+                if label not in used:
+                    new_labels.append(label)
+                label += 1
+            start = len(self._labels)
+            det_track[unmatched] = np.arange(start, start + len(unmatched))
+            self._labels = np.append(self._labels, new_labels)
+            self._positions = np.vstack([self._positions, positions[unmatched]])
+            self._velocities = np.vstack([self._velocities, np.zeros((len(unmatched), 2))])
+            self._last_seen = np.append(self._last_seen, np.full(len(unmatched), t, np.float64))
+
+        self._last_t = t
+        return self._labels[det_track], distances
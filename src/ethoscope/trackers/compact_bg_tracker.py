@@ -0,0 +1,160 @@
+__author__ = 'quentin'
+
+import cv2
+import numpy as np
+
+from ethoscope.trackers.adaptive_bg_tracker import AdaptiveBGModel, BackgroundModel
+from ethoscope.trackers.trackers import _owned_nbytes
+
+
+class BufferPool(object):
+    def __init__(self):
+        """
+        Scratch images shared by several objects (e.g. the trackers of all ROIs).
+        Each named buffer is allocated once, at the largest size requested so far, and handed out as views.
+        This is only valid for data that does not need to persist between two uses,
+        and when users are not running concurrently (as tracking units are, within a monitor).
+        """
+        self._buffers = {}
+        self._noise = np.zeros(0, np.float32)
+
+    def get(self, name, shape, dtype):
+        """
+        :param name: the name of the buffer. Different names never share memory.
+        :type name: str
+        :param shape: the shape of the requested image
+        :type shape: tuple
+        :param dtype: the type of the requested image
+        :return: an uninitialised, contiguous, image
+        :rtype: :class:`~numpy.ndarray`
+        """
+        dtype = np.dtype(dtype)
+        n_bytes = int(np.prod(shape)) * dtype.itemsize
+        buff = self._buffers.get(name)
+        if buff is None or buff.size < n_bytes:
+            buff = np.empty(n_bytes, np.uint8)
+            self._buffers[name] = buff
+        return buff[:n_bytes].view(dtype).reshape(shape)
+
+    def get_uniform_noise(self, shape, n_offsets=4096):
+        """
+        Random numbers, uniformly distributed in [0, 1).
+        They are generated once, and a view at a random offset is returned,
+        which is much faster than generating new numbers at every call.
+
+        :param shape: the shape of the requested image
+        :type shape: tuple
+        :param n_offsets: the number of different possible offsets
+        :type n_offsets: int
+        :return: a ``float32`` image that must not be modified
+        :rtype: :class:`~numpy.ndarray`
+        """
+        n = int(np.prod(shape))
+        if self._noise.size < n + n_offsets:
+            self._noise = np.random.uniform(0, 1, n + n_offsets).astype(np.float32)
+        offset = np.random.randint(n_offsets)
+        return self._noise[offset:offset + n].reshape(shape)
+
+    @property
+    def nbytes(self):
+        """
+        :return: the memory used by all buffers, in bytes
+        :rtype: int
+        """
+        return sum(b.nbytes for b in self._buffers.values()) + self._noise.nbytes
+
+
+class CompactBackgroundModel(BackgroundModel):
+    def __init__(self, pool, *args, **kwargs):
+        """
+        A :class:`~ethoscope.trackers.adaptive_bg_tracker.BackgroundModel` that keeps its background as a ``uint16``
+        fixed point image (8 fractional bits) instead of ``float32``, and no per-object learning rate matrices.
+        The running average is computed, in a scratch buffer shared through ``pool``, by ``cv2.accumulateWeighted``,
+        which skips foreground pixels through its mask.
+        When converting back to fixed point, values are rounded stochastically, so that small updates
+        (i.e. slow learning rates) are not systematically rounded away.
+
+        :param pool: the pool providing scratch buffers
+        :type pool: :class:`~ethoscope.trackers.compact_bg_tracker.BufferPool`
+        """
+        self._pool = pool
+        super(CompactBackgroundModel, self).__init__(*args, **kwargs)
+
+    def _set_background(self, img):
+        self._bg_mean = img.astype(np.uint16) << 8
+
+    def _accumulate(self, img_t, alpha, fg_mask):
+        bg_float = self._pool.get("bg_float", img_t.shape, np.float32)
+        np.multiply(self._bg_mean, np.float32(1 / 256.), bg_float)
+
+        mask = None
+        if fg_mask is not None:
+            cv2.dilate(fg_mask, None, fg_mask)
+            mask = self._pool.get("bg_mask", img_t.shape, np.uint8)
+            cv2.bitwise_not(fg_mask, mask)
+        cv2.accumulateWeighted(img_t, bg_float, alpha, mask=mask)
+
+        noise = self._pool.get_uniform_noise(img_t.shape)
+        cv2.scaleAdd(bg_float, 256., noise, bg_float)
+        # truncation of positive values, after adding noise, is an unbiased rounding
+        np.copyto(self._bg_mean, bg_float, casting="unsafe")
+
+    def get_bg_uint8(self, out=None):
+        if out is None:
+            out = np.empty(self._bg_mean.shape, np.uint8)
+        np.right_shift(self._bg_mean, 8, out=out, casting="unsafe")
+        return out
+
+    def get_state(self):
+        state = super(CompactBackgroundModel, self).get_state()
+        if self._bg_mean is not None:
+            state["bg"] = (self._bg_mean / 256.).astype(np.float16)
+        return state
+
+    def set_state(self, state):
+        super(CompactBackgroundModel, self).set_state(state)
+        if state["bg"] is not None:
+            self._bg_mean = np.round(state["bg"].astype(np.float32) * 256).astype(np.uint16)
+
+
+class CompactAdaptiveBGModel(AdaptiveBGModel):
+    _description = {"overview": "The default tracker for fruit flies, using less memory (for many or large ROIs). One animal per ROI.",
+                    "arguments": [
+                        {"type": "str", "name": "preprocessing", "description": "The preprocessing of images: 'minimal' (default) or 'local_contrast' (for uneven illumination)", "default": "minimal"}
+                    ]}
+
+    # scratch images are shared by the trackers of all ROIs
+    pool = BufferPool()
+
+    def __init__(self, roi, data=None, preprocessing="minimal"):
+        """
+        The same algorithm as :class:`~ethoscope.trackers.adaptive_bg_tracker.AdaptiveBGModel`,
+        with a memory-compact configuration: the background is a ``uint16`` image
+        (see :class:`~ethoscope.trackers.compact_bg_tracker.CompactBackgroundModel`) and all the images that are only
+        needed whilst processing a frame are shared between ROIs
+        (see :class:`~ethoscope.trackers.compact_bg_tracker.BufferPool`).
+        The only image each tracker owns is therefore its background, 2 bytes per pixel, instead of about 17.
+
+        :param roi:
+        :param data:
+        """
+        super(CompactAdaptiveBGModel, self).__init__(roi, data, preprocessing)
+        self._bg_model = CompactBackgroundModel(self.pool)
+
+    def _make_preprocessor(self, preprocessor_class):
+        return preprocessor_class(self._object_expected_size, pool=self.pool)
+
+    def _find_position(self, img, mask, t):
+        shape = img.shape[0:2]
+        self._buff_fg = self.pool.get("fg", shape, np.uint8)
+        self._buff_bg = self.pool.get("bg", shape, np.uint8)
+        self._buff_object = self.pool.get("object", shape, np.uint8)
+        self._buff_fg_backup = self.pool.get("fg_backup", shape, np.uint8)
+        return super(CompactAdaptiveBGModel, self)._find_position(img, mask, t)
+
+    def _owned_memory(self):
+        # the pool is accounted for in the shared footprint
+        return _owned_nbytes(self, {id(self._roi), id(self._roi.mask()), id(self._motion_model), id(self.pool)})
+
+    def _shared_memory(self):
+        return self.pool.nbytes
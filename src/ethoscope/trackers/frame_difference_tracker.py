@@ -0,0 +1,174 @@
+__author__ = 'quentin'
+
+from math import log10, atan2, degrees, sqrt
+import cv2
+import numpy as np
+
+from ethoscope.core.variables import XPosVariable, YPosVariable, XYDistance, WidthVariable, HeightVariable, PhiVariable
+from ethoscope.core.data_point import DataPoint
+from ethoscope.trackers.trackers import BaseTracker, NoPositionError
+
+
+class FrameDifferenceTracker(BaseTracker):
+    _description = {"overview": "A cheap tracker for high frame rates (e.g. 60 fps and above). One animal per ROI.",
+                    "arguments": []}
+
+    def __init__(self, roi, data=None, threshold=20, motion_threshold=15, half_life=10 * 1000,
+                 min_area=4, max_fg_prop=0.25):
+        """
+        A tracker meant for high frame rates, where each frame must be processed in a fraction of the time
+        :class:`~ethoscope.trackers.adaptive_bg_tracker.AdaptiveBGModel` takes.
+        There are no contours, and no model of the animal. At each frame:
+
+         * Pixels darker than a slow background reference, by more than ``threshold``, are foreground.
+         * The animal is located from the moments of the foreground (centroid, then size and orientation),
+           refined once within a window around the first centroid, to ignore isolated noisy pixels.
+         * The background is updated (running average, with a half-life of ``half_life``), except around the animal,
+           and where the difference with the previous frame shows motion.
+           The latter prevents moving animals from being learnt, even before the background reference is clean.
+
+        :param roi: The Region Of Interest the the tracker will use to locate the animal.
+        :type roi: :class:`~ethoscope.rois.roi_builders.ROI`
+        :param data: An optional data set. Not used.
+        :param threshold: The minimal difference with the background, in grey levels, for a pixel to be foreground
+        :type threshold: int
+        :param motion_threshold: The minimal difference between consecutive frames, in grey levels, considered as motion
+        :type motion_threshold: int
+        :param half_life: The half-life of the background, in ms
+        :type half_life: int
+        :param min_area: The minimal number of foreground pixels for an animal to be detected
+        :type min_area: int
+        :param max_fg_prop: the maximal proportion of the ROI that can be foreground.
+            Above, the frame is considered as a global change (e.g. of illumination), and the background is relearnt.
+        :type max_fg_prop: float
+        """
+        self._threshold = threshold
+        self._motion_threshold = motion_threshold
+        self._half_life = half_life
+        self._min_area = min_area
+        self._max_fg_prop = max_fg_prop
+
+        self._bg = None
+        # the number of frames averaged in the background, whilst it is bootstrapped as a plain mean
+        self._n_bg_frames = 0
+        self._last_bg_t = None
+        self._buff_grey = None
+        self._buff_previous = None
+        self._buff_bg = None
+        self._buff_fg = None
+        self._buff_learn = None
+        self._old_pos = 0.0 + 0.0j
+        super(FrameDifferenceTracker, self).__init__(roi, data)
+
+    def get_state(self):
+        state = super(FrameDifferenceTracker, self).get_state()
+        state["bg"] = self._bg.astype(np.float16) if self._bg is not None else None
+        state["n_bg_frames"] = self._n_bg_frames
+        state["last_bg_t"] = self._last_bg_t
+        state["old_pos"] = self._old_pos
+        return state
+
+    def set_state(self, state):
+        super(FrameDifferenceTracker, self).set_state(state)
+        self._bg = state["bg"].astype(np.float32) if state["bg"] is not None else None
+        self._n_bg_frames = state["n_bg_frames"]
+        self._last_bg_t = state["last_bg_t"]
+        self._old_pos = state["old_pos"]
+
+    def _init_buffers(self, img):
+        shape = img.shape[0:2]
+        self._buff_grey = np.empty(shape, np.uint8)
+        self._buff_previous = np.empty(shape, np.uint8)
+        self._buff_bg = np.empty(shape, np.uint8)
+        self._buff_fg = np.empty(shape, np.uint8)
+        self._buff_learn = np.empty(shape, np.uint8)
+
+    def _find_position(self, img, mask, t):
+        if self._buff_grey is None:
+            self._init_buffers(img)
+        else:
+            self._buff_grey, self._buff_previous = self._buff_previous, self._buff_grey
+
+        grey = self._buff_grey
+        cv2.cvtColor(img, cv2.COLOR_BGR2GRAY, grey)
+        cv2.bitwise_and(grey, mask, grey)
+
+        if self._bg is None:
+            self._bg = grey.astype(np.float32)
+            self._n_bg_frames = 1
+            self._last_bg_t = t
+            raise NoPositionError
+
+        # pixels that did not move since the previous frame can be learnt
+        cv2.absdiff(grey, self._buff_previous, self._buff_learn)
+        cv2.threshold(self._buff_learn, self._motion_threshold, 255, cv2.THRESH_BINARY_INV, dst=self._buff_learn)
+
+        try:
+            return self._track(grey, mask, t)
+        finally:
+            self._update_bg(grey, t)
+
+    def _track(self, grey, mask, t):
+        cv2.convertScaleAbs(self._bg, self._buff_bg)
+        cv2.subtract(self._buff_bg, grey, self._buff_fg)
+        cv2.threshold(self._buff_fg, self._threshold, 255, cv2.THRESH_BINARY, dst=self._buff_fg)
+
+        moments = cv2.moments(self._buff_fg, True)
+        area = moments["m00"]
+        if area < self._min_area:
+            raise NoPositionError
+
+        if area > self._max_fg_prop * cv2.countNonZero(mask):
+            # a global change: the background is relearnt from scratch
+            self._n_bg_frames = 0
+            raise NoPositionError
+
+        x, y, w, h, angle = self._ellipse(moments)
+        # the same, within a window around the animal only
+        half_size = int(max(w, h)) + 1
+        x0, y0 = max(int(x) - half_size, 0), max(int(y) - half_size, 0)
+        window = self._buff_fg[y0: int(y) + half_size + 1, x0: int(x) + half_size + 1]
+        moments = cv2.moments(window, True)
+        if moments["m00"] < self._min_area:
+            raise NoPositionError
+        x, y, w, h, angle = self._ellipse(moments)
+        x, y = x + x0, y + y0
+
+        # the animal, and its surroundings, is not learnt
+        half_size = int(max(w, h)) + 1
+        self._buff_learn[max(int(y) - half_size, 0): int(y) + half_size + 1,
+                         max(int(x) - half_size, 0): int(x) + half_size + 1] = 0
+
+        w_im = max(grey.shape)
+        pos = (x + 1.0j * y) / w_im
+        xy_dist = round(log10(1. / float(w_im) + abs(pos - self._old_pos)) * 1000)
+        self._old_pos = pos
+
+        out = DataPoint([XPosVariable(int(round(x))),
+                         YPosVariable(int(round(y))),
+                         WidthVariable(int(round(w))),
+                         HeightVariable(int(round(h))),
+                         PhiVariable(int(round(angle))),
+                         XYDistance(int(xy_dist))])
+        return [out]
+
+    @staticmethod
+    def _ellipse(moments):
+        # the centre, axes and orientation of the ellipse with the same first and second moments as the foreground
+        m00 = moments["m00"]
+        x, y = moments["m10"] / m00, moments["m01"] / m00
+        a, b, c = moments["mu20"] / m00, moments["mu11"] / m00, moments["mu02"] / m00
+        delta = sqrt(4 * b ** 2 + (a - c) ** 2)
+        # for a uniform ellipse, the variance along an axis is a quarter of the square of its half length
+        w = 4 * sqrt(max((a + c + delta) / 2, 0))
+        h = 4 * sqrt(max((a + c - delta) / 2, 0))
+        angle = degrees(0.5 * atan2(2 * b, a - c)) % 180
+        return x, y, w, h, angle
+
+    def _update_bg(self, grey, t):
+        dt = t - self._last_bg_t
+        self._last_bg_t = t
+        self._n_bg_frames += 1
+        # a plain mean of the first frames, then an exponential running average
+        alpha = max(1 - 0.5 ** (dt / float(self._half_life)), 1.0 / self._n_bg_frames)
+        cv2.accumulateWeighted(grey, self._bg, alpha, mask=self._buff_learn)
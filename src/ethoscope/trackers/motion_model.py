@@ -0,0 +1,157 @@
+__author__ = 'quentin'
+
+from math import exp
+import numpy as np
+
+
+class KalmanMotionBank(object):
+    def __init__(self, speed_sd=20.0, velocity_tau=1.0, measurement_sd=2.0):
+        """
+        Kalman filters predicting the position of one animal per ROI, all stored in a single set of arrays,
+        so that predicting (or correcting) all ROIs is one vectorised operation per frame, rather than one per ROI.
+
+        The state of each animal is its position and velocity, in pixels, within its ROI.
+        Velocities follow a constant velocity model, where the velocity reverts to zero
+        with a time constant ``velocity_tau`` (an Ornstein-Uhlenbeck process). Without this reversion,
+        a prediction made over a long gap (e.g. a few seconds without detection) would drift away from the animal,
+        which typically stops. The uncertainty of predictions grows with time since the last observation.
+
+        The bank is driven by its owner (e.g. :class:`~ethoscope.core.monitor.Monitor`): :meth:`predict` is called once
+        per frame, before trackers run; trackers then :meth:`observe` positions; :meth:`correct` applies all
+        observations at once, at the end of the frame.
+
+        :param speed_sd: the typical speed of animals (standard deviation of the velocity), in pixels per second
+        :type speed_sd: float
+        :param velocity_tau: the time constant over which the velocity is forgotten, in seconds
+        :type velocity_tau: float
+        :param measurement_sd: the standard deviation of the error of observed positions, in pixels
+        :type measurement_sd: float
+        """
+        self._speed_var = float(speed_sd) ** 2
+        self._tau = float(velocity_tau)
+        self._r = float(measurement_sd) ** 2
+        self._slots = {}
+        # The x and y axes are independent filters, each with a (position, velocity) state.
+        # Rows are the position, the velocity and the three distinct terms of their covariance, which all evolve
+        # linearly, so a prediction is a single matrix product. Columns are slots, then axes.
+        self._state = np.zeros((5, 0, 2))
+        self._initialised = np.zeros(0, np.bool_)
+        self._observed = np.zeros(0, np.bool_)
+        self._z = np.zeros((0, 2))
+        self._t = None
+
+    def register(self, idx):
+        """
+        Allocate a filter for a ROI. This should be done before tracking starts, as it reallocates all arrays.
+
+        :param idx: the index of the ROI
+        :type idx: int
+        """
+        if idx in self._slots:
+            return
+        self._slots[idx] = len(self._slots)
+        self._state = np.concatenate([self._state, np.zeros((5, 1, 2))], axis=1)
+        self._initialised = np.append(self._initialised, False)
+        self._observed = np.append(self._observed, False)
+        self._z = np.concatenate([self._z, np.zeros((1, 2))])
+
+    def _transition(self, dt):
+        # exact discretisation of an integrated Ornstein-Uhlenbeck velocity
+        s, tau = self._speed_var, self._tau
+        d = exp(-dt / tau)
+        a = tau * (1 - d)
+        m = np.array([[1, a, 0, 0, 0],
+                      [0, d, 0, 0, 0],
+                      [0, 0, 1, 2 * a, a ** 2],
+                      [0, 0, 0, d, a * d],
+                      [0, 0, 0, 0, d ** 2]])
+        # process noise, added to the covariance terms
+        q = np.array([0, 0,
+                      s * tau ** 2 * (2 * dt / tau - 3 + 4 * d - d ** 2),
+                      s * tau * (1 - d) ** 2,
+                      s * (1 - d ** 2)])
+        return m, q
+
+    def predict(self, t):
+        """
+        Predict the state of all animals at time ``t``. Pending observations are applied first.
+
+        :param t: the time, in ms
+        :type t: int
+        """
+        self.correct()
+        if self._t is not None and t > self._t:
+            m, q = self._transition((t - self._t) / 1000.0)
+            n = self._state.shape[1]
+            self._state = (np.dot(m, self._state.reshape(5, -1)) + q[:, None]).reshape(5, n, 2)
+        self._t = t
+
+    def observe(self, idx, x, y):
+        """
+        Record the observed position of the animal of a ROI, for the current frame.
+
+        :param idx: the index of the ROI
+        :type idx: int
+        :param x: the observed x position, in pixels, within the ROI
+        :type x: float
+        :param y: the observed y position, in pixels, within the ROI
+        :type y: float
+        """
+        slot = self._slots[idx]
+        self._z[slot] = x, y
+        self._observed[slot] = True
+
+    def correct(self):
+        """
+        Update the filters with all the observations recorded since the last call.
+        Filters observed for the first time are initialised at the observed position, with no velocity.
+        """
+        if not self._observed.any():
+            return
+        new = self._observed & ~self._initialised
+        if new.any():
+            self._state[:, new] = 0
+            self._state[0, new] = self._z[new]
+            self._state[2, new] = self._r
+            self._state[4, new] = self._speed_var
+            self._initialised |= new
+            self._observed &= ~new
+
+        pos, vel, p_pp, p_pv, p_vv = self._state
+        # the gain (only the position is observed), null for filters without observation
+        k_p = p_pp / (p_pp + self._r) * self._observed[:, None]
+        k_v = p_pv / (p_pp + self._r) * self._observed[:, None]
+        innovation = self._z - pos
+        vel += k_v * innovation
+        pos += k_p * innovation
+        p_vv -= k_v * p_pv
+        p_pv *= 1 - k_p
+        p_pp *= 1 - k_p
+        self._observed.fill(False)
+
+    def prediction(self, idx):
+        """
+        :param idx: the index of the ROI
+        :type idx: int
+        :return: the predicted position (x, y) and its standard deviation (along the most uncertain axis),
+            in pixels, at the time of the last call to :meth:`predict`. ``None`` if the animal was never observed.
+        :rtype: (float, float, float)
+        """
+        slot = self._slots.get(idx)
+        if slot is None or not self._initialised[slot]:
+            return None
+        x, y = self._state[0, slot]
+        sd = np.sqrt(np.max(self._state[2, slot]))
+        return x, y, sd
+
+    def reset(self, idx):
+        """
+        Forget the animal of a ROI. The next observation will start a new track.
+
+        :param idx: the index of the ROI
+        :type idx: int
+        """
+        slot = self._slots.get(idx)
+        if slot is not None:
+            self._initialised[slot] = False
+            self._observed[slot] = False
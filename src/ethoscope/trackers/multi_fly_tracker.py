@@ -10,6 +10,7 @@ from scipy import ndimage
 from ethoscope.core.variables import XPosVariable, YPosVariable, XYDistance, WidthVariable, HeightVariable, PhiVariable, Label
 from ethoscope.core.data_point import DataPoint
 from ethoscope.trackers.trackers import BaseTracker, NoPositionError
+from ethoscope.trackers.assignment import MultiAnimalAssigner
 from ethoscope.utils.debug import EthoscopeException
 import logging
 
@@ -26,15 +27,21 @@ class MultiFlyTracker(BaseTracker):
 
 
 
-    def __init__(self, roi, data=None):
+    def __init__(self, roi, data=None, max_speed=0.25, max_unmatched_duration=10 * 1000):
         """
-        An adaptive background subtraction model to find position of one animal in one roi.
+        An adaptive background subtraction model to find position of several animals in one roi.
+        Detections are matched, from frame to frame, to animal identities (see :class:`~ethoscope.trackers.assignment.MultiAnimalAssigner`).
+        Each data point therefore has a stable ``label`` and the distance moved by this animal since its last observation.
 
-        TODO more description here
         :param roi:
         :param data:
+        :param max_speed: the maximal distance (relative to the longest axis of the ROI) an animal can move between two observations
+        :type max_speed: float
+        :param max_unmatched_duration: how long (in ms) an animal identity is kept when the animal is not detected
+        :type max_unmatched_duration: int
         :return:
         """
+        self._assigner = MultiAnimalAssigner(max_speed * roi.longest_axis, max_unmatched_duration)
         self._previous_shape=None
         self._object_expected_size = 0.05 # proportion of the roi main axis
         self._max_area = (5 * self._object_expected_size) ** 2
@@ -156,7 +163,7 @@ class MultiFlyTracker(BaseTracker):
             raise NoPositionError
 
 
-        out_pos = []
+        detections = []
         for vc in valid_contours:
             (x,y) ,(w,h), angle  = cv2.minAreaRect(vc)
 
@@ -170,40 +177,36 @@ class MultiFlyTracker(BaseTracker):
             max_h = 2*h_im
             if w>max_h or h>max_h:
                 continue
-            pos = x +1.0j*y
-            pos /= w_im
-
-            # fixme some matching needed here
-            #xy_dist = round(log10(1./float(w_im) + abs(pos - self._old_pos))*1000)
 
             cv2.ellipse(self._buff_fg ,((x,y), (int(w*1.5),int(h*1.5)),angle),255,-1)
+            detections.append((x, y, w, h, angle))
+
+
+        if len(detections) == 0:
+            self._bg_model.increase_learning_rate()
+            raise NoPositionError
+
+        w_im = max(grey.shape)
+        labels, dists = self._assigner.assign([(d[0], d[1]) for d in detections], t)
 
+        out_pos = []
+        for (x, y, w, h, angle), label, dist in zip(detections, labels, dists):
+            xy_dist = round(log10(1./float(w_im) + dist / float(w_im))*1000)
 
             x_var = XPosVariable(int(round(x)))
             y_var = YPosVariable(int(round(y)))
-            # distance = XYDistance(int(xy_dist))
-            #xor_dist = XorDistance(int(xor_dist))
+            distance = XYDistance(int(xy_dist))
             w_var = WidthVariable(int(round(w)))
             h_var = HeightVariable(int(round(h)))
             phi_var = PhiVariable(int(round(angle)))
-            # mlogl =   mLogLik(int(distance*1000))
 
             out = DataPoint([x_var, y_var, w_var, h_var,
                              phi_var,
-                             #mlogl,
-                             # distance,
-                             #xor_dist
-                            #Label(0)
+                             distance,
+                             Label(int(label))
                              ])
-
-
             out_pos.append(out)
 
-
-        if len(out_pos) == 0:
-            self._bg_model.increase_learning_rate()
-            raise NoPositionError
-
         # accurate measurment for multi animal tracking:
         #cv2.ellipse(self._buff_fg ,((x,y), (int(w*1.5),int(h*1.5)),angle),255,-1)
         #
@@ -0,0 +1,179 @@
+__author__ = 'quentin'
+
+from collections import deque
+import cv2
+import numpy as np
+
+
+class BasePreprocessor(object):
+    def __init__(self, object_expected_size=0.05, pool=None):
+        """
+        Template class for the preprocessing of ROI images, before background subtraction.
+        A preprocessor turns the (colour) image of a ROI into a single channel, ``uint8``, image,
+        in which animals are bright. All work is done in buffers that are allocated once.
+        Derived classes must implement the ``_apply`` method.
+
+        :param object_expected_size: the expected size of animals, as a proportion of the longest axis of the ROI
+        :type object_expected_size: float
+        :param pool: An optional pool from which scratch buffers (i.e. that do not persist between frames) are taken,
+            so they can be shared between trackers. ``None`` means the preprocessor owns them.
+        :type pool: :class:`~ethoscope.trackers.compact_bg_tracker.BufferPool`
+        """
+        self._object_expected_size = object_expected_size
+        self._pool = pool
+        self._buffers = {}
+        self._identity_lut = np.arange(256, dtype=np.uint8).reshape(1, 256)
+        self._lut = np.empty_like(self._identity_lut)
+
+    def _buffer(self, name, shape, dtype):
+        if self._pool is not None:
+            return self._pool.get("preprocessing_" + name, shape, dtype)
+        buff = self._buffers.get(name)
+        if buff is None or buff.shape != shape or buff.dtype != dtype:
+            buff = np.empty(shape, dtype)
+            self._buffers[name] = buff
+        return buff
+
+    def _scale(self, grey, scale):
+        # same as cv2.multiply(grey, scale, dst=grey), through a look up table, which is much faster
+        cv2.multiply(self._identity_lut, scale, dst=self._lut)
+        cv2.LUT(grey, self._lut, grey)
+
+    def _kernel_size(self, img, factor):
+        size = int(self._object_expected_size * np.max(img.shape) * factor)
+        if size % 2 == 0:
+            size += 1
+        return size
+
+    def apply(self, img, mask, t):
+        """
+        :param img: the image of a ROI
+        :type img: :class:`~numpy.ndarray`
+        :param mask: the mask of the ROI
+        :type mask: :class:`~numpy.ndarray`
+        :param t: the time of the frame, in ms
+        :type t: int
+        :return: The preprocessed image. It is a buffer that will be overwritten by the next call.
+        :rtype: :class:`~numpy.ndarray`
+        """
+        return self._apply(img, mask, t)
+
+    def _apply(self, img, mask, t):
+        raise NotImplementedError
+
+    def mask_changed(self):
+        """
+        Forget what was computed from the mask, as the mask of the ROI changed (e.g. the ROI was aligned),
+        though its shape did not.
+        """
+        pass
+
+
+class MinimalPreprocessor(BasePreprocessor):
+    def __init__(self, object_expected_size=0.05, darker_fg=True, pool=None):
+        """
+        Greyscale conversion, a small Gaussian blur, and scaling so that the mean grey level of the ROI is 128.
+        This is the default preprocessing of :class:`~ethoscope.trackers.adaptive_bg_tracker.AdaptiveBGModel`.
+
+        :param darker_fg: whether animals are darker than the background (the image is then inverted)
+        :type darker_fg: bool
+        """
+        self._darker_fg = darker_fg
+        super(MinimalPreprocessor, self).__init__(object_expected_size, pool)
+
+    def _apply(self, img, mask, t):
+        blur_rad = self._kernel_size(img, 0.5)
+        grey = self._buffer("grey", img.shape[0:2], np.uint8)
+
+        cv2.cvtColor(img, cv2.COLOR_BGR2GRAY, grey)
+        cv2.GaussianBlur(grey, (blur_rad, blur_rad), 1.2, grey)
+        if self._darker_fg:
+            cv2.subtract(255, grey, grey)
+
+        mean = cv2.mean(grey, mask)
+        self._scale(grey, 128. / mean[0])
+
+        if mask is not None:
+            cv2.bitwise_and(grey, mask, grey)
+        return grey
+
+
+class LocalContrastPreprocessor(BasePreprocessor):
+    def __init__(self, object_expected_size=0.05, mode_window=30 * 1000, pool=None):
+        """
+        Local contrast normalisation: the absolute difference between each pixel and the mean of its neighbourhood
+        (within the mask), after scaling the image so that its typical (modal) grey level is 128.
+        This makes animals stand out against gradients of illumination.
+
+        Local sums are computed from an integral image (so the cost does not depend on the size of the neighbourhood),
+        and multiplied by the reciprocal of the number of pixels of the mask in each neighbourhood,
+        which is computed once. All steps work in preallocated buffers.
+        The modal grey level is smoothed over ``mode_window``, with a running sum.
+
+        :param mode_window: the duration over which the modal grey level is averaged, in ms
+        :type mode_window: int
+        """
+        self._mode_window = mode_window
+        self._modes = deque()
+        self._mode_times = deque()
+        self._mode_sum = 0.0
+        self._inv_weights = None
+        super(LocalContrastPreprocessor, self).__init__(object_expected_size, pool)
+
+    def _update_mode(self, grey, t):
+        hist = cv2.calcHist([grey], [0], None, [256], [0, 255]).ravel()
+        hist = np.convolve(hist, [1] * 3)
+        mode = int(np.argmax(hist))
+
+        self._modes.append(mode)
+        self._mode_times.append(t)
+        self._mode_sum += mode
+        while len(self._mode_times) > 2 and self._mode_times[-1] - self._mode_times[0] > self._mode_window:
+            self._mode_sum -= self._modes.popleft()
+            self._mode_times.popleft()
+        return self._mode_sum / len(self._modes)
+
+    def _box_sum(self, grey, ksize):
+        # the sum of the ksize x ksize neighbourhood of each pixel, with reflected borders, from an integral image
+        r = ksize // 2
+        h, w = grey.shape
+        padded = self._buffer("padded", (h + 2 * r, w + 2 * r), np.uint8)
+        cv2.copyMakeBorder(grey, r, r, r, r, cv2.BORDER_REFLECT_101, padded)
+        # 32 bit integers are enough for all but huge images
+        dtype = np.int32 if 255.0 * padded.size < 2 ** 31 else np.float64
+        integral = self._buffer("integral", (h + 2 * r + 1, w + 2 * r + 1), dtype)
+        cv2.integral(padded, integral, sdepth=cv2.CV_32S if dtype == np.int32 else cv2.CV_64F)
+        out = self._buffer("box_sum", (h, w), dtype)
+        cv2.subtract(integral[ksize:, ksize:], integral[:-ksize, ksize:], out)
+        cv2.subtract(out, integral[ksize:, :-ksize], out)
+        cv2.add(out, integral[:-ksize, :-ksize], out)
+        return out
+
+    def mask_changed(self):
+        self._inv_weights = None
+
+    def _apply(self, img, mask, t):
+        shape = img.shape[0:2]
+        ksize = self._kernel_size(img, 2.0)
+        if mask is None:
+            mask = np.full(shape, 255, np.uint8)
+
+        if self._inv_weights is None or self._inv_weights.shape != shape:
+            # the number of pixels of the mask around each pixel
+            count = self._box_sum(mask, ksize) / 255.0
+            self._inv_weights = np.zeros(shape, np.float32)
+            np.divide(1.0, count, out=self._inv_weights, where=count > 0.5)
+
+        grey = self._buffer("grey", shape, np.uint8)
+        local_mean = self._buffer("local_mean", shape, np.uint8)
+
+        cv2.cvtColor(img, cv2.COLOR_BGR2GRAY, grey)
+        self._scale(grey, 128. / self._update_mode(grey, t))
+        cv2.bitwise_and(grey, mask, grey)
+
+        local_sum = self._box_sum(grey, ksize)
+        cv2.multiply(local_sum, self._inv_weights, local_mean, dtype=cv2.CV_8U)
+
+        cv2.absdiff(grey, local_mean, grey)
+        cv2.bitwise_and(grey, mask, grey)
+        return grey
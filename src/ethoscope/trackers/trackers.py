@@ -1,9 +1,32 @@
 __author__ = 'quentin'
 
 from collections import deque
+from math import log10
+import logging
+import numpy as np
 
 from ethoscope.utils.description  import DescribedObject
 from ethoscope.core.variables import *
+from ethoscope.core.data_point import DataPoint
+
+
+def _owned_nbytes(obj, seen):
+    # the memory of the arrays owned by an object (i.e. not views), recursively through ethoscope objects.
+    # Deques are histories (positions, times, ...), not buffers, so they are not walked
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes if obj.base is None else 0
+    if isinstance(obj, deque):
+        return 0
+    if isinstance(obj, (list, tuple)):
+        return sum(_owned_nbytes(o, seen) for o in obj)
+    if isinstance(obj, dict):
+        return sum(_owned_nbytes(o, seen) for o in obj.values())
+    if hasattr(obj, "__dict__") and type(obj).__module__.startswith("ethoscope"):
+        return sum(_owned_nbytes(o, seen) for o in obj.__dict__.values())
+    return 0
 
 
 class NoPositionError(Exception):
@@ -14,6 +37,8 @@ class NoPositionError(Exception):
 
 class BaseTracker(DescribedObject):
     # data_point = None
+    # the memory footprint is measured, by the tracking thread, at most this often, in ms
+    _footprint_period = 60 * 1000
     def __init__(self, roi,data=None):
         """
         Template class for video trackers.
@@ -30,15 +55,22 @@ class BaseTracker(DescribedObject):
         self._times =deque()
         self._data = data
         self._roi = roi
+        self._mask_version = roi.mask_version
         self._last_non_inferred_time = 0
         self._last_time_point = 0
+        self._first_time_point = None
+        self._time_to_first_position = None
         self._max_history_length = 250 * 1000  # in milliseconds
+        self._motion_model = None
+        # (owned, shared) memory, in bytes, and when it was measured (see `memory_footprint`)
+        self._memory_footprint = (0, 0)
+        self._footprint_t = None
 
         # self._max_history_length = 500   # in milliseconds
         # if self.data_point is None:
         #     raise NotImplementedError("Trackers must have a DataPoint object.")
 
-    def track(self, t, img):
+    def track(self, t, img, crop=None):
         """
         Locate the animal in a image, at a given time.
 
@@ -46,12 +78,30 @@ class BaseTracker(DescribedObject):
         :type t: int
         :param img: the whole frame.
         :type img: :class:`~numpy.ndarray`
+        :param crop: the region of the ROI in ``img``, and its mask, when already cut
+            (see :meth:`~ethoscope.core.roi.ROISet.crop_all`). ``None`` means the ROI cuts ``img``.
+        :type crop: (:class:`~numpy.ndarray`, :class:`~numpy.ndarray`)
         :return: The position of the animal at time ``t``
         :rtype: :class:`~ethoscope.core.data_point.DataPoint`
         """
+        if crop is None:
+            crop = self._roi.apply(img)
+        sub_img, mask = crop
+        if self._roi.mask_version != self._mask_version:
+            self._mask_version = self._roi.mask_version
+            self._mask_changed()
+        try:
+            return self._locate(t, sub_img, mask)
+        finally:
+            # measured here, so that other threads (e.g. the web server) only read the result
+            if self._footprint_t is None or t - self._footprint_t >= self._footprint_period:
+                self._footprint_t = t
+                self._memory_footprint = (self._owned_memory(), self._shared_memory())
 
-        sub_img, mask = self._roi.apply(img)
+    def _locate(self, t, sub_img, mask):
         self._last_time_point = t
+        if self._first_time_point is None:
+            self._first_time_point = t
         try:
 
             points = self._find_position(sub_img,mask,t)
@@ -63,9 +113,13 @@ class BaseTracker(DescribedObject):
 
             # point = self.normalise_position(point)
             self._last_non_inferred_time = t
+            if self._time_to_first_position is None:
+                self._time_to_first_position = t - self._first_time_point
+                logging.info("ROI %i: first position found after %i ms" % (self._roi.idx, self._time_to_first_position))
 
             for p in points:
                 p.append(IsInferredVariable(False))
+            self._observe(points)
 
         except NoPositionError:
             if len(self._positions) == 0:
@@ -79,13 +133,47 @@ class BaseTracker(DescribedObject):
                 for p in points:
                     p.append(IsInferredVariable(True))
 
+        self._push(points, t)
+        return points
+
+    def _push(self, points, t):
         self._positions.append(points)
         self._times.append(t)
 
-
         if len(self._times) > 2 and (self._times[-1] - self._times[0]) > self._max_history_length:
             self._positions.popleft()
             self._times.popleft()
+
+    def carry_forward(self, t):
+        """
+        Repeat the last positions at time ``t``, without analysing any image.
+        This is meant for frames that are known to be the same as the last analysed one, so the animal did not move.
+
+        :param t: time in ms
+        :type t: int
+        :return: The position of the animal at time ``t``
+        :rtype: :class:`~ethoscope.core.data_point.DataPoint`
+        """
+        last_time_point = self._last_time_point
+        self._last_time_point = t
+        # no position was given for the last analysed frame
+        if len(self._positions) == 0 or self._times[-1] != last_time_point:
+            return []
+
+        if self._last_non_inferred_time == last_time_point:
+            points = [p.copy() for p in self._positions[-1]]
+            for p in points:
+                if XYDistance.header_name in p:
+                    # the distance for no movement, using the same log scale as trackers
+                    p[XYDistance.header_name] = XYDistance(int(round(log10(1. / self._roi.longest_axis) * 1000)))
+            self._last_non_inferred_time = t
+            self._observe(points)
+        else:
+            points = self._infer_position(t)
+            if len(points) == 0:
+                return []
+
+        self._push(points, t)
         return points
 
     def _infer_position(self, t, max_time=30 * 1000):
@@ -94,7 +182,64 @@ class BaseTracker(DescribedObject):
         if t - self._last_non_inferred_time  > max_time:
             return []
 
-        return self._positions[-1]
+        last_points = self._positions[-1]
+        prediction = None
+        if self._motion_model is not None and len(last_points) == 1:
+            prediction = self._motion_model.prediction(self._roi.idx)
+        if prediction is None:
+            # copies, so that flagging them as inferred does not alter the stored ones
+            return [p.copy() for p in last_points]
+
+        # the last position, moved to where the motion model predicts the animal to be
+        _, _, w, h = self._roi.rectangle
+        x = int(round(np.clip(prediction[0], 0, w - 1)))
+        y = int(round(np.clip(prediction[1], 0, h - 1)))
+        point = last_points[0].copy()
+        dist = abs(complex(x - point[XPosVariable.header_name], y - point[YPosVariable.header_name]))
+        point[XPosVariable.header_name] = XPosVariable(x)
+        point[YPosVariable.header_name] = YPosVariable(y)
+        if XYDistance.header_name in point:
+            w_im = self._roi.longest_axis
+            point[XYDistance.header_name] = XYDistance(int(round(log10((1. + dist) / w_im) * 1000)))
+        # the inferred flag is appended by the caller
+        point.pop(IsInferredVariable.header_name, None)
+        return [point]
+
+    def _observe(self, points):
+        if self._motion_model is not None and len(points) == 1:
+            self._motion_model.observe(self._roi.idx, points[0][XPosVariable.header_name], points[0][YPosVariable.header_name])
+
+    def set_motion_model(self, motion_model):
+        """
+        Use a motion model to infer positions (instead of repeating the last one) when the animal is not detected,
+        and to provide a predicted :meth:`~ethoscope.trackers.trackers.BaseTracker.search_region`.
+        Only trackers returning one position per frame are supported.
+
+        :param motion_model: a motion model, shared by the trackers of all ROIs, and updated by their owner
+            (e.g. a :class:`~ethoscope.core.monitor.Monitor`)
+        :type motion_model: :class:`~ethoscope.trackers.motion_model.KalmanMotionBank`
+        """
+        self._motion_model = motion_model
+        motion_model.register(self._roi.idx)
+
+    def search_region(self, n_sigmas=3.0, min_size=10):
+        """
+        :param n_sigmas: the half size of the region, in standard deviations of the prediction
+        :type n_sigmas: float
+        :param min_size: the minimal half size of the region, in pixels
+        :type min_size: int
+        :return: the region where the animal is expected, as an upright rectangle ``(x, y, w, h)`` within the ROI.
+            ``None`` if there is no motion model, or no prediction yet.
+        :rtype: (int,int,int,int)
+        """
+        if self._motion_model is None:
+            return None
+        prediction = self._motion_model.prediction(self._roi.idx)
+        if prediction is None:
+            return None
+        x, y, sd = prediction
+        half_size = max(min_size, n_sigmas * sd)
+        return (int(x - half_size), int(y - half_size), int(2 * half_size) + 1, int(2 * half_size) + 1)
 
 
     @property
@@ -118,6 +263,15 @@ class BaseTracker(DescribedObject):
         """
         return self._last_time_point
 
+    @property
+    def time_to_first_position(self):
+        """
+        :return: The time (in ms) between the first frame and the first observed (i.e. not inferred) position.
+            ``None`` if no position was observed yet.
+        :rtype: int
+        """
+        return self._time_to_first_position
+
     @property
     def times(self):
         """
@@ -126,6 +280,103 @@ class BaseTracker(DescribedObject):
         """
         return self._times
 
+    def _mask_changed(self):
+        # called before tracking a frame, when the mask of the ROI changed (e.g. it was aligned).
+        # Derived classes that keep values computed from the mask must rebuild them
+        pass
+
+    def _owned_memory(self):
+        return _owned_nbytes(self, {id(self._roi), id(self._roi.mask()), id(self._motion_model)})
+
+    def _shared_memory(self):
+        return 0
+
+    @property
+    def memory_footprint(self):
+        """
+        :return: The memory, in bytes, of the images (buffers, models, ...) this tracker owns.
+            Images shared with other trackers (see :attr:`~ethoscope.trackers.trackers.BaseTracker.shared_memory_footprint`)
+            and the ROI itself are not counted.
+            It is measured by :meth:`track`, after the first frame and then every ``_footprint_period``,
+            so it can be read from any thread. 0 before the first frame.
+        :rtype: int
+        """
+        return self._memory_footprint[0]
+
+    @property
+    def shared_memory_footprint(self):
+        """
+        :return: The memory, in bytes, of the images shared by all trackers of this class. 0 for most trackers.
+            Measured like :attr:`~ethoscope.trackers.trackers.BaseTracker.memory_footprint`.
+        :rtype: int
+        """
+        return self._memory_footprint[1]
+
+    @classmethod
+    def get_shared_state(cls):
+        """
+        The state shared by all trackers of this class (e.g. a model of the animals, learnt from all ROIs).
+        It is saved once, rather than with the state of each tracker (see :meth:`get_state`).
+
+        :return: a picklable dictionary, or ``None`` when trackers share no state
+        :rtype: dict
+        """
+        return None
+
+    @classmethod
+    def set_shared_state(cls, state):
+        """
+        Restore a state generated by :meth:`~ethoscope.trackers.trackers.BaseTracker.get_shared_state`.
+
+        :param state: the shared state of trackers of this class
+        :type state: dict
+        """
+        pass
+
+    def get_state(self):
+        """
+        A compact snapshot of the internal state of the tracker, so that tracking can be resumed, after a restart,
+        without learning everything again (see :meth:`~ethoscope.trackers.trackers.BaseTracker.set_state`).
+        The base implementation only keeps the last position and time points.
+        Derived classes should extend it with their models (e.g. background).
+
+        :return: a picklable dictionary
+        :rtype: dict
+        """
+        state = {"class": self.__class__.__name__,
+                 "roi_rectangle": tuple(self._roi.rectangle),
+                 "last_non_inferred_time": self._last_non_inferred_time,
+                 "last_time_point": self._last_time_point,
+                 "first_time_point": self._first_time_point,
+                 "time_to_first_position": self._time_to_first_position}
+        if len(self._positions) > 0:
+            # data points cannot be pickled as such, so we keep the variables only
+            state["last_positions"] = [p.values() for p in self._positions[-1]]
+            state["last_time"] = self._times[-1]
+        return state
+
+    def set_state(self, state):
+        """
+        Restore a state generated by :meth:`~ethoscope.trackers.trackers.BaseTracker.get_state`.
+
+        :param state: the state of a tracker of the same class, on the same ROI
+        :type state: dict
+        """
+        if state["class"] != self.__class__.__name__:
+            raise ValueError("Cannot restore the state of a %s in a %s" % (state["class"], self.__class__.__name__))
+        if tuple(state["roi_rectangle"]) != tuple(self._roi.rectangle):
+            raise ValueError("The state was saved for another ROI: %s" % str(state["roi_rectangle"]))
+
+        self._last_non_inferred_time = state["last_non_inferred_time"]
+        self._last_time_point = state["last_time_point"]
+        self._first_time_point = state["first_time_point"]
+        self._time_to_first_position = state["time_to_first_position"]
+        self._positions.clear()
+        self._times.clear()
+        if "last_positions" in state:
+            self._positions.append([DataPoint(values) for values in state["last_positions"]])
+            self._times.append(state["last_time"])
+
     def _find_position(self,img, mask,t):
         raise NotImplementedError
 
@@ -0,0 +1,240 @@
+__author__ = 'quentin'
+
+from math import log10
+import cv2
+import numpy as np
+
+try:
+    REDUCE_SUM, REDUCE_MAX = cv2.REDUCE_SUM, cv2.REDUCE_MAX
+except AttributeError:
+    REDUCE_SUM, REDUCE_MAX = cv2.cv.CV_REDUCE_SUM, cv2.cv.CV_REDUCE_MAX
+
+from ethoscope.core.variables import XPosVariable, YPosVariable, XYDistance, WidthVariable, HeightVariable, PhiVariable
+from ethoscope.core.data_point import DataPoint
+from ethoscope.trackers.adaptive_bg_tracker import BackgroundModel
+from ethoscope.trackers.trackers import BaseTracker, NoPositionError
+
+
+def _median(a):
+    # faster than np.median for small arrays, and exact for odd lengths
+    k = len(a) // 2
+    return np.partition(a, k)[k]
+
+
+class TubeProjectionTracker(BaseTracker):
+    # the default width of the bands, as a proportion of the length of the tube
+    _band_width = 0.02
+    _description = {"overview": "A fast tracker for tube arenas, where the animal can only move along the tube. One animal per ROI.",
+                    "arguments": []}
+
+    def __init__(self, roi, data=None, n_bands=None, min_contrast=4.0, n_sigmas=6.0, max_fg_prop=0.25):
+        """
+        A tracker for ROIs that are tubes (i.e. much longer than wide), in which one animal moves along the main axis.
+        Instead of analysing the whole image, each frame is collapsed along the short axis of the ROI into 1-D
+        intensity profiles (the mean grey level of each slice of the tube).
+        So that a small animal in a wide tube is not diluted, the tube is split in a few bands along its short axis,
+        each giving one profile.
+        A running background of the profiles is maintained (see :class:`~ethoscope.trackers.adaptive_bg_tracker.BackgroundModel`),
+        and the animal is located as the highest peak of the residual (background minus profile, as animals are darker).
+        The position along the short axis is then computed only around the peak.
+
+        :param roi: The Region Of Interest the the tracker will use to locate the animal.
+        :type roi: :class:`~ethoscope.rois.roi_builders.ROI`
+        :param data: An optional data set. Not used.
+        :param n_bands: The number of bands the tube is split into. By default, bands are about as wide as an animal.
+        :type n_bands: int
+        :param min_contrast: The minimal height of the residual peak, in grey levels.
+        :type min_contrast: float
+        :param n_sigmas: The minimal height of the residual peak, in robust standard deviations of the residual.
+        :type n_sigmas: float
+        :param max_fg_prop: the maximal proportion of the tube that can differ from the background.
+            Above, the frame is considered as a global change (e.g. of illumination), and no position is returned.
+        :type max_fg_prop: float
+        """
+        self._n_bands = n_bands
+        self._min_contrast = min_contrast
+        self._n_sigmas = n_sigmas
+        self._max_fg_prop = max_fg_prop
+
+        self._bg_model = BackgroundModel()
+        # the cross-section of the tube, to find position along the short axis
+        self._section_bg_model = BackgroundModel()
+
+        # dim of the frame reduced to make the profile: 0 when the tube is horizontal
+        self._reduced_dim = None
+        self._band_slices = None
+        self._inv_count = None
+        self._section_inv_count = None
+        self._invalid = None
+        self._valid_columns = None
+        self._mask = None
+        self._buff_grey = None
+        self._buff_profile = None
+        self._buff_residual = None
+        self._buff_fg = None
+        self._old_pos = 0.0 + 0.0j
+        super(TubeProjectionTracker, self).__init__(roi, data)
+
+    def get_state(self):
+        state = super(TubeProjectionTracker, self).get_state()
+        state["bg_model"] = self._bg_model.get_state()
+        state["section_bg_model"] = self._section_bg_model.get_state()
+        state["old_pos"] = self._old_pos
+        return state
+
+    def set_state(self, state):
+        super(TubeProjectionTracker, self).set_state(state)
+        self._bg_model.set_state(state["bg_model"])
+        self._section_bg_model.set_state(state["section_bg_model"])
+        self._old_pos = state["old_pos"]
+
+    def _init_buffers(self, img, mask):
+        h, w = img.shape[0:2]
+        self._reduced_dim = 0 if w >= h else 1
+        self._buff_grey = np.empty((h, w), np.uint8)
+        short, long = min(h, w), max(h, w)
+
+        n_bands = self._n_bands
+        if n_bands is None:
+            n_bands = int(round(short / (self._band_width * long)))
+        n_bands = int(np.clip(n_bands, 1, short))
+        bounds = np.linspace(0, short, n_bands + 1).astype(np.int64)
+        if self._reduced_dim == 0:
+            self._band_slices = [np.s_[a:b, :] for a, b in zip(bounds[:-1], bounds[1:])]
+        else:
+            self._band_slices = [np.s_[:, a:b] for a, b in zip(bounds[:-1], bounds[1:])]
+
+        # number of pixels in the mask, per slice. Dividing by it turns sums into means
+        count = self._reduce_bands(mask) / 255.0
+        valid = count > 0
+        self._invalid = ~valid
+        self._valid_columns = np.any(valid, 0)
+        self._inv_count = np.zeros_like(count)
+        self._inv_count[valid] = 1.0 / count[valid]
+        self._buff_profile = np.empty_like(count)
+        self._buff_residual = np.empty_like(count)
+
+        section_count = cv2.reduce(mask, 1 - self._reduced_dim, REDUCE_SUM, dtype=cv2.CV_32F).ravel() / 255.0
+        self._section_inv_count = np.zeros_like(section_count)
+        self._section_inv_count[section_count > 0] = 1.0 / section_count[section_count > 0]
+
+        self._buff_fg = np.zeros(count.shape, np.uint8)
+        self._mask = mask
+
+    def _mask_changed(self):
+        # the pixel counts are rebuilt, from the new mask, at the next frame. Background models are kept
+        self._buff_grey = None
+
+    def _reduce_bands(self, grey, out=None):
+        if out is None:
+            out = np.empty((len(self._band_slices), grey.shape[1 - self._reduced_dim]), np.float32)
+        for i, sl in enumerate(self._band_slices):
+            out[i] = cv2.reduce(grey[sl], self._reduced_dim, REDUCE_SUM, dtype=cv2.CV_32F).ravel()
+        return out
+
+    def _find_position(self, img, mask, t):
+        if self._buff_grey is None:
+            self._init_buffers(img, mask)
+
+        cv2.cvtColor(img, cv2.COLOR_BGR2GRAY, self._buff_grey)
+        cv2.bitwise_and(self._buff_grey, mask, self._buff_grey)
+
+        profile = self._reduce_bands(self._buff_grey, self._buff_profile)
+        np.multiply(profile, self._inv_count, profile)
+        section = cv2.reduce(self._buff_grey, 1 - self._reduced_dim, REDUCE_SUM, dtype=cv2.CV_32F).ravel()
+        np.multiply(section, self._section_inv_count, section)
+
+        try:
+            return self._track(profile, section, t)
+        except NoPositionError:
+            self._bg_model.update(profile, t)
+            self._section_bg_model.update(section, t)
+            raise NoPositionError
+
+    def _track(self, profile, section, t):
+        if self._bg_model.bg_img is None:
+            raise NoPositionError
+
+        band_residual = self._buff_residual
+        np.subtract(self._bg_model.bg_img, profile, band_residual)
+        band_residual[self._invalid] = 0
+        # the animal is where any band is darker than the background
+        residual = cv2.reduce(band_residual, 0, REDUCE_MAX).ravel()
+
+        valid_res = residual[self._valid_columns]
+        med = _median(valid_res)
+        sigma = 1.4826 * _median(np.abs(valid_res - med))
+        threshold = max(self._min_contrast, med + self._n_sigmas * sigma)
+
+        peak = int(np.argmax(residual))
+        peak_height = residual[peak]
+        if peak_height < threshold:
+            self._bg_model.increase_learning_rate()
+            raise NoPositionError
+
+        if np.count_nonzero(valid_res > threshold) > self._max_fg_prop * len(valid_res):
+            self._bg_model.increase_learning_rate()
+            raise NoPositionError
+
+        # the extent of the animal is where the residual is above half of the peak
+        below = np.flatnonzero(residual <= max(threshold, peak_height) / 2.0)
+        i = np.searchsorted(below, peak)
+        start = below[i - 1] + 1 if i > 0 else 0
+        end = below[i] if i < len(below) else len(residual)
+
+        # centre of the animal along the tube
+        weights = residual[start:end]
+        u = np.sum(weights * np.arange(start, end)) / np.sum(weights)
+
+        # position along the short axis: where the slices that contain the animal are darker than the section background
+        v, height = self._cross_position(start, end, section)
+
+        if self._reduced_dim == 0:
+            x, y, w, h, angle = u, v, end - start, height, 0
+        else:
+            x, y, w, h, angle = v, u, end - start, height, 90
+
+        w_im = len(residual)
+        pos = (x + 1.0j * y) / w_im
+        xy_dist = round(log10(1. / float(w_im) + abs(pos - self._old_pos)) * 1000)
+        self._old_pos = pos
+
+        self._buff_fg.fill(0)
+        self._buff_fg[:, start:end] = 255
+        self._bg_model.decrease_learning_rate()
+        self._bg_model.update(profile, t, self._buff_fg)
+        self._section_bg_model.update(section, t)
+
+        out = DataPoint([XPosVariable(int(round(x))),
+                         YPosVariable(int(round(y))),
+                         WidthVariable(int(round(w))),
+                         HeightVariable(int(round(h))),
+                         PhiVariable(int(angle)),
+                         XYDistance(int(xy_dist))])
+        return [out]
+
+    def _cross_position(self, start, end, section):
+        if self._reduced_dim == 0:
+            window = self._buff_grey[:, start:end]
+            window_mask = self._mask[:, start:end]
+        else:
+            window = self._buff_grey[start:end, :]
+            window_mask = self._mask[start:end, :]
+
+        window_section = cv2.reduce(window, 1 - self._reduced_dim, REDUCE_SUM, dtype=cv2.CV_32F).ravel()
+        window_count = cv2.reduce(window_mask, 1 - self._reduced_dim, REDUCE_SUM, dtype=cv2.CV_32F).ravel() / 255.0
+        # the mean grey level of the section, without the animal
+        section_bg = self._section_bg_model.bg_img
+        if section_bg is None:
+            section_bg = section
+        # the expected sum over the window, if the animal was not there
+        expected = section_bg * window_count
+        weights = expected - window_section
+        weights[weights < 0] = 0
+        total = np.sum(weights)
+        if total == 0:
+            centre = (len(section) - 1) / 2.0
+            return centre, 0
+        centre = np.sum(weights * np.arange(len(weights))) / total
+        height = np.count_nonzero(weights > np.max(weights) / 2.0)
+        return centre, height
@@ -0,0 +1,118 @@
+__author__ = 'quentin'
+
+import os
+import logging
+import pickle
+
+
+class TrackerCheckpointer(object):
+    def __init__(self, path, period=5 * 60 * 1000):
+        """
+        Periodically saves the state of trackers (background models, learning rates, last positions, ...) to a file,
+        so that, after an interruption (e.g. a reboot), tracking can be resumed warm.
+        Files are written atomically: a checkpoint is either the previous or the new one, never a partial one.
+
+        :param path: the file to save checkpoints into. Its directory is created if needed.
+        :type path: str
+        :param period: the time between two checkpoints, in ms (of frame time).
+        :type period: int
+        """
+        self._path = path
+        self._period = period
+        self._last_t = None
+        self._drift_state = None
+        self._shared_state = None
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def drift_state(self):
+        """
+        :return: the alignment of ROIs saved with the last loaded checkpoint
+            (see :meth:`~ethoscope.core.drift_correction.ROIDriftCorrector.get_state`), or ``None``
+        :rtype: dict
+        """
+        return self._drift_state
+
+    @property
+    def shared_state(self):
+        """
+        :return: the state shared by all trackers, saved with the last loaded checkpoint
+            (see :meth:`~ethoscope.trackers.trackers.BaseTracker.get_shared_state`), or ``None``
+        :rtype: dict
+        """
+        return self._shared_state
+
+    def is_due(self, t):
+        """
+        :param t: the time of the current frame, in ms
+        :type t: int
+        :return: whether a checkpoint should be saved now. The first checkpoint is due one period after the first call.
+        :rtype: bool
+        """
+        if self._last_t is None:
+            self._last_t = t
+        return t - self._last_t >= self._period
+
+    def save(self, t, states, drift_state=None, shared_state=None):
+        """
+        Atomically write a checkpoint.
+
+        :param t: the time of the frame the states correspond to, in ms
+        :type t: int
+        :param states: the states of the trackers, by ROI index
+            (see :meth:`~ethoscope.core.monitor.Monitor.tracker_states`)
+        :type states: dict
+        :param drift_state: the alignment of the ROIs the trackers work on, if they were moved
+            (see :meth:`~ethoscope.core.drift_correction.ROIDriftCorrector.get_state`)
+        :type drift_state: dict
+        :param shared_state: the state shared by all trackers, saved once
+            (see :meth:`~ethoscope.trackers.trackers.BaseTracker.get_shared_state`)
+        :type shared_state: dict
+        """
+        self._last_t = t
+        directory = os.path.dirname(self._path)
+        if directory and not os.path.exists(directory):
+            logging.warning("No cache dir detected. making one")
+            os.makedirs(directory)
+
+        tmp_path = self._path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump({"t": t, "states": states, "drift_state": drift_state, "shared_state": shared_state},
+                        f, pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self._path)
+
+    def load(self):
+        """
+        :return: the states of the last checkpoint, by ROI index, or ``None`` if there is no usable checkpoint.
+            The alignment of ROIs is then in :attr:`drift_state`, and the state shared by trackers in
+            :attr:`shared_state`.
+        :rtype: dict
+        """
+        try:
+            with open(self._path, "rb") as f:
+                checkpoint = pickle.load(f)
+        except IOError:
+            return None
+        except Exception as e:
+            logging.warning("Could not load tracker checkpoint %s: %s" % (self._path, str(e)))
+            return None
+        logging.info("Loaded tracker checkpoint from t = %i ms" % checkpoint["t"])
+        self._last_t = checkpoint["t"]
+        self._drift_state = checkpoint.get("drift_state")
+        self._shared_state = checkpoint.get("shared_state")
+        return checkpoint["states"]
+
+    def remove(self):
+        """
+        Delete the checkpoint, if any. This should be done when an experiment stops normally.
+        """
+        for p in (self._path, self._path + ".tmp"):
+            try:
+                os.remove(p)
+            except OSError:
+                pass
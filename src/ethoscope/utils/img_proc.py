@@ -1,7 +1,72 @@
 __author__ = 'quentin'
 import cv2
 import numpy as np
-import itertools
+
+def _proximity_groups(centres, radii):
+    """
+    Group points that are connected by a chain of "close" pairs.
+    Two points, ``a`` and ``b``, are close if their distance is smaller than the radius of, at least, one of them.
+    A spatial hash grid is used to query neighbours and a union-find structure to build groups,
+    so that the cost grows roughly linearly with the number of points.
+
+    :param centres: a ``n x 2`` array of coordinates
+    :type centres: :class:`~numpy.ndarray`
+    :param radii: a vector of ``n`` radii
+    :type radii: :class:`~numpy.ndarray`
+    :return: the index of the group of each point, and whether each point is close to at least another one
+    :rtype: (:class:`~numpy.ndarray`, :class:`~numpy.ndarray`)
+    """
+    n = len(centres)
+    parent = np.arange(n)
+    paired = np.zeros(n, np.bool_)
+
+    def find(a):
+        root = a
+        while parent[root] != root:
+            root = parent[root]
+        while parent[a] != root:
+            parent[a], a = root, parent[a]
+        return root
+
+    def union(a, b):
+        paired[a] = paired[b] = True
+        ra, rb = find(a), find(b)
+        if ra != rb:
+            parent[max(ra, rb)] = min(ra, rb)
+
+    positive = radii[radii > 0]
+    cell = float(np.median(positive)) if len(positive) > 0 else 1.0
+    keys = np.floor(centres / cell).astype(np.int64)
+
+    # the cells containing the centres
+    cells = {}
+    for i, (kx, ky) in enumerate(keys):
+        cells.setdefault((kx, ky), []).append(i)
+
+    # each point visits the cells covered by its own radius; very large points are compared to all points at once
+    max_span = 8
+    for a in range(n):
+        r = radii[a]
+        span = int(np.ceil(r / cell))
+        if span > max_span:
+            d = np.sqrt(np.sum((centres - centres[a]) ** 2, 1))
+            for b in np.where(d < r)[0]:
+                if b != a:
+                    union(a, b)
+            continue
+        kx, ky = keys[a]
+        for cx in range(kx - span, kx + span + 1):
+            for cy in range(ky - span, ky + span + 1):
+                for b in cells.get((cx, cy), ()):
+                    if b == a:
+                        continue
+                    dx, dy = centres[b] - centres[a]
+                    if dx * dx + dy * dy < r * r:
+                        union(a, b)
+
+    groups = np.array([find(i) for i in range(n)])
+    return groups, paired
+
 
 def merge_blobs(contours, prop = .5):
     """
@@ -14,46 +79,109 @@ def merge_blobs(contours, prop = .5):
     :param contours: list of contours
     :return: the convex hulls of the merged contours, list of contourss
     """
-    idx_pos_w = []
+    centres = np.zeros((len(contours), 2), np.float64)
+    radii = np.zeros(len(contours), np.float64)
     for i, c in enumerate(contours):
         (x,y) ,(w,h), angle  = cv2.minAreaRect(c)
         w = max(w,h)
         h = min(w,h)
-        idx_pos_w.append((i, x+1j*y,w + h))
-
-    pairs_to_group = []
-    for a,b in itertools.combinations(idx_pos_w,2):
-
-        d = abs(a[1] - b[1])
-        wm = max(a[2], b[2]) * prop
-        if d < wm:
-            pairs_to_group.append({a[0], b[0]})
+        centres[i] = x, y
+        radii[i] = (w + h) * prop
 
+    groups, paired = _proximity_groups(centres, radii)
 
-    if len(pairs_to_group) == 0:
+    if not np.any(paired):
         return contours
 
-    repeat = True
-    out_sets = pairs_to_group
-
-    while repeat:
-        comps = out_sets
-        out_sets = []
-        repeat=False
-        for s in comps:
-            connected = False
-            for i,o in enumerate(out_sets):
-                if o & s:
-                    out_sets[i] = s | out_sets[i]
-                    connected = True
-                    repeat=True
-            if not connected:
-                out_sets.append(s)
-
     out_hulls = []
-    for c in comps:
-        out_hulls.append(np.concatenate([contours[s] for s in c]))
+    for g in np.unique(groups[paired]):
+        members = np.where(groups == g)[0]
+        out_hulls.append(np.concatenate([contours[s] for s in members]))
 
     out_hulls= [cv2.convexHull(o) for o in out_hulls]
 
     return out_hulls
+
+
+class StreamingMedian(object):
+    def __init__(self, base=9, max_levels=3):
+        """
+        An approximate per-pixel median of a stream of images, computed with bounded memory (the "remedian").
+        Images are stored in a buffer of ``base`` slots. When it is full, their median is pushed to the buffer of the
+        next level, and so on. At most ``base * max_levels`` images are held, whatever the number of images.
+        The result is exact as long as no more than ``base`` images were added.
+
+        :param base: the number of images per level. Odd numbers avoid averaging two middle values.
+        :type base: int
+        :param max_levels: the number of levels. When the last level is full, it is collapsed to its median.
+        :type max_levels: int
+        """
+        if base < 1 or max_levels < 1:
+            raise ValueError("base and max_levels must be positive")
+        self._base = base
+        self._max_levels = max_levels
+        self._levels = []
+        self._counts = []
+        self._n = 0
+
+    @property
+    def n(self):
+        """
+        :return: the number of images added so far
+        :rtype: int
+        """
+        return self._n
+
+    def _median(self, stack, dtype):
+        # sorts ``stack`` in place, along its first axis, only as much as needed
+        n = len(stack)
+        if n % 2 == 0:
+            return np.median(stack, 0).astype(dtype)
+        stack.partition(n // 2, axis=0)
+        return stack[n // 2].astype(dtype)
+
+    def _push(self, level, img):
+        if level == len(self._levels):
+            self._levels.append(np.empty((self._base,) + img.shape, img.dtype))
+            self._counts.append(0)
+
+        buff = self._levels[level]
+        buff[self._counts[level]] = img
+        self._counts[level] += 1
+
+        if self._counts[level] == self._base:
+            med = self._median(buff, buff.dtype)
+            if level + 1 < self._max_levels:
+                self._counts[level] = 0
+                self._push(level + 1, med)
+            else:
+                buff[0] = med
+                self._counts[level] = 1
+
+    def update(self, img):
+        """
+        Add an image. It is copied, so the caller can reuse its buffer.
+
+        :param img: an image. All images must have the same shape and type.
+        :type img: :class:`~numpy.ndarray`
+        """
+        if len(self._levels) > 0 and img.shape != self._levels[0].shape[1:]:
+            raise ValueError("All images must have the same shape")
+        self._push(0, img)
+        self._n += 1
+
+    def get(self):
+        """
+        :return: the current median image, or ``None`` if no image was added
+        :rtype: :class:`~numpy.ndarray`
+        """
+        if self._n == 0:
+            return None
+        carried = None
+        for buff, count in zip(self._levels, self._counts):
+            values = [buff[i] for i in range(count)]
+            if carried is not None:
+                values.append(carried)
+            if len(values) > 0:
+                carried = self._median(np.array(values), buff.dtype)
+        return carried
@@ -1,5 +1,6 @@
 __author__ = 'quentin'
 import multiprocessing
+import threading
 import time, datetime
 import traceback
 import logging
@@ -7,9 +8,163 @@ from collections import OrderedDict
 import cv2
 import tempfile
 import os
+import shutil
+import struct
+import json
+import sqlite3
+import pickle
+from collections import deque
+import numpy as np
+from Queue import Empty
+
+
+class BaseAsyncSQLWriter(multiprocessing.Process):
+    # a transaction is committed once it holds this many commands, or once its first command is this old, in seconds
+    _commit_max_commands = 500
+    _commit_max_delay = 1.0
+
+    def __init__(self):
+        """
+        Template for the processes that run, asynchronously, the commands sent by a
+        :class:`~ethoscope.utils.io.ResultWriter` through a queue.
+        Subclasses must implement a ``_get_connection`` method.
+        Commands are grouped in transactions (group commit): all the commands available in the queue are run,
+        and committed together when the transaction is large or old enough (see ``_commit_max_commands`` and
+        ``_commit_max_delay``), or when the writer stops. The process waits for commands,
+        instead of polling the queue, and wakes up to commit old transactions.
+
+        Messages are ``(command, args, seq)``, where ``seq`` is an increasing sequence number.
+        The sequence number of the last committed command, and of the command that failed, if any,
+        are shared with the parent process, so that it can send again what was not committed.
+        """
+        # shared with the parent process (see `counters`)
+        self._counters = multiprocessing.Array("d", [0, 0, 0, 0, 0, -1])
+        super(BaseAsyncSQLWriter, self).__init__()
+
+    def _get_connection(self):
+        raise NotImplementedError
+
+    def _prepare(self):
+        # called in the writer process, before connecting
+        pass
+
+    def _close_connection(self, db):
+        # called in the writer process, once the last transaction is committed
+        db.close()
+
+    def _execute(self, cursor, command, args):
+        # a list of arguments is a batch of rows, inserted by the same (prepared) statement
+        if args is None:
+            cursor.execute(command)
+        elif isinstance(args, list):
+            cursor.executemany(command, args)
+        else:
+            cursor.execute(command, args)
+        return max(cursor.rowcount, 0)
+
+    def _next_batch(self, timeout):
+        # blocks until at least one command arrives (or `timeout`), then takes all the commands available
+        try:
+            batch = [self._queue.get(timeout=timeout)]
+        except Empty:
+            return []
+        while len(batch) < self._commit_max_commands:
+            try:
+                batch.append(self._queue.get_nowait())
+            except Empty:
+                break
+        return batch
+
+    def _commit(self, db, n_commands, n_rows, last_seq):
+        db.commit()
+        with self._counters.get_lock():
+            self._counters[0] += 1
+            self._counters[1] += n_commands
+            self._counters[2] += n_rows
+            self._counters[3] = max(self._counters[3], n_commands)
+            self._counters[4] = last_seq
+
+    @property
+    def counters(self):
+        """
+        :return: the number of commits, of committed commands and of committed rows,
+            the largest number of commands in a commit, the sequence number of the last committed command,
+            and the sequence number of the command that failed (``-1`` if none)
+        :rtype: (int, int, int, int, int, int)
+        """
+        with self._counters.get_lock():
+            return tuple(int(c) for c in self._counters)
+
+    def run(self):
+
+        db = None
+        do_run = True
+        command = None
+        n_commands, n_rows, transaction_start, last_seq = 0, 0, None, 0
+        try:
+            self._prepare()
+            db = self._get_connection()
+            c = db.cursor()
+            while do_run:
+                try:
+                    timeout = None
+                    if transaction_start is not None:
+                        timeout = max(0, transaction_start + self._commit_max_delay - time.time())
+
+                    for msg in self._next_batch(timeout):
+                        if (msg == 'DONE'):
+                            do_run=False
+                            break
+
+                        command, args, seq = msg
+                        try:
+                            n_rows += self._execute(c, command, args)
+                        except:
+                            self._counters[5] = seq
+                            raise
+                        n_commands += 1
+                        last_seq = seq
+                        if transaction_start is None:
+                            transaction_start = time.time()
+
+                    if n_commands > 0 and (not do_run or
+                                           n_commands >= self._commit_max_commands or
+                                           time.time() - transaction_start >= self._commit_max_delay):
+                        self._commit(db, n_commands, n_rows, last_seq)
+                        n_commands, n_rows, transaction_start = 0, 0, None
+
+                except:
+                    do_run = False
+                    try:
+                        logging.error("Failed to run database command:\n%s" % command)
+                    except:
+                        logging.error("Did not retrieve queue value")
+
+        except KeyboardInterrupt as e:
+            logging.warning("DB async process interrupted with KeyboardInterrupt")
+            raise e
+
+        except Exception as e:
+            logging.error("DB async process stopped with an exception")
+            raise e
+
+        finally:
+            logging.info("Closing async database writer")
+            # the commands that succeeded are kept
+            if db is not None and n_commands > 0:
+                try:
+                    self._commit(db, n_commands, n_rows, last_seq)
+                except Exception:
+                    logging.error("Could not commit the last transaction")
+            while not self._queue.empty():
+                self._queue.get()
 
+            self._queue.close()
+            if db is not None:
+                self._close_connection(db)
 
-class AsyncMySQLWriter(multiprocessing.Process):
+
+class AsyncMySQLWriter(BaseAsyncSQLWriter):
 
     def __init__(self, db_credentials, queue, erase_old_db=True):
         self._db_name = db_credentials["name"]
@@ -91,111 +246,193 @@ class AsyncMySQLWriter(multiprocessing.Process):
                   db=self._db_name)
         return db
 
-    def run(self):
-
-        db = None
-        do_run = True
-        try:
-            if self._erase_old_db:
-                self._delete_my_sql_db()
-                self._create_mysql_db()
-
-            db = self._get_connection()
-            while do_run:
-                try:
-                    msg = self._queue.get()
-
-                    if (msg == 'DONE'):
-                        do_run=False
-                        continue
-
-                    command, args = msg
-
-
-                    c = db.cursor()
-                    if args is None:
-                        c.execute(command)
-                    else:
-                        c.execute(command, args)
-
-                    db.commit()
-
-                except:
-                    do_run = False
-                    try:
-                        logging.error("Failed to run mysql command:\n%s" % command)
-                    except:
-                        logging.error("Did not retrieve queue value")
-
-                finally:
-                    if self._queue.empty():
-                        #we sleep iff we have an empty queue. this way, we don't over use a cpu
-                        time.sleep(.1)
-
-        except KeyboardInterrupt as e:
-            logging.warning("DB async process interrupted with KeyboardInterrupt")
-            raise e
-
-        except Exception as e:
-            logging.error("DB async process stopped with an exception")
-            raise e
-
-        finally:
-            logging.info("Closing async mysql writer")
-            while not self._queue.empty():
-                self._queue.get()
-
-            self._queue.close()
-            if db is not None:
-                db.close()
+    def _prepare(self):
+        if self._erase_old_db:
+            self._delete_my_sql_db()
+            self._create_mysql_db()
 
 class ImgToMySQLHelper(object):
     _table_name = "IMG_SNAPSHOTS"
-    def __init__(self, period=300.0):
+    # the size of the thumbnails compared to detect changes, in pixels
+    _thumbnail_size = (64, 48)
+    _min_quality = 10
+    _max_quality = 90
+    # how long to wait for the last snapshot to be encoded, when closing, in seconds
+    _close_timeout = 10.0
+
+    def __init__(self, period=300.0, bytes_per_hour=512 * 1024, change_threshold=1.0, max_period=3600.0, quality=50):
         """
-        :param period: how often snapshots are saved, in seconds
-        :return:
+        Takes periodic snapshots of frames, as JPEG. Frames are encoded, in memory, by a background thread,
+        so the tracking loop only copies a frame into a buffer, when a snapshot is due.
+        A snapshot is skipped when the frame has not changed since the last saved snapshot, that is when the mean
+        absolute difference between their thumbnails is below ``change_threshold`` (in grey levels).
+        The JPEG quality is adapted, after each snapshot, so that snapshots take about ``bytes_per_hour``.
+
+        :param period: how often snapshots are taken, in seconds
+        :type period: float
+        :param bytes_per_hour: the size of the snapshots of one hour, in bytes
+        :type bytes_per_hour: int
+        :param change_threshold: the smallest change between two saved snapshots
+        :type change_threshold: float
+        :param max_period: unchanged frames are saved anyway when the last snapshot is this old, in seconds
+        :type max_period: float
+        :param quality: the JPEG quality of the first snapshot
+        :type quality: int
         """
 
         self._period = period
+        self._bytes_per_hour = bytes_per_hour
+        self._change_threshold = change_threshold
+        self._max_period = max_period
+        self._quality = quality
         self._last_tick = 0
-        self._tmp_file = tempfile.mktemp(prefix="ethoscope_", suffix=".jpg")
-
-    def __del__(self):
-        try:
-            os.remove(self._tmp_file)
-        except:
-            logging.error("Could not remove temp file: %s" % self._tmp_file)
 
+        # the frame to encode, and its time. Only the background thread reads them, when `_pending` is set
+        self._frame = None
+        self._frame_t = None
+        self._pending = threading.Event()
+        self._stopping = False
+        self._thread = None
+        # the (t, jpeg) of the snapshots encoded, but not yet collected by `flush`
+        self._done = deque()
+
+        self._last_thumbnail = None
+        self._last_saved_t = None
+        self._n_saved, self._n_unchanged, self._n_busy, self._n_bytes = 0, 0, 0, 0
+
+    def _start(self):
+        self._thread = threading.Thread(target=self._run, name="snapshot_encoder")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            self._pending.wait()
+            if self._stopping and self._frame_t is None:
+                return
+            try:
+                self._encode(self._frame, self._frame_t)
+            except Exception:
+                logging.error("Could not encode a snapshot:\n%s" % traceback.format_exc())
+            finally:
+                self._frame_t = None
+                self._pending.clear()
+
+    def _encode(self, frame, t):
+        thumbnail = cv2.resize(frame, self._thumbnail_size, interpolation=cv2.INTER_AREA).astype(np.float32)
+        if self._last_thumbnail is not None and t - self._last_saved_t < self._max_period * 1000:
+            if np.mean(np.abs(thumbnail - self._last_thumbnail)) < self._change_threshold:
+                self._n_unchanged += 1
+                return
+
+        target = self._bytes_per_hour * self._period / 3600.0
+        jpeg = self._imencode(frame)
+        if len(jpeg) > 1.5 * target and self._quality > self._min_quality:
+            # much too large. As the encoding is not in the tracking loop, it can be done again
+            self._adapt_quality(len(jpeg), target)
+            jpeg = self._imencode(frame)
+        self._adapt_quality(len(jpeg), target)
+
+        self._last_thumbnail = thumbnail
+        self._last_saved_t = t
+        self._n_saved += 1
+        self._n_bytes += len(jpeg)
+        self._done.append((int(t), jpeg.tostring()))
+
+    def _imencode(self, frame):
+        _, jpeg = cv2.imencode(".jpg", frame, [int(cv2.IMWRITE_JPEG_QUALITY), self._quality])
+        return jpeg
+
+    def _adapt_quality(self, size, target):
+        # the size of a JPEG grows, at most, linearly with the quality, so this converges without oscillating
+        quality = int(round(self._quality * float(target) / size))
+        self._quality = min(max(quality, self._min_quality), self._max_quality)
+
+    def is_due(self, t):
+        """
+        :param t: the time since start of the experiment, in ms
+        :return: whether a frame given to :meth:`flush` at time ``t`` would be used for a snapshot
+        :rtype: bool
+        """
+        return int(round((t/1000.0)/self._period)) != self._last_tick
 
     def flush(self, t, img):
         """
+        Hands a copy of ``img`` to the encoder if a snapshot is due. If the encoder is still busy with the previous
+        snapshot, the next frame is tried.
 
         :param t: the time since start of the experiment, in ms
         :param img: an array representing an image.
         :type img: np.ndarray
-        :return:
+        :return: the time and the JPEG of the snapshots encoded since the last call (see :meth:`collect`)
+        :rtype: list((int, str))
         """
 
         tick = int(round((t/1000.0)/self._period))
-        if tick == self._last_tick:
-            return
-
-        cv2.imwrite(self._tmp_file, img, [int(cv2.IMWRITE_JPEG_QUALITY), 50])
+        if tick != self._last_tick:
+            if self._pending.is_set():
+                self._n_busy += 1
+            else:
+                if self._frame is None or self._frame.shape != img.shape or self._frame.dtype != img.dtype:
+                    self._frame = np.empty_like(img)
+                np.copyto(self._frame, img)
+                self._frame_t = t
+                self._last_tick = tick
+                if self._thread is None:
+                    self._start()
+                self._pending.set()
+
+        return self.collect()
+
+    def collect(self):
+        """
+        Snapshots are encoded in the background, so they are ready after the call that handed their frame.
+        This must be called regularly, even when no frame is due, so that they are saved as soon as possible.
 
-        bstring = open(self._tmp_file, "rb").read()
-        cmd = 'INSERT INTO ' + self._table_name + '(id,t,img) VALUES(%s,%s,%s)'
+        :return: the time and the JPEG of the snapshots encoded, and not collected yet
+        :rtype: list((int, str))
+        """
+        out = []
+        while len(self._done) > 0:
+            out.append(self._done.popleft())
+        return out
 
-        args = (0, int(t), bstring)
+    def close(self):
+        """
+        Waits for the snapshot being encoded, if any, and stops the encoder.
 
-        self._last_tick = tick
+        :return: the time and the JPEG of the snapshots that were not collected by :meth:`flush`
+        :rtype: list((int, str))
+        """
+        if self._thread is not None:
+            deadline = time.time() + self._close_timeout
+            while self._pending.is_set() and time.time() < deadline:
+                time.sleep(0.01)
+            self._stopping = True
+            self._pending.set()
+            self._thread.join(max(deadline - time.time(), 0))
+            self._thread = None
+        return self.collect()
 
-        return cmd, args
+    @property
+    def stats(self):
+        """
+        :return: the number of saved snapshots, of snapshots skipped because the frame did not change, and of
+            frames skipped because the encoder was busy. Also, the size of the saved snapshots and the current quality.
+        :rtype: dict
+        """
+        return {"saved": self._n_saved,
+                "unchanged": self._n_unchanged,
+                "busy": self._n_busy,
+                "bytes": self._n_bytes,
+                "quality": self._quality}
 
 class DAMFileHelper(object):
 
     def __init__(self, period=60.0, n_rois=32):
         self._period = period
+        # the tick of the last flush
+        self._last_tick = None
 
 
         self._activity_accum = OrderedDict()
@@ -260,10 +497,19 @@ class DAMFileHelper(object):
         return command
 
 
+    def is_due(self, t):
+        """
+        :param t: the time since start of the experiment, in ms
+        :return: whether :meth:`flush` at time ``t`` would write a new period
+        :rtype: bool
+        """
+        return int(round((t/1000.0)/self._period)) != self._last_tick
+
     def flush(self, t):
 
         out =  OrderedDict()
         tick = int(round((t/1000.0)/self._period))
+        self._last_tick = tick
 
         if len(self._activity_accum) < 1:
             self._activity_accum[tick] = OrderedDict()
@@ -298,16 +544,214 @@ class DAMFileHelper(object):
 
         return out
 
+class SpillLog(object):
+    def __init__(self, path):
+        """
+        An append-only log of database commands, on disk, that are read back in order.
+        Records are pickled, and prefixed by their length. The offset of the first record that was not
+        committed (see :meth:`commit`) is saved next to the log, so that, after a crash, reading resumes from there.
+        An incomplete last record (e.g. after a crash whilst appending) is dropped.
+        The log is emptied once all its records are committed.
+
+        :param path: the file of the log. Its directory is created if needed.
+        :type path: str
+        """
+        self._path = path
+        self._offset_path = path + ".offset"
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self._committed = 0
+        try:
+            with open(self._offset_path) as f:
+                self._committed = int(f.read())
+        except (IOError, ValueError):
+            pass
+
+        self._size = self._valid_size()
+        self._file = open(path, "ab")
+        self._file.truncate(self._size)
+        self._committed = min(self._committed, self._size)
+        self._read_offset = self._committed
+
+    def _valid_size(self):
+        if not os.path.exists(self._path):
+            return 0
+        size = os.path.getsize(self._path)
+        offset = 0
+        with open(self._path, "rb") as f:
+            while offset + 4 <= size:
+                f.seek(offset)
+                n = struct.unpack("<I", f.read(4))[0]
+                if offset + 4 + n > size:
+                    break
+                offset += 4 + n
+        if offset < size:
+            logging.warning("Dropping an incomplete record at the end of the spill log %s" % self._path)
+        return offset
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def empty(self):
+        """
+        :return: whether all records were read
+        :rtype: bool
+        """
+        return self._read_offset >= self._size
+
+    @property
+    def pending_bytes(self):
+        """
+        :return: the size of the records that were not committed
+        :rtype: int
+        """
+        return self._size - self._committed
+
+    def append(self, record):
+        """
+        :param record: a picklable object
+        """
+        data = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+        self._file.write(struct.pack("<I", len(data)) + data)
+        self._file.flush()
+        self._size += 4 + len(data)
+
+    def read(self, max_records):
+        """
+        Reads the next records. They are not removed from the log until they are committed.
+
+        :param max_records: the largest number of records to read
+        :type max_records: int
+        :return: the records, each with the offset following it (see :meth:`commit`)
+        :rtype: list((int, object))
+        """
+        out = []
+        with open(self._path, "rb") as f:
+            f.seek(self._read_offset)
+            while len(out) < max_records and self._read_offset < self._size:
+                n = struct.unpack("<I", f.read(4))[0]
+                record = pickle.loads(f.read(n))
+                self._read_offset += 4 + n
+                out.append((self._read_offset, record))
+        return out
+
+    def commit(self, offset):
+        """
+        Marks the records before ``offset`` as done.
+
+        :param offset: an offset returned by :meth:`read`
+        :type offset: int
+        """
+        if offset >= self._size and self._read_offset >= self._size:
+            self._file.truncate(0)
+            self._size, self._read_offset, offset = 0, 0, 0
+        self._committed = offset
+        tmp_path = self._offset_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(str(offset))
+        os.rename(tmp_path, self._offset_path)
+
+    def prepend(self, records):
+        """
+        Puts records before the records that were not read yet. Records that were read, but not committed, are dropped.
+
+        :param records: picklable objects
+        :type records: list
+        """
+        remaining = [r for _, r in self.read(float("inf"))]
+        self._file.truncate(0)
+        self._size = 0
+        for r in records + remaining:
+            self.append(r)
+        self._read_offset = 0
+        self.commit(0)
+
+    def close(self, remove_if_empty=True):
+        self._file.close()
+        if remove_if_empty and self._committed >= self._size:
+            for p in [self._path, self._offset_path]:
+                try:
+                    os.remove(p)
+                except OSError:
+                    pass
+
+
 class ResultWriter(object):
     # _flush_every_ns = 30 # flush every 10s of data
-    _max_insert_string_len = 1000
+    # rows are sent to the database, per ROI, by batches of at least this many
+    _max_insert_rows = 32
     _async_writing_class = AsyncMySQLWriter
     _null = 0
-    def __init__(self, db_credentials, rois, metadata=None, make_dam_like_table=True, take_frame_shots=False, erase_old_db=True, *args, **kwargs):
+    # the parameter marker of the database module
+    _placeholder = "%s"
+    _positions_table_name = "POSITIONS"
+    # commands go to the spill log when this many are waiting to be committed, or the oldest is this old, in seconds
+    _spill_max_pending = 2000
+    _spill_max_delay = 30.0
+    # the number of spilled commands sent to the writer at each flush
+    _spill_replay_batch = 200
+    # a stopped writer is restarted at most this often, in seconds
+    _restart_delay = 5.0
+    # a command that made the writer fail this many times is dropped
+    _max_command_failures = 3
+    # how long to wait for all commands to be sent to the writer, when closing, in seconds
+    _close_timeout = 60.0
+    # the rates reported by `stats` are measured over periods of this many seconds
+    _stats_interval = 10.0
+    def __init__(self, db_credentials, rois, metadata=None, make_dam_like_table=True, take_frame_shots=False, erase_old_db=True,
+                 positions_table=False, spill_path=None, *args, **kwargs):
+        """
+        Saves the data of an experiment in a database, asynchronously.
+        By default, each ROI has its own table, ``ROI_<idx>``.
+        With ``positions_table``, the rows of all ROIs go to a single ``POSITIONS`` table, indexed by ROI and time,
+        and are inserted together, whatever the number of ROIs. ``ROI_<idx>`` are then views of this table,
+        so that existing readers keep working. In both cases, ``VAR_MAP`` describes the variables (columns).
+
+        The commands that the writer process has not committed yet are kept. If the process stops, it is restarted,
+        and they are sent again. When the database falls behind (too many commands, or too old, are waiting),
+        or whilst the writer process is stopped, commands are appended to a :class:`~ethoscope.utils.io.SpillLog`,
+        on disk, instead of memory. They are sent, in order, once the database catches up.
+
+        :param db_credentials: the name of the database, and the user name and password to access it
+        :type db_credentials: dict
+        :param rois: the ROIs of the experiment
+        :type rois: list(:class:`~ethoscope.core.roi.ROI`)
+        :param metadata: saved in the ``METADATA`` table
+        :type metadata: dict
+        :param make_dam_like_table: whether to save activity in a ``CSV_DAM_ACTIVITY`` table
+        :type make_dam_like_table: bool
+        :param take_frame_shots: whether to save, periodically, a frame in an ``IMG_SNAPSHOTS`` table
+        :type take_frame_shots: bool
+        :param erase_old_db: whether to start a new database. Otherwise, data are appended (e.g. after a crash)
+        :type erase_old_db: bool
+        :param positions_table: whether to use a single table for all ROIs
+        :type positions_table: bool
+        :param spill_path: the file of the spill log. ``None`` means a temporary file.
+            With ``erase_old_db=False``, the commands left in this log (e.g. by a crash) are sent first.
+        :type spill_path: str
+        """
         self._queue = multiprocessing.JoinableQueue()
         self._async_writer = self._async_writing_class(db_credentials, self._queue, erase_old_db)
         self._async_writer.start()
         self._last_t, self._last_flush_t, self._last_dam_t = [0] * 3
+        # commits, commands and rows, and the largest commit, of the writers that were restarted
+        self._past_counters = (0, 0, 0, 0)
+        # the time and the total counters at the start of the current stats interval, and the rates of the last one
+        self._stats_window = (time.time(), self._total_counters())
+        self._rates = {"commits_per_s": None, "rows_per_commit": None, "commands_per_commit": None}
+
+        # the commands sent to the writer, and not committed yet, as [seq, time, command, args, spill offset, n failures]
+        self._unacknowledged = deque()
+        self._seq = 0
+        self._n_restarts = 0
+        self._last_restart = 0
+        self._n_spilled = 0
+        self._spill_path = spill_path
+        self._spill_log = self._open_spill_log(spill_path, erase_old_db)
 
         self._metadata = metadata
         self._rois = rois
@@ -315,6 +759,7 @@ class ResultWriter(object):
 
         self._make_dam_like_table = make_dam_like_table
         self._take_frame_shots = take_frame_shots
+        self._positions_table = positions_table
 
         if make_dam_like_table:
             self._dam_file_helper = DAMFileHelper(n_rois=len(rois))
@@ -326,7 +771,9 @@ class ResultWriter(object):
         else:
             self._shot_saver = None
 
+        # the rows waiting to be sent, and the statement inserting them, per ROI
         self._insert_dict = {}
+        self._insert_commands = {}
         if self._metadata is None:
             self._metadata  = {}
 
@@ -383,14 +830,67 @@ class ResultWriter(object):
     def metadata(self):
         return self._metadata
 
+    @property
+    def stats(self):
+        """
+        Reading the stats has no side effect, so any number of readers (e.g. the web interface) can poll them.
+
+        :return: the activity of the database writer: the total number of commits, commands and rows,
+            and the largest commit (in commands). Commits per second, rows and commands per commit, are measured
+            over the last complete period of ``_stats_interval`` seconds (``None`` before).
+            Also, the number of commands waiting in the queue,
+            and the activity of the snapshot encoder (see :attr:`~ethoscope.utils.io.ImgToMySQLHelper.stats`).
+        :rtype: dict
+        """
+        n_commits, n_commands, n_rows, largest_commit = self._total_counters()
+        try:
+            queue_depth = self._queue.qsize()
+        except NotImplementedError:
+            queue_depth = None
+
+        return {"commits_per_s": self._rates["commits_per_s"],
+                "rows_per_commit": self._rates["rows_per_commit"],
+                "commands_per_commit": self._rates["commands_per_commit"],
+                "largest_commit": largest_commit,
+                "commits": n_commits,
+                "commands": n_commands,
+                "rows": n_rows,
+                "queue_depth": queue_depth,
+                "uncommitted": len(self._unacknowledged),
+                "spilled_commands": self._n_spilled,
+                "spill_pending_bytes": self._spill_log.pending_bytes,
+                "writer_restarts": self._n_restarts,
+                "snapshots": self._shot_saver.stats if self._shot_saver is not None else None}
+
+    def _total_counters(self):
+        # commits, commands, rows and largest commit, of all writers since the start
+        counters = self._async_writer.counters
+        past = self._past_counters
+        return past[0] + counters[0], past[1] + counters[1], past[2] + counters[2], max(past[3], counters[3])
+
+    def _update_rates(self):
+        now = time.time()
+        start, start_counters = self._stats_window
+        if now - start < self._stats_interval or now <= start:
+            return
+        counters = self._total_counters()
+        n_commits, n_commands, n_rows = [a - b for a, b in zip(counters[0:3], start_counters[0:3])]
+        self._rates = {"commits_per_s": round(n_commits / (now - start), 2),
+                       "rows_per_commit": round(float(n_rows) / n_commits, 1) if n_commits > 0 else None,
+                       "commands_per_commit": round(float(n_commands) / n_commits, 1) if n_commits > 0 else None}
+        self._stats_window = (now, counters)
+
     def write(self, t, roi, data_rows):
 
         #fixme
         dr = data_rows[0]
 
         if not self._var_map_initialised:
-            for r in self._rois:
-                self._initialise(r, dr)
+            if self._positions_table:
+                self._initialise_positions_table(dr)
+            else:
+                for r in self._rois:
+                    self._initialise(r, dr)
             self._initialise_var_map(dr)
 
         self._add(t, roi, data_rows)
@@ -401,21 +901,52 @@ class ResultWriter(object):
         if self._dam_file_helper is not None:
             self._dam_file_helper.input_roi_data(t, roi, dr)
 
-    def flush(self, t, img=None):
-        if self._dam_file_helper is not None:
+    def snapshot_due(self, t):
+        """
+        :param t: the time since start of the experiment, in ms
+        :return: whether :meth:`flush` needs the frame at time ``t``, to take a snapshot
+        :rtype: bool
+        """
+        return self._shot_saver is not None and self._shot_saver.is_due(t)
+
+    def dam_due(self, t):
+        """
+        :param t: the time since start of the experiment, in ms
+        :return: whether :meth:`flush`, with ``dam=True``, would write the DAM-like activity of a new period
+        :rtype: bool
+        """
+        return self._dam_file_helper is not None and self._dam_file_helper.is_due(t)
+
+    def flush(self, t, img=None, dam=True):
+        """
+        Send the accumulated data to the database.
+
+        :param t: the time since start of the experiment, in ms
+        :param img: the last frame, used to take snapshots. ``None`` means no snapshot is taken (it is postponed).
+        :type img: :class:`~numpy.ndarray`
+        :param dam: whether to flush the DAM-like activity table. When ``False``, activity keeps being accumulated.
+        :type dam: bool
+        """
+        self._check_async_writer()
+        self._replay_spill_log()
+        self._update_rates()
+
+        if dam and self._dam_file_helper is not None:
             out = self._dam_file_helper.flush(t)
             for c in out:
                 self._write_async_command(c)
 
-        if self._shot_saver is not None and img is not None:
-            c_args = self._shot_saver.flush(t, img)
-            if c_args is not None:
-                self._write_async_command(*c_args)
+        if self._shot_saver is not None:
+            # the snapshots encoded since the last flush are saved, whether or not a new frame is given
+            shots = self._shot_saver.flush(t, img) if img is not None else self._shot_saver.collect()
+            for shot_t, jpeg in shots:
+                self._write_async_command(*self._snapshot_command(shot_t, jpeg))
 
-        for k, v in self._insert_dict.items():
-            if len(v) > self._max_insert_string_len:
-                self._write_async_command(v)
-                self._insert_dict[k] = ""
+        for key, rows in self._insert_dict.items():
+            # all ROIs share the batch of the positions table
+            batch_size = self._max_insert_rows * (len(self._rois) if key == self._positions_table_name else 1)
+            if len(rows) >= batch_size:
+                self._flush_rows(key)
 
         return False
 
@@ -423,16 +954,32 @@ class ResultWriter(object):
 
     def _add(self, t, roi, data_rows):
         t = int(round(t))
-        roi_id = roi.idx
-
+        if self._positions_table:
+            rows = self._insert_dict.setdefault(self._positions_table_name, [])
+            prefix = (roi.idx, t)
+        else:
+            rows = self._insert_dict.setdefault(roi.idx, [])
+            prefix = (t,)
+        # plain ints, which are compact to send to the writer process
         for dr in data_rows:
-            tp = (0, t) + tuple(dr.values())
+            rows.append(prefix + tuple(int(v) for v in dr.values()))
 
-            if roi_id not in self._insert_dict  or self._insert_dict[roi_id] == "":
-                command = 'INSERT INTO ROI_%i VALUES %s' % (roi_id, str(tp))
-                self._insert_dict[roi_id] = command
-            else:
-                self._insert_dict[roi_id] += ("," + str(tp))
+    def _snapshot_command(self, t, jpeg):
+        command = "INSERT INTO %s (t, img) VALUES (%s, %s)" % (ImgToMySQLHelper._table_name,
+                                                               self._placeholder, self._placeholder)
+        return command, (t, jpeg)
+
+    def _flush_rows(self, key):
+        # `key` is a ROI index, or the name of the positions table
+        rows = self._insert_dict.get(key)
+        if not rows:
+            return
+        self._write_async_command(self._insert_commands[key], rows)
+        self._insert_dict[key] = []
+
+    def _insert_command(self, table_name, columns):
+        return "INSERT INTO %s (%s) VALUES (%s)" % (table_name, ", ".join(columns),
+                                                    ", ".join([self._placeholder] * len(columns)))
 
     def _initialise_var_map(self,  data_row):
         logging.info("Filling 'VAR_MAP' with values")
@@ -455,21 +1002,59 @@ class ResultWriter(object):
         table_name = "ROI_%i" % roi.idx
         self._create_table(table_name, fields)
 
+        # the id is left to the database
+        columns = ["t"] + [dt.header_name for dt in data_row.values()]
+        self._insert_commands[roi.idx] = self._insert_command(table_name, columns)
+
+    def _positions_table_fields(self, data_row):
+        # the rows of a ROI are clustered, in time order. The id is indexed for incremental backups
+        fields = ["id INT NOT NULL AUTO_INCREMENT", "roi_idx SMALLINT NOT NULL", "t INT NOT NULL"]
+        for dt in data_row.values():
+            fields.append("%s %s" % (dt.header_name, dt.sql_data_type))
+        fields += ["PRIMARY KEY (roi_idx, t, id)", "KEY (id)"]
+        return ", ".join(fields)
+
+    def _initialise_positions_table(self, data_row):
+        logging.info("Creating table '%s', for all ROIs" % self._positions_table_name)
+        self._create_table(self._positions_table_name, self._positions_table_fields(data_row))
+
+        variables = [dt.header_name for dt in data_row.values()]
+        for r in self._rois:
+            select = "SELECT id, t, %s FROM %s WHERE roi_idx = %i" % (", ".join(variables), self._positions_table_name, r.idx)
+            self._create_view("ROI_%i" % r.idx, select)
+
+        columns = ["roi_idx", "t"] + variables
+        self._insert_commands[self._positions_table_name] = self._insert_command(self._positions_table_name, columns)
+
+    def _create_view(self, name, select):
+        command = "CREATE OR REPLACE VIEW %s AS %s" % (name, select)
+        logging.info("Creating database view with: " + command)
+        self._write_async_command(command)
+
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         logging.info("Closing result writer...")
-        for k, v in self._insert_dict.items():
-            self._write_async_command(v)
-            self._insert_dict[k] = ""
+        for key in self._insert_dict.keys():
+            self._flush_rows(key)
+        if self._shot_saver is not None:
+            for shot_t, jpeg in self._shot_saver.close():
+                self._write_async_command(*self._snapshot_command(shot_t, jpeg))
 
         try:
             command = "INSERT INTO METADATA VALUES %s" % str(("stop_date_time", str(int(time.time()))))
             self._write_async_command(command)
-            while not self._queue.empty():
+            # spilled commands are sent too
+            deadline = time.time() + self._close_timeout
+            while not self._spill_log.empty or not self._queue.empty() or not self._async_writer.is_alive():
+                if time.time() > deadline:
+                    logging.error("Timeout whilst waiting for the database writer")
+                    break
                 logging.info("waiting for queue to be processed")
+                self._check_async_writer()
+                self._replay_spill_log()
                 time.sleep(.1)
 
         except Exception as e:
@@ -486,13 +1071,110 @@ class ResultWriter(object):
             self._async_writer.join()
             logging.info("Joined OK")
 
+            self._check_async_writer(restart=False)
+            if len(self._unacknowledged) > 0:
+                # kept for a later attempt (see `spill_path`)
+                logging.error("%i database commands were not committed. They are saved in %s" %
+                              (len(self._unacknowledged), self._spill_log.path))
+                self._spill_log.prepend([(e[2], e[3]) for e in self._unacknowledged])
+            self._spill_log.close(remove_if_empty=True)
+
     def close(self):
         pass
 
+    def _open_spill_log(self, spill_path, erase_old_db):
+        if spill_path is None:
+            fd, spill_path = tempfile.mkstemp(prefix="ethoscope_spill_", suffix=".log")
+            os.close(fd)
+        elif erase_old_db and os.path.exists(spill_path) and os.path.getsize(spill_path) > 0:
+            # the commands of another experiment must not go to this new database
+            orphan_path = "%s.%i.orphan" % (spill_path, int(time.time()))
+            logging.warning("Moving the spill log of a previous experiment to %s" % orphan_path)
+            os.rename(spill_path, orphan_path)
+            try:
+                os.remove(spill_path + ".offset")
+            except OSError:
+                pass
+
+        spill_log = SpillLog(spill_path)
+        if not spill_log.empty:
+            logging.warning("Sending %i bytes of database commands left in %s" % (spill_log.pending_bytes, spill_path))
+        return spill_log
+
+    def _send(self, command, args, spill_offset=None, n_failures=0):
+        self._seq += 1
+        self._unacknowledged.append([self._seq, time.time(), command, args, spill_offset, n_failures])
+        self._queue.put((command, args, self._seq))
+
+    def _must_spill(self):
+        # once commands are spilled, all commands are, until the log is replayed, to keep them in order
+        if not self._spill_log.empty or not self._async_writer.is_alive():
+            return True
+        if len(self._unacknowledged) >= self._spill_max_pending:
+            return True
+        return len(self._unacknowledged) > 0 and time.time() - self._unacknowledged[0][1] > self._spill_max_delay
+
+    def _acknowledge(self):
+        last_seq = self._async_writer.counters[4]
+        spill_offset = None
+        while len(self._unacknowledged) > 0 and self._unacknowledged[0][0] <= last_seq:
+            entry = self._unacknowledged.popleft()
+            if entry[4] is not None:
+                spill_offset = entry[4]
+        if spill_offset is not None:
+            self._spill_log.commit(spill_offset)
+
+    def _check_async_writer(self, restart=True):
+        self._acknowledge()
+        if self._async_writer.is_alive():
+            return
+        if not restart or time.time() - self._last_restart < self._restart_delay:
+            return
+
+        # a command that always fails (e.g. invalid) must not stop the writer forever
+        counters = self._async_writer.counters
+        failed_seq = counters[5]
+        if len(self._unacknowledged) > 0 and self._unacknowledged[0][0] == failed_seq:
+            self._unacknowledged[0][5] += 1
+            if self._unacknowledged[0][5] >= self._max_command_failures:
+                entry = self._unacknowledged.popleft()
+                logging.error("Dropping a database command that failed %i times:\n%s" % (entry[5], entry[2]))
+                if entry[4] is not None:
+                    self._spill_log.commit(entry[4])
+
+        logging.error("Async database writer has stopped unexpectedly. Restarting it")
+        self._queue.cancel_join_thread()
+        self._queue = multiprocessing.JoinableQueue()
+        self._async_writer = self._async_writing_class(self._db_credentials, self._queue, False)
+        self._async_writer.start()
+        self._last_restart = time.time()
+        self._n_restarts += 1
+        # the counters of the new writer start from zero
+        past = self._past_counters
+        self._past_counters = (past[0] + counters[0], past[1] + counters[1], past[2] + counters[2],
+                               max(past[3], counters[3]))
+
+        # what was not committed is sent again, in order
+        pending = list(self._unacknowledged)
+        self._unacknowledged.clear()
+        for _, _, command, args, spill_offset, n_failures in pending:
+            self._send(command, args, spill_offset, n_failures)
+
+    def _replay_spill_log(self):
+        if self._spill_log.empty or not self._async_writer.is_alive():
+            return
+        room = min(self._spill_max_pending // 2 - len(self._unacknowledged), self._spill_replay_batch)
+        if room <= 0:
+            return
+        for offset, (command, args) in self._spill_log.read(room):
+            self._send(command, args, offset)
+
     def _write_async_command(self, command, args=None):
-        if not self._async_writer.is_alive():
-            raise Exception("Async database writer has stopped unexpectedly")
-        self._queue.put((command, args))
+        if self._must_spill():
+            self._spill_log.append((command, args))
+            self._n_spilled += 1
+        else:
+            self._send(command, args)
 
     def _create_table(self, name, fields, engine="InnoDB"):
         command = "CREATE TABLE IF NOT EXISTS %s (%s) ENGINE %s KEY_BLOCK_SIZE=16" % (name, fields, engine)
@@ -506,12 +1188,14 @@ class ResultWriter(object):
                          "metadata": self._metadata,
                          "make_dam_like_table": self._make_dam_like_table,
                          "take_frame_shots": self._take_frame_shots,
-                         "erase_old_db": False}}
+                         "erase_old_db": False,
+                         "positions_table": self._positions_table,
+                         "spill_path": self._spill_path}}
 
     def __setstate__(self, state):
         self.__init__(**state["args"])
 
-class AsyncSQLiteWriter(multiprocessing.Process):
+class AsyncSQLiteWriter(BaseAsyncSQLWriter):
     _pragmas = {"temp_store": "MEMORY",
                 "journal_mode": "OFF",
                 "locking_mode":  "EXCLUSIVE"}
@@ -528,74 +1212,78 @@ class AsyncSQLiteWriter(multiprocessing.Process):
             except:
                 pass
 
+            # the writer process opens its own connection, so this one is closed once the file is set up
             conn = self._get_connection()
+            try:
+                c = conn.cursor()
+                logging.info("Setting DB parameters'")
+                for k,v in self._pragmas.items():
+                    command = "PRAGMA %s = %s" %(str(k), str(v))
+                    c.execute(command)
+            finally:
+                conn.close()
 
-            c = conn.cursor()
-            logging.info("Setting DB parameters'")
-            for k,v in self._pragmas.items():
-                command = "PRAGMA %s = %s" %(str(k), str(v))
-                c.execute(command)
-
-        
     def _get_connection(self):
         import sqlite3
         db =   sqlite3.connect(self._db_name)
         return db
 
+    def _execute(self, cursor, command, args):
+        # binary data is sent as bytearray, as buffers cannot be pickled
+        if isinstance(args, tuple):
+            args = tuple(sqlite3.Binary(a) if isinstance(a, bytearray) else a for a in args)
+        return super(AsyncSQLiteWriter, self)._execute(cursor, command, args)
 
-    def run(self):
-
-        db = None
-        do_run = True
-        try:
-            db = self._get_connection()
-            while do_run:
-                try:
-                    msg = self._queue.get()
-
-                    if (msg == 'DONE'):
-                        do_run=False
-                        continue
-
-                    command, args = msg
 
+class AsyncWALSQLiteWriter(AsyncSQLiteWriter):
+    _pragmas = {"temp_store": "MEMORY",
+                "journal_mode": "WAL",
+                "synchronous": "NORMAL",
+                # checkpoints are run by the writer itself, between transactions (see `_checkpoint_period`)
+                "wal_autocheckpoint": 0}
+    _commit_max_commands = 2000
+    _commit_max_delay = 2.0
+    # the WAL is copied back into the database at most this often, in seconds
+    _checkpoint_period = 30.0
+    # statements are prepared once and cached by the connection. There is one insert statement per ROI table
+    _cached_statements = 512
 
-                    c = db.cursor()
-                    if args is None:
-                        c.execute(command)
-                    else:
-                        c.execute(command, args)
-
-                    db.commit()
-
-                except:
-                    do_run=False
-                    try:
-                        logging.error("Failed to run mysql command:\n%s" % command)
-                    except:
-                        logging.error("Did not retrieve queue value")
+    def __init__(self, db_name, queue, erase_old_db=True):
+        """
+        A crash-safe SQLite writer.
+        The database is written through a write-ahead log (WAL), with ``synchronous=NORMAL``:
+        a crash, or a power cut, can lose the last transactions, but never corrupts the database.
+        Readers (e.g. a live dashboard, or a backup) can query the database while it is written,
+        without blocking the writer, and without being blocked.
+        Transactions are larger than those of :class:`~ethoscope.utils.io.AsyncSQLiteWriter`, and the WAL is
+        checkpointed (i.e. written back into the database) by the writer, between transactions, every
+        ``_checkpoint_period`` seconds. The WAL is emptied when the writer stops, so the database is a single file again.
+        """
+        super(AsyncWALSQLiteWriter, self).__init__(db_name, queue, erase_old_db)
+        self._last_checkpoint = 0
 
-                finally:
-                    if self._queue.empty():
-                        #we sleep iff we have an empty queue. this way, we don't over use a cpu
-                        time.sleep(.1)
+    def _get_connection(self):
+        import sqlite3
+        db = sqlite3.connect(self._db_name, cached_statements=self._cached_statements)
+        # unlike the WAL mode, most pragmas only apply to the connection that sets them
+        for k, v in self._pragmas.items():
+            db.execute("PRAGMA %s = %s" % (str(k), str(v)))
+        self._last_checkpoint = time.time()
+        return db
 
-        except KeyboardInterrupt as e:
-            logging.warning("DB async process interrupted with KeyboardInterrupt")
-            raise e
+    def _commit(self, db, n_commands, n_rows, last_seq):
+        super(AsyncWALSQLiteWriter, self)._commit(db, n_commands, n_rows, last_seq)
+        if time.time() - self._last_checkpoint >= self._checkpoint_period:
+            # passive checkpoints do not wait for readers
+            db.execute("PRAGMA wal_checkpoint(PASSIVE)")
+            self._last_checkpoint = time.time()
 
+    def _close_connection(self, db):
+        try:
+            db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
         except Exception as e:
-            logging.error("DB async process stopped with an exception")
-            raise e
-
-        finally:
-            logging.info("Closing async mysql writer")
-            while not self._queue.empty():
-                self._queue.get()
-
-            self._queue.close()
-            if db is not None:
-                db.close()
+            logging.warning("Could not checkpoint the WAL of %s: %s" % (self._db_name, str(e)))
+        db.close()
 
 class Null(object):
     def __repr__(self):
@@ -606,6 +1294,7 @@ class Null(object):
 class SQLiteResultWriter(ResultWriter):
     _async_writing_class = AsyncSQLiteWriter
     _null= Null()
+    _placeholder = "?"
     def __init__(self, db_credentials, rois, metadata=None, make_dam_like_table=False, take_frame_shots=False, *args, **kwargs):
         super(SQLiteResultWriter, self).__init__(db_credentials, rois, metadata,make_dam_like_table, take_frame_shots, *args, **kwargs)
 
@@ -617,16 +1306,457 @@ class SQLiteResultWriter(ResultWriter):
         logging.info("Creating database table with: " + command)
         self._write_async_command(command)
 
-    def _add(self, t, roi, data_rows):
-        t = int(round(t))
-        roi_id = roi.idx
+    def _positions_table_fields(self, data_row):
+        # the id is the rowid, so it is set by SQLite
+        fields = ["id INTEGER PRIMARY KEY", "roi_idx SMALLINT", "t INT"]
+        for dt in data_row.values():
+            fields.append("%s %s" % (dt.header_name, dt.sql_data_type))
+        return ", ".join(fields)
+
+    def _initialise_positions_table(self, data_row):
+        super(SQLiteResultWriter, self)._initialise_positions_table(data_row)
+        self._write_async_command("CREATE INDEX IF NOT EXISTS %s_roi_t ON %s (roi_idx, t)" %
+                                  (self._positions_table_name, self._positions_table_name))
+
+    def _create_view(self, name, select):
+        command = "CREATE VIEW IF NOT EXISTS %s AS %s" % (name, select)
+        logging.info("Creating database view with: " + command)
+        self._write_async_command(command)
+
+    def _snapshot_command(self, t, jpeg):
+        # a bytearray is stored as a BLOB (see `AsyncSQLiteWriter`), a string would be stored as TEXT
+        command, (t, jpeg) = super(SQLiteResultWriter, self)._snapshot_command(t, jpeg)
+        return command, (t, bytearray(jpeg))
+
+
+class WALSQLiteResultWriter(SQLiteResultWriter):
+    # a crash-safe SQLite result file, that can be read while it is written (see `AsyncWALSQLiteWriter`)
+    _async_writing_class = AsyncWALSQLiteWriter
+
+
+def _segment_index(path, row_bytes, magic):
+    """
+    Finds the segments of a columnar ROI file (see :class:`~ethoscope.utils.io.ColumnarResultWriter`).
+    Footers are read from the end of the file. If the file does not end with a complete segment
+    (e.g. after a crash), headers are read from its start instead, up to the first incomplete segment.
+
+    :return: the offset of the data and the number of rows of each segment, and the end of the last complete segment
+    :rtype: (list((int, int)), int)
+    """
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        segments = []
+        end = size
+        while end > 0:
+            if end < 16:
+                break
+            f.seek(end - 8)
+            n_rows, footer_magic = struct.unpack("<I4s", f.read(8))
+            start = end - 8 - n_rows * row_bytes - 8
+            if footer_magic != magic or start < 0:
+                break
+            f.seek(start)
+            header_magic, header_n_rows = struct.unpack("<4sI", f.read(8))
+            if header_magic != magic or header_n_rows != n_rows:
+                break
+            segments.append((start + 8, n_rows))
+            end = start
+        if end == 0:
+            return segments[::-1], size
+
+        logging.warning("Columnar file %s does not end with a complete segment. Scanning it from the start" % path)
+        segments = []
+        start = 0
+        while start + 8 <= size:
+            f.seek(start)
+            header_magic, n_rows = struct.unpack("<4sI", f.read(8))
+            end = start + 8 + n_rows * row_bytes + 8
+            if header_magic != magic or end > size:
+                break
+            f.seek(end - 8)
+            if struct.unpack("<I4s", f.read(8)) != (n_rows, magic):
+                break
+            segments.append((start + 8, n_rows))
+            start = end
+        return segments, start
+
+
+class ColumnarResultWriter(object):
+    # the type of the columns, per SQL type of variable. Other types are stored as 64 bit integers
+    _column_types = {"SMALLINT": "<i2", "BOOLEAN": "|i1", "INT": "<i4"}
+    _time_type = "<i4"
+    # rows are written, per ROI, by segments of at least this many rows, or at least this old, in ms
+    _segment_rows = 1024
+    _segment_max_delay = 60 * 1000
+    _segment_magic = b"ETCS"
+    _schema_file = "schema.json"
+    _snapshot_dir = "IMG_SNAPSHOTS"
+    _file_extension = ".columnar"
+    # the rates reported by `stats` are measured over periods of this many seconds
+    _stats_interval = 10.0
+
+    def __init__(self, path, rois, metadata=None, make_dam_like_table=False, take_frame_shots=False, erase_old_db=True,
+                 *args, **kwargs):
+        """
+        Saves the data of an experiment in binary, columnar, files, instead of a database.
+        This is much cheaper than SQL inserts for many ROIs or high frame rates. Files are written directly,
+        when the writer is flushed, so there is no writer process.
+
+        ``path`` is a directory. Each ROI has a file, ``ROI_<idx>.bin``, made of append-only segments.
+        A segment holds, for a number of rows, one fixed-width array per column (``t``, then the variables,
+        with types from their SQL types), between a header and a footer that both give its number of rows.
+        ``schema.json`` describes the columns, and holds the ROI map, the variable map, the metadata and the start events.
+        Snapshots are saved as JPEG files, in ``IMG_SNAPSHOTS``.
+        Files can be read with :class:`~ethoscope.utils.io.ColumnarResultReader` and converted to the usual SQLite layout
+        with :func:`~ethoscope.utils.io.columnar_to_sqlite`.
+
+        :param path: the directory to save results into
+        :type path: str
+        :param rois: the ROIs of the experiment
+        :type rois: list(:class:`~ethoscope.core.roi.ROI`)
+        :param metadata: the metadata of the experiment
+        :type metadata: dict
+        :param make_dam_like_table: not supported. Activity can be computed from positions.
+        :type make_dam_like_table: bool
+        :param take_frame_shots: whether to save, periodically, a frame
+        :type take_frame_shots: bool
+        :param erase_old_db: whether to start from scratch. Otherwise, data are appended (e.g. after a crash)
+        :type erase_old_db: bool
+        """
+        self._path = path
+        self._rois = rois
+        self._metadata = metadata if metadata is not None else {}
+        self._make_dam_like_table = make_dam_like_table
+        self._take_frame_shots = take_frame_shots
+        if make_dam_like_table:
+            logging.warning("The columnar result writer does not make a DAM like table")
 
+        if take_frame_shots:
+            self._shot_saver = ImgToMySQLHelper()
+        else:
+            self._shot_saver = None
+
+        self._rows = {}
+        self._first_row_t = {}
+        self._files = {}
+        self._n_segments, self._n_rows, self._n_bytes = 0, 0, 0
+        # the time, segments and rows at the start of the current stats interval, and the rates of the last one
+        self._stats_window = (time.time(), 0, 0)
+        self._rates = {"segments_per_s": None, "rows_per_segment": None}
+
+        if erase_old_db:
+            shutil.rmtree(self._path, ignore_errors=True)
+            os.makedirs(self._path)
+            rois_features = [dict((k, None if v is None else int(v)) for k, v in r.get_feature_dict().items()) for r in rois]
+            self._schema = {"rois": rois_features,
+                            "columns": None,
+                            "var_map": None,
+                            "metadata": dict(self._metadata),
+                            "start_events": []}
+            event = "graceful_start"
+        else:
+            with open(os.path.join(self._path, self._schema_file)) as f:
+                self._schema = json.load(f)
+            event = "crash_recovery"
+        self._schema["start_events"].append((int(time.time()), event))
+        self._write_schema()
+        logging.info("Columnar result writer initialised in %s" % self._path)
+
+    @property
+    def metadata(self):
+        return self._metadata
+
+    @property
+    def stats(self):
+        """
+        Reading the stats has no side effect.
+
+        :return: the activity of the writer: the total number of segments, rows and bytes written, and the number of
+            rows waiting to be written. Segments written per second and rows per segment are measured over the last
+            complete period of ``_stats_interval`` seconds (``None`` before).
+        :rtype: dict
+        """
+        return {"segments_per_s": self._rates["segments_per_s"],
+                "rows_per_segment": self._rates["rows_per_segment"],
+                "segments": self._n_segments,
+                "rows_written": self._n_rows,
+                "bytes_written": self._n_bytes,
+                "buffered_rows": sum(len(r) for r in self._rows.values())}
+
+    def _update_rates(self):
+        now = time.time()
+        start, start_n_segments, start_n_rows = self._stats_window
+        if now - start < self._stats_interval or now <= start:
+            return
+        n_segments = self._n_segments - start_n_segments
+        self._rates = {"segments_per_s": round(n_segments / (now - start), 2),
+                       "rows_per_segment": round(float(self._n_rows - start_n_rows) / n_segments, 1) if n_segments > 0 else None}
+        self._stats_window = (now, self._n_segments, self._n_rows)
+
+    @property
+    def _row_bytes(self):
+        return sum(np.dtype(dtype).itemsize for _, dtype in self._schema["columns"])
+
+    def _write_schema(self):
+        tmp_path = os.path.join(self._path, self._schema_file + ".tmp")
+        with open(tmp_path, "w") as f:
+            # metadata that are not JSON types are saved as strings, as in the METADATA table
+            json.dump(self._schema, f, default=str)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, os.path.join(self._path, self._schema_file))
+
+    def _initialise(self, data_row):
+        columns = [("t", self._time_type)]
+        columns += [(dt.header_name, self._column_types.get(dt.sql_data_type, "<i8")) for dt in data_row.values()]
+        if self._schema["columns"] is not None and [tuple(c) for c in self._schema["columns"]] != columns:
+            raise ValueError("The variables differ from those of the existing result files")
+        self._schema["columns"] = columns
+        self._schema["var_map"] = [(dt.header_name, dt.sql_data_type, dt.functional_type) for dt in data_row.values()]
+        self._write_schema()
+
+        for r in self._rois:
+            file_path = os.path.join(self._path, "ROI_%i.bin" % r.idx)
+            if os.path.exists(file_path):
+                # an incomplete last segment is dropped, so that new segments follow complete ones
+                _, end = _segment_index(file_path, self._row_bytes, self._segment_magic)
+                with open(file_path, "r+b") as f:
+                    f.truncate(end)
+            self._files[r.idx] = open(file_path, "ab")
+
+    def write(self, t, roi, data_rows):
+        if len(self._files) == 0:
+            self._initialise(data_rows[0])
+        t = int(round(t))
+        rows = self._rows.setdefault(roi.idx, [])
+        if len(rows) == 0:
+            self._first_row_t[roi.idx] = t
         for dr in data_rows:
-            # here we use NULL because SQLite does not support '0' for auto index
-            tp = (self._null, t) + tuple(dr.values())
+            rows.append((t,) + tuple(int(v) for v in dr.values()))
+
+    def _write_segment(self, roi_idx):
+        rows = self._rows.get(roi_idx)
+        if not rows:
+            return
+        table = np.array(rows, np.int64)
+        header = struct.pack("<4sI", self._segment_magic, len(rows))
+        parts = [header]
+        for i, (_, dtype) in enumerate(self._schema["columns"]):
+            parts.append(table[:, i].astype(dtype).tobytes())
+        parts.append(struct.pack("<I4s", len(rows), self._segment_magic))
+        segment = b"".join(parts)
+
+        f = self._files[roi_idx]
+        f.write(segment)
+        f.flush()
+        self._n_segments += 1
+        self._n_rows += len(rows)
+        self._n_bytes += len(segment)
+        self._rows[roi_idx] = []
+
+    def snapshot_due(self, t):
+        """
+        :param t: the time since start of the experiment, in ms
+        :return: whether :meth:`flush` needs the frame at time ``t``, to take a snapshot
+        :rtype: bool
+        """
+        return self._shot_saver is not None and self._shot_saver.is_due(t)
+
+    def dam_due(self, t):
+        """
+        :return: ``False``, as there is no DAM like table
+        :rtype: bool
+        """
+        return False
+
+    def flush(self, t, img=None, dam=True):
+        """
+        Writes the segments that are large or old enough.
+
+        :param t: the time since start of the experiment, in ms
+        :param img: the last frame, used to take snapshots. ``None`` means no snapshot is taken (it is postponed).
+        :type img: :class:`~numpy.ndarray`
+        :param dam: unused, as there is no DAM like table
+        :type dam: bool
+        """
+        if self._shot_saver is not None:
+            shots = self._shot_saver.flush(t, img) if img is not None else self._shot_saver.collect()
+            for shot_t, jpeg in shots:
+                self._save_snapshot(shot_t, jpeg)
+
+        for roi_idx, rows in self._rows.items():
+            if len(rows) >= self._segment_rows or (len(rows) > 0 and t - self._first_row_t[roi_idx] >= self._segment_max_delay):
+                self._write_segment(roi_idx)
+        self._update_rates()
+        return False
+
+    def __enter__(self):
+        return self
+
+    def _save_snapshot(self, t, jpeg):
+        shot_dir = os.path.join(self._path, self._snapshot_dir)
+        if not os.path.exists(shot_dir):
+            os.makedirs(shot_dir)
+        with open(os.path.join(shot_dir, "%i.jpg" % t), "wb") as f:
+            f.write(jpeg)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        logging.info("Closing columnar result writer...")
+        try:
+            if self._shot_saver is not None:
+                for shot_t, jpeg in self._shot_saver.close():
+                    self._save_snapshot(shot_t, jpeg)
+            for roi_idx in self._rows.keys():
+                self._write_segment(roi_idx)
+            self._schema["metadata"]["stop_date_time"] = str(int(time.time()))
+            self._write_schema()
+        finally:
+            for f in self._files.values():
+                os.fsync(f.fileno())
+                f.close()
+            self._files = {}
 
-            if roi_id not in self._insert_dict  or self._insert_dict[roi_id] == "":
-                command = 'INSERT INTO ROI_%i VALUES %s' % (roi_id, str(tp))
-                self._insert_dict[roi_id] = command
+    def close(self):
+        pass
+
+    def __getstate__(self):
+        return {"args": {"path": self._path,
+                         "rois": self._rois,
+                         "metadata": self._metadata,
+                         "make_dam_like_table": self._make_dam_like_table,
+                         "take_frame_shots": self._take_frame_shots,
+                         "erase_old_db": False}}
+
+    def __setstate__(self, state):
+        self.__init__(**state["args"])
+
+
+class ColumnarResultReader(object):
+    def __init__(self, path):
+        """
+        Reads the files of a :class:`~ethoscope.utils.io.ColumnarResultWriter`. Files are memory-mapped.
+
+        :param path: the directory of the results
+        :type path: str
+        """
+        self._path = path
+        with open(os.path.join(path, ColumnarResultWriter._schema_file)) as f:
+            self._schema = json.load(f)
+
+    @property
+    def rois(self):
+        """
+        :return: the features of the ROIs, as in the ``ROI_MAP`` table
+        :rtype: list(dict)
+        """
+        return self._schema["rois"]
+
+    @property
+    def var_map(self):
+        """
+        :return: the name, SQL type and functional type of each variable, as in the ``VAR_MAP`` table
+        :rtype: list(tuple)
+        """
+        return [tuple(v) for v in self._schema["var_map"] or []]
+
+    @property
+    def metadata(self):
+        return self._schema["metadata"]
+
+    @property
+    def start_events(self):
+        return [tuple(e) for e in self._schema["start_events"]]
+
+    @property
+    def columns(self):
+        """
+        :return: the name and type of the columns of ROI files
+        :rtype: list((str, str))
+        """
+        return [tuple(c) for c in self._schema["columns"] or []]
+
+    def segments(self, roi_idx):
+        """
+        :param roi_idx: the index of a ROI
+        :type roi_idx: int
+        :return: the columns of each segment, as memory-mapped arrays
+        :rtype: list(:class:`~collections.OrderedDict`)
+        """
+        file_path = os.path.join(self._path, "ROI_%i.bin" % roi_idx)
+        if not os.path.exists(file_path) or os.path.getsize(file_path) == 0:
+            return []
+        row_bytes = sum(np.dtype(dtype).itemsize for _, dtype in self.columns)
+        index, _ = _segment_index(file_path, row_bytes, ColumnarResultWriter._segment_magic)
+        data = np.memmap(file_path, dtype=np.uint8, mode="r")
+        out = []
+        for offset, n_rows in index:
+            segment = OrderedDict()
+            for name, dtype in self.columns:
+                n_bytes = n_rows * np.dtype(dtype).itemsize
+                segment[name] = data[offset:offset + n_bytes].view(dtype)
+                offset += n_bytes
+            out.append(segment)
+        return out
+
+    def read(self, roi_idx):
+        """
+        :param roi_idx: the index of a ROI
+        :type roi_idx: int
+        :return: all the values of each column
+        :rtype: :class:`~collections.OrderedDict`
+        """
+        segments = self.segments(roi_idx)
+        out = OrderedDict()
+        for name, dtype in self.columns:
+            if len(segments) == 1:
+                out[name] = segments[0][name]
             else:
-                self._insert_dict[roi_id] += ("," + str(tp))
+                out[name] = np.concatenate([s[name] for s in segments]) if segments else np.zeros(0, dtype)
+        return out
+
+
+def columnar_to_sqlite(path, db_path):
+    """
+    Converts the files of a :class:`~ethoscope.utils.io.ColumnarResultWriter` to a SQLite database, with the same layout
+    as a :class:`~ethoscope.utils.io.SQLiteResultWriter` (but no DAM like table), for downstream tools.
+
+    :param path: the directory of the results
+    :type path: str
+    :param db_path: the database to create. It must not exist.
+    :type db_path: str
+    """
+    if os.path.exists(db_path):
+        raise ValueError("%s already exists" % db_path)
+    reader = ColumnarResultReader(path)
+    db = sqlite3.connect(db_path)
+    try:
+        c = db.cursor()
+        c.execute("CREATE TABLE ROI_MAP (roi_idx SMALLINT, roi_value SMALLINT, x SMALLINT,y SMALLINT,w SMALLINT,h SMALLINT)")
+        c.executemany("INSERT INTO ROI_MAP VALUES (?, ?, ?, ?, ?, ?)",
+                      [(r["idx"], r["value"], r["x"], r["y"], r["w"], r["h"]) for r in reader.rois])
+        c.execute("CREATE TABLE VAR_MAP (var_name CHAR(100), sql_type CHAR(100), functional_type CHAR(100))")
+        c.executemany("INSERT INTO VAR_MAP VALUES (?, ?, ?)", reader.var_map)
+        c.execute("CREATE TABLE METADATA (field CHAR(100), value VARCHAR(3000))")
+        c.executemany("INSERT INTO METADATA VALUES (?, ?)", [(k, str(v)) for k, v in reader.metadata.items()])
+        c.execute("CREATE TABLE START_EVENTS (id INTEGER PRIMARY KEY, t INT, event CHAR(100))")
+        c.executemany("INSERT INTO START_EVENTS (t, event) VALUES (?, ?)", reader.start_events)
+
+        if len(reader.columns) > 0:
+            fields = ", ".join(["id INTEGER PRIMARY KEY", "t INT"] + ["%s %s" % (v[0], v[1]) for v in reader.var_map])
+            names = [name for name, _ in reader.columns]
+            for r in reader.rois:
+                table_name = "ROI_%i" % r["idx"]
+                c.execute("CREATE TABLE %s (%s)" % (table_name, fields))
+                command = "INSERT INTO %s (%s) VALUES (%s)" % (table_name, ", ".join(names), ", ".join("?" * len(names)))
+                for segment in reader.segments(r["idx"]):
+                    c.executemany(command, zip(*[segment[n].tolist() for n in names]))
+
+        shot_dir = os.path.join(path, ColumnarResultWriter._snapshot_dir)
+        if os.path.isdir(shot_dir):
+            c.execute("CREATE TABLE IMG_SNAPSHOTS (id INTEGER PRIMARY KEY, t INT, img LONGBLOB)")
+            for t in sorted(int(os.path.splitext(f)[0]) for f in os.listdir(shot_dir)):
+                with open(os.path.join(shot_dir, "%i.jpg" % t), "rb") as f:
+                    c.execute("INSERT INTO IMG_SNAPSHOTS (t, img) VALUES (?, ?)", (t, sqlite3.Binary(f.read())))
+        db.commit()
+    finally:
+        db.close()
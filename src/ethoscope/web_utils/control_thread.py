@@ -13,9 +13,18 @@ import trace
 from ethoscope.hardware.input.cameras import OurPiCameraAsync, MovieVirtualCamera, DummyPiCameraAsync, V4L2Camera
 from ethoscope.roi_builders.target_roi_builder import  OlfactionAssayROIBuilder, SleepMonitorWithTargetROIBuilder, TargetGridROIBuilder
 from ethoscope.roi_builders.roi_builders import  DefaultROIBuilder
-from ethoscope.core.monitor import Monitor
+from ethoscope.roi_builders.layout_cache import ROILayoutCache
+from ethoscope.core.monitor import Monitor, PipelinedMonitor
+from ethoscope.core.rate_scheduler import AdaptiveRateScheduler
+from ethoscope.core.frame_change import FrameChangeDetector
+from ethoscope.core.drift_correction import ROIDriftCorrector
+from ethoscope.core.roi import ROISet
 from ethoscope.drawers.drawers import NullDrawer, DefaultDrawer
 from ethoscope.trackers.adaptive_bg_tracker import AdaptiveBGModel
+from ethoscope.trackers.tube_tracker import TubeProjectionTracker
+from ethoscope.trackers.compact_bg_tracker import CompactAdaptiveBGModel
+from ethoscope.trackers.frame_difference_tracker import FrameDifferenceTracker
+from ethoscope.trackers.motion_model import KalmanMotionBank
 from ethoscope.hardware.interfaces.interfaces import HardwareConnection
 from ethoscope.stimulators.stimulators import DefaultStimulator
 #<<<<<<< HEAD
@@ -28,7 +37,8 @@ from ethoscope.stimulators.odour_stimulators import DynamicOdourSleepDepriver, M
 from ethoscope.stimulators.optomotor_stimulators import OptoMidlineCrossStimulator
 
 from ethoscope.utils.debug import EthoscopeException
-from ethoscope.utils.io import ResultWriter, SQLiteResultWriter
+from ethoscope.utils.io import ResultWriter, SQLiteResultWriter, WALSQLiteResultWriter, ColumnarResultWriter
+from ethoscope.utils.checkpoint import TrackerCheckpointer
 from ethoscope.utils.description import DescribedObject
 from ethoscope.web_utils.helpers import isMachinePI
 
@@ -60,6 +70,50 @@ class ExperimentalInformations(DescribedObject):
             return self._info_dic
 
 
+class MonitorOptions(DescribedObject):
+        _description  = {   "overview": "Optional changes to how frames are processed",
+                            "arguments": [
+                                    {"type": "number", "name":"adaptive_rate", "min": 0, "max": 1, "step": 1, "default": 0,
+                                     "description": "Track ROIs where nothing moves at a lower rate (1) or not (0)"},
+                                    {"type": "number", "name":"skip_static_frames", "min": 0, "max": 1, "step": 1, "default": 0,
+                                     "description": "Do not track frames where nothing changed (1), or track all frames (0)"},
+                                    {"type": "number", "name":"motion_model", "min": 0, "max": 1, "step": 1, "default": 0,
+                                     "description": "When an animal is not detected, predict its position from its motion (1), or repeat its last position (0)"},
+                                    {"type": "number", "name":"pipelined", "min": 0, "max": 1, "step": 1, "default": 0,
+                                     "description": "Acquire frames, save results and draw in separate threads (1), or all in the tracking loop (0)"},
+                                   ]}
+        def __init__(self, adaptive_rate=0, skip_static_frames=0, motion_model=0, pipelined=0):
+            self._adaptive_rate = bool(float(adaptive_rate))
+            self._skip_static_frames = bool(float(skip_static_frames))
+            self._motion_model = bool(float(motion_model))
+            self._pipelined = bool(float(pipelined))
+
+        @property
+        def monitor_class(self):
+            """
+            :return: the class of the monitor for the selected options
+            :rtype: class
+            """
+            if self._pipelined:
+                return PipelinedMonitor
+            return Monitor
+
+        @property
+        def monitor_kwargs(self):
+            """
+            :return: the keyword arguments of the :class:`~ethoscope.core.monitor.Monitor` for the selected options
+            :rtype: dict
+            """
+            kwargs = {}
+            if self._adaptive_rate:
+                kwargs["rate_scheduler"] = AdaptiveRateScheduler()
+            if self._skip_static_frames:
+                kwargs["change_detector"] = FrameChangeDetector()
+            if self._motion_model:
+                kwargs["motion_model"] = KalmanMotionBank()
+            return kwargs
+
+
 class ControlThread(Thread):
     """
     The versatile control thread
@@ -72,7 +126,7 @@ class ControlThread(Thread):
                 "possible_classes":[DefaultROIBuilder, SleepMonitorWithTargetROIBuilder, TargetGridROIBuilder, OlfactionAssayROIBuilder],
             },
         "tracker":{
-                "possible_classes":[AdaptiveBGModel],
+                "possible_classes":[AdaptiveBGModel, CompactAdaptiveBGModel, TubeProjectionTracker, FrameDifferenceTracker],
             },
         "interactor":{
                         "possible_classes":[DefaultStimulator, 
@@ -95,10 +149,13 @@ class ControlThread(Thread):
                         "possible_classes":[OurPiCameraAsync, MovieVirtualCamera, DummyPiCameraAsync, V4L2Camera],
                     },
         "result_writer":{
-                        "possible_classes":[ResultWriter, SQLiteResultWriter],
+                        "possible_classes":[ResultWriter, SQLiteResultWriter, WALSQLiteResultWriter, ColumnarResultWriter],
                 },
         "experimental_info":{
                         "possible_classes":[ExperimentalInformations],
+                },
+        "monitor_options":{
+                        "possible_classes":[MonitorOptions],
                 }
      }
     
@@ -127,12 +184,16 @@ class ControlThread(Thread):
                             "fps":0
                             }
     _persistent_state_file = "/var/cache/ethoscope/persistent_state.pkl"
+    _tracker_checkpoint_file = "/var/cache/ethoscope/tracker_checkpoint.pkl"
+    _roi_layout_cache_file = "/var/cache/ethoscope/roi_layouts.pkl"
+    _result_spill_file = "/var/cache/ethoscope/result_spill.log"
 
     def __init__(self, machine_id, name, version, ethoscope_dir, data=None, *args, **kwargs):
 
         self._monit_args = args
         self._monit_kwargs = kwargs
         self._metadata = None
+        self._ethoscope_dir = ethoscope_dir
 
         # for FPS computation
         self._last_info_t_stamp = 0
@@ -171,6 +232,10 @@ class ControlThread(Thread):
                         "experimental_info": {}
                         }
         self._monit = None
+        # the ROI builder, which keeps the anchors of the layout, and the corrector keeping ROIs aligned on them
+        self._roi_builder = None
+        self._drift_corrector = None
+        self._result_writer = None
 
         self._parse_user_options(data)
 
@@ -279,10 +344,37 @@ class ControlThread(Thread):
                             "last_time_stamp":t,
                             "fps": f
                             }
+            ttfp = self._monit.time_to_first_positions
+            self._info["monitor_info"]["time_to_first_position"] = {str(k): v for k, v in ttfp.items()}
+            deadline_stats = self._monit.deadline_stats
+            if deadline_stats is not None:
+                self._info["monitor_info"]["deadline"] = deadline_stats
+            rate_stats = self._monit.rate_stats
+            if rate_stats is not None:
+                self._info["monitor_info"]["adaptive_rate"] = rate_stats
+            memory = self._monit.memory_footprint
+            self._info["monitor_info"]["memory_footprint"] = {"per_roi": {str(k): v for k, v in memory["per_roi"].items()},
+                                                              "total": memory["total"],
+                                                              "shared": memory["shared"]}
+            frame_skip_stats = self._monit.frame_skip_stats
+            if frame_skip_stats is not None:
+                self._info["monitor_info"]["frame_skip"] = frame_skip_stats
+            drift_stats = self._monit.drift_stats
+            if drift_stats is not None:
+                self._info["monitor_info"]["roi_drift"] = drift_stats
+            if isinstance(self._monit, PipelinedMonitor):
+                self._info["monitor_info"]["pipeline"] = self._monit.stage_stats
+            result_writer = self._result_writer
+            if result_writer is not None:
+                self._info["monitor_info"]["db_writer"] = result_writer.stats
 
         frame = self._drawer.last_drawn_frame
         if frame is not None:
-            cv2.imwrite(self._info["last_drawn_img"], frame, [int(cv2.IMWRITE_JPEG_QUALITY), 50])
+            # the info image is optional work, we do not encode it when the monitor is falling behind
+            if self._monit.is_overloaded and os.path.exists(self._info["last_drawn_img"]):
+                self._monit.shed_task("info_image")
+            else:
+                cv2.imwrite(self._info["last_drawn_img"], frame, [int(cv2.IMWRITE_JPEG_QUALITY), 50])
 
 
         self._last_info_t_stamp = wall_time
@@ -290,7 +382,7 @@ class ControlThread(Thread):
 
 
     def _start_tracking(self, camera, result_writer, rois,   TrackerClass, tracker_kwargs,
-                        hardware_connection, StimulatorClass, stimulator_kwargs):
+                        hardware_connection, StimulatorClass, stimulator_kwargs, resume=False):
 
         #Here the stimulator passes args. Hardware connection was previously open as thread.
         stimulators = [StimulatorClass(hardware_connection, **stimulator_kwargs) for _ in rois]
@@ -300,18 +392,59 @@ class ControlThread(Thread):
 
         # todo: pickle hardware connection, camera, rois, tracker class, stimulator class,.
         # then rerun stimulators and Monitor(......)
-        self._monit = Monitor(camera, TrackerClass, rois,
-                              stimulators=stimulators,
-                              *self._monit_args)
+        # trackers are checkpointed only when the experiment can be resumed (i.e. the camera can be pickled)
+        checkpointer = None
+        if camera.canbepickled:
+            checkpointer = TrackerCheckpointer(self._tracker_checkpoint_file)
+            if not resume:
+                checkpointer.remove()
+
+        MonitorOptionsClass = self._option_dict["monitor_options"]["class"]
+        monitor_options = MonitorOptionsClass(**self._option_dict["monitor_options"]["kwargs"])
+
+        MonitorClass = monitor_options.monitor_class
+        self._monit = MonitorClass(camera, TrackerClass, rois,
+                                   stimulators=stimulators,
+                                   target_fps=camera.target_fps,
+                                   checkpointer=checkpointer,
+                                   drift_corrector=self._drift_corrector,
+                                   *self._monit_args, **monitor_options.monitor_kwargs)
+
+        if resume and checkpointer is not None:
+            states = checkpointer.load()
+            if states is not None:
+                # trackers worked on aligned ROIs, so the alignment is restored first
+                n_restored = self._monit.restore_tracker_states(states, checkpointer.drift_state,
+                                                                checkpointer.shared_state)
+                logging.info("Restored %i trackers out of %i from checkpoint" % (n_restored, len(rois)))
         self._info["status"] = "running"
         logging.info("Setting monitor status as running: '%s'" % self._info["status"])
 
         self._monit.run(result_writer, self._drawer)
 
+    def _result_destination(self, ResultWriterClass):
+        # file based writers save results in the ethoscope directory, named after the database
+        if issubclass(ResultWriterClass, SQLiteResultWriter):
+            return os.path.join(self._ethoscope_dir, self._db_credentials["name"] + ".db")
+        if issubclass(ResultWriterClass, ColumnarResultWriter):
+            return os.path.join(self._ethoscope_dir, self._db_credentials["name"] + ColumnarResultWriter._file_extension)
+        return self._db_credentials
+
     def _set_tracking_from_pickled(self):
         with open(self._persistent_state_file, "r") as f:
             time.sleep(15)
-            return pickle.load(f)
+            state = pickle.load(f)
+        # states saved by older versions have no ROI builder, so ROIs cannot be aligned anymore
+        roi_builder = state[8] if len(state) > 8 else None
+        self._set_drift_corrector(roi_builder, state[2])
+        return state[0:8]
+
+    def _set_drift_corrector(self, roi_builder, rois):
+        # ROIs follow small displacements of the arena during the experiment
+        self._roi_builder = roi_builder
+        self._drift_corrector = None
+        if roi_builder is not None and roi_builder.layout_anchors is not None:
+            self._drift_corrector = ROIDriftCorrector(roi_builder, rois)
 
     def _save_pickled_state(self, camera, result_writer, rois,   TrackerClass, tracker_kwargs,
                         hardware_connection, StimulatorClass, stimulator_kwargs):
@@ -321,7 +454,7 @@ class ControlThread(Thread):
         """
 
         tpl = (camera, result_writer, rois, TrackerClass, tracker_kwargs,
-                        hardware_connection, StimulatorClass, stimulator_kwargs)
+                        hardware_connection, StimulatorClass, stimulator_kwargs, self._roi_builder)
 
 
         if not os.path.exists(os.path.dirname(self._persistent_state_file)):
@@ -353,12 +486,19 @@ class ControlThread(Thread):
         cam = CameraClass(**camera_kwargs)
 
         roi_builder = ROIBuilderClass(**roi_builder_kwargs)
+        # arenas rarely move, so the layout of the previous experiment is reused when it still matches
+        layout_cache = ROILayoutCache(self._roi_layout_cache_file)
+        layout_key = layout_cache.key(self._info["id"], ROIBuilderClass, roi_builder_kwargs)
         try:
-            rois = roi_builder.build(cam)
+            rois = layout_cache.build(roi_builder, cam, layout_key)
         except EthoscopeException as e:
             cam._close()
             raise e
 
+        # packed once, and shared by the monitor, its trackers and the result writer
+        rois = ROISet(rois)
+
+        self._set_drift_corrector(roi_builder, rois)
 
         logging.info("Initialising monitor")
         cam.restart()
@@ -385,7 +525,9 @@ class ControlThread(Thread):
             "selected_options": str(self._option_dict),
         }
         # hardware_interface is a running thread
-        rw = ResultWriter(self._db_credentials, rois, self._metadata, take_frame_shots=True)
+        # database commands are spilled to disk when the database falls behind
+        rw = ResultWriterClass(self._result_destination(ResultWriterClass), rois, self._metadata, take_frame_shots=True,
+                               spill_path=self._result_spill_file, **result_writer_kwargs)
 
         return  (cam, rw, rois, TrackerClass, tracker_kwargs,
                         hardware_connection, StimulatorClass, stimulator_kwargs)
@@ -394,6 +536,8 @@ class ControlThread(Thread):
         cam = None
         hardware_connection = None
 
+        resume = False
+
         try:
             self._info["status"] = "initialising"
             logging.info("Starting Monitor thread")
@@ -403,6 +547,7 @@ class ControlThread(Thread):
 
             try:
                 cam, rw, rois, TrackerClass, tracker_kwargs, hardware_connection, StimulatorClass, stimulator_kwargs = self._set_tracking_from_pickled()
+                resume = True
 
             except IOError:
                 cam, rw, rois, TrackerClass, tracker_kwargs, hardware_connection, StimulatorClass, stimulator_kwargs = self._set_tracking_from_scratch()
@@ -412,11 +557,12 @@ class ControlThread(Thread):
                 #cam, rw, rois, TrackerClass, tracker_kwargs, hardware_connection, StimulatorClass, stimulator_kwargs = self._set_tracking_from_scratch()
             
             with rw as result_writer:
+                self._result_writer = result_writer
                 if cam.canbepickled:
                     self._save_pickled_state(cam, rw, rois, TrackerClass, tracker_kwargs, hardware_connection, StimulatorClass, stimulator_kwargs)
                 
                 self._start_tracking(cam, result_writer, rois, TrackerClass, tracker_kwargs,
-                                     hardware_connection, StimulatorClass, stimulator_kwargs)
+                                     hardware_connection, StimulatorClass, stimulator_kwargs, resume)
             self.stop()
 
         except EthoscopeException as e:
@@ -432,6 +578,7 @@ class ControlThread(Thread):
                 os.remove(self._persistent_state_file)
             except:
                 logging.warning("Failed to remove persistent file")
+            TrackerCheckpointer(self._tracker_checkpoint_file).remove()
             try:
                 if cam is not None:
                     cam._close()
@@ -462,6 +609,7 @@ class ControlThread(Thread):
         if not self._monit is None:
             self._monit.stop()
             self._monit = None
+        self._result_writer = None
 
         self._info["status"] = "stopped"
         self._info["time"] = time.time()